@@ -109,7 +109,7 @@ def main(output, robot_ip, vis_camera_idx, init_joints, frequency, command_laten
 
                 # visualize
                 vis_img = obs[f'camera_{vis_camera_idx}'][-1,:,:,::-1].copy()
-                episode_id = env.replay_buffer.n_episodes
+                episode_id = env.episode_writer.n_episodes
                 text = f'Episode: {episode_id}, Stage: {stage}'
                 if is_recording:
                     text += ', Recording!'
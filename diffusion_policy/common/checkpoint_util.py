@@ -1,5 +1,20 @@
 from typing import Optional, Dict
 import os
+from diffusion_policy.common.sharded_checkpoint import (
+    is_sharded_checkpoint, remove_sharded_checkpoint)
+
+
+def remove_checkpoint(path):
+    """
+    Removes a checkpoint written by BaseWorkspace.save_checkpoint.
+    """
+    if is_sharded_checkpoint(path):
+        # also frees shards no longer linked by other checkpoints
+        remove_sharded_checkpoint(path,
+            shard_store=os.path.join(os.path.dirname(path), '.shards'))
+    elif os.path.exists(path):
+        os.remove(path)
+
 
 class TopKCheckpointManager:
     def __init__(self,
@@ -19,6 +34,18 @@ class TopKCheckpointManager:
         self.format_str = format_str
         self.path_value_map = dict()
     
+    def get_threshold(self) -> Optional[float]:
+        """
+        Value of monitor_key a new checkpoint has to beat
+        to enter the top-k, None if any value would.
+        """
+        if (self.k == 0) or (len(self.path_value_map) < self.k):
+            return None
+        values = self.path_value_map.values()
+        if self.mode == 'max':
+            return min(values)
+        return max(values)
+
     def get_ckpt_path(self, data: Dict[str, float]) -> Optional[str]:
         if self.k == 0:
             return None
@@ -54,6 +81,5 @@ class TopKCheckpointManager:
             if not os.path.exists(self.save_dir):
                 os.mkdir(self.save_dir)
 
-            if os.path.exists(delete_path):
-                os.remove(delete_path)
+            remove_checkpoint(delete_path)
             return ckpt_path
@@ -0,0 +1,147 @@
+from typing import Callable, Optional
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import zarr
+
+
+def _encode_chunk(compressor, chunk, verify_read=True, store=None, key=None):
+    encoded = compressor.encode(np.ascontiguousarray(chunk))
+    if verify_read:
+        # make sure we can successfully decode
+        _ = compressor.decode(encoded)
+    if store is not None:
+        store[key] = encoded
+        return None
+    return encoded
+
+
+class ChunkEncoder:
+    """
+    Encodes frames into a zarr array one whole chunk per task.
+    Frames are buffered with put() until their chunk is complete,
+    the chunk is then encoded with the array's compressor and stored
+    under its chunk key, bypassing zarr's read-modify-write.
+
+    mode='thread': encode and store in a thread pool.
+    mode='process': encode in a process pool. Workers write directly
+        into a DirectoryStore, otherwise (e.g. MemoryStore) the encoded
+        bytes are sent back and stored by the main process.
+        Workers are spawned, the main module needs an
+        if __name__ == '__main__' guard.
+
+    Arrays must be chunked in time only and have no filters.
+    """
+    def __init__(self,
+            mode: str='thread',
+            n_workers: Optional[int]=None,
+            max_inflight_tasks: Optional[int]=None,
+            verify_read: bool=True,
+            callback: Optional[Callable[[int, int], None]]=None):
+        """
+        callback: called with (chunk_start, n_frames) after each chunk is stored.
+        """
+        assert mode in ('thread', 'process')
+        if n_workers is None or n_workers <= 0:
+            n_workers = multiprocessing.cpu_count()
+        if max_inflight_tasks is None:
+            max_inflight_tasks = n_workers * 5
+        self.mode = mode
+        self.n_workers = n_workers
+        self.max_inflight_tasks = max_inflight_tasks
+        self.verify_read = verify_read
+        self.callback = callback
+        self.executor = None
+        # future: (store, key, chunk_start, n_frames)
+        self.futures = dict()
+        # (store id, array path, chunk idx): [zarr_arr, chunk, n_frames]
+        self.pending_chunks = dict()
+
+    # ========= context manager ===========
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.stop()
+
+    def start(self):
+        if self.mode == 'process':
+            # callers are often decoding with threads, avoid fork
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.n_workers)
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    # ========= API ===========
+    def put(self, zarr_arr: zarr.Array, idx: int, frame: np.ndarray):
+        chunk_len = zarr_arr.chunks[0]
+        assert tuple(zarr_arr.chunks[1:]) == tuple(zarr_arr.shape[1:])
+        chunk_idx = idx // chunk_len
+        buf_key = (id(zarr_arr.store), zarr_arr.path, chunk_idx)
+        if buf_key not in self.pending_chunks:
+            chunk = np.full(zarr_arr.chunks,
+                fill_value=zarr_arr.fill_value or 0, dtype=zarr_arr.dtype)
+            self.pending_chunks[buf_key] = [zarr_arr, chunk, 0]
+        entry = self.pending_chunks[buf_key]
+        entry[1][idx - chunk_idx * chunk_len] = frame
+        entry[2] += 1
+
+        chunk_start = chunk_idx * chunk_len
+        n_rows = min(chunk_len, zarr_arr.shape[0] - chunk_start)
+        if entry[2] >= n_rows:
+            del self.pending_chunks[buf_key]
+            self._submit(zarr_arr, chunk_idx, entry[1], entry[2])
+
+    def flush(self):
+        """
+        Submit incomplete chunks (missing frames are fill_value)
+        and wait for all tasks.
+        """
+        for buf_key, (zarr_arr, chunk, n_frames) in list(self.pending_chunks.items()):
+            del self.pending_chunks[buf_key]
+            self._submit(zarr_arr, buf_key[-1], chunk, n_frames)
+        self._wait(concurrent.futures.ALL_COMPLETED)
+
+    # ========= internal ===========
+    def _submit(self, zarr_arr, chunk_idx, chunk, n_frames):
+        if len(self.futures) >= self.max_inflight_tasks:
+            # limit number of inflight tasks
+            self._wait(concurrent.futures.FIRST_COMPLETED)
+
+        store = zarr_arr.store
+        key = zarr_arr._chunk_key((chunk_idx,) + (0,) * (len(zarr_arr.shape) - 1))
+        worker_store = store
+        if (self.mode == 'process') and (not isinstance(store, zarr.DirectoryStore)):
+            # store not shared with workers
+            worker_store = None
+        f = self.executor.submit(_encode_chunk,
+            zarr_arr.compressor, chunk, self.verify_read, worker_store, key)
+        self.futures[f] = (store, key, chunk_idx * zarr_arr.chunks[0], n_frames)
+
+    def _wait(self, return_when):
+        if len(self.futures) == 0:
+            return
+        completed, _ = concurrent.futures.wait(
+            self.futures.keys(), return_when=return_when)
+        for f in completed:
+            store, key, chunk_start, n_frames = self.futures.pop(f)
+            try:
+                encoded = f.result()
+            except Exception as e:
+                raise RuntimeError('Failed to encode image!') from e
+            if encoded is not None:
+                store[key] = encoded
+            if self.callback is not None:
+                self.callback(chunk_start, n_frames)
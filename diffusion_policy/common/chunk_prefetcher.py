@@ -0,0 +1,299 @@
+"""
+Read-ahead of zarr chunks for a known sample order.
+
+ChunkPrefetcher decodes whole chunks on a thread pool into a bounded
+buffer, PrefetchedArray serves reads from it. ChunkPrefetchLoader
+walks a batch sampler, schedules the chunks of the next lookahead
+batches and calls dataset.get_batch, overlapping I/O and decoding
+with the training step. Scheduled chunks are pinned until their
+batch is consumed, only unpinned chunks are evicted. Stall counters (time spent waiting for
+chunks still being decoded, or read synchronously) tell if
+n_threads, lookahead or max_bytes are too small.
+"""
+from typing import Dict, Sequence
+import time
+import numbers
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+import torch.utils.data
+
+
+class ChunkPrefetcher:
+    def __init__(self, arrays: Dict[str, 'zarr.Array'],
+            max_bytes: int=2**30, n_threads: int=8):
+        """
+        arrays: chunked along the first (time) dim only, as in ReplayBuffer.
+        max_bytes: bound on decoded chunks held in the buffer.
+        """
+        self.arrays = dict(arrays)
+        self.max_bytes = int(max_bytes)
+        self.n_threads = n_threads
+        self._init_buffer()
+
+        self.n_hits = 0
+        self.n_stalls = 0
+        self.stall_time = 0.
+        self.n_misses = 0
+        self.miss_time = 0.
+        self.n_evictions = 0
+
+    def _init_buffer(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.n_threads)
+        # (key, chunk_idx): Future, in LRU order
+        self.chunks = collections.OrderedDict()
+        # (key, chunk_idx): number of scheduled batches using it
+        self.pins = collections.Counter()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # copies (e.g. in DataLoader workers) start with an empty buffer
+        state = self.__dict__.copy()
+        for key in ['executor', 'chunks', 'pins', 'n_bytes', 'lock']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_buffer()
+
+    def _chunk_nbytes(self, key) -> int:
+        arr = self.arrays[key]
+        return arr.chunks[0] * int(np.prod(arr.shape[1:])) \
+            * np.dtype(arr.dtype).itemsize
+
+    def _read_chunk(self, key, chunk_idx) -> np.ndarray:
+        arr = self.arrays[key]
+        chunk_len = arr.chunks[0]
+        return arr[chunk_idx*chunk_len:(chunk_idx+1)*chunk_len]
+
+    def _make_room(self, n_bytes) -> bool:
+        # evict least recently used decoded chunks, never pending or pinned ones
+        while self.n_bytes + n_bytes > self.max_bytes:
+            for chunk_key, future in self.chunks.items():
+                if future.done() and (chunk_key not in self.pins):
+                    break
+            else:
+                return False
+            del self.chunks[chunk_key]
+            self.n_bytes -= self._chunk_nbytes(chunk_key[0])
+            self.n_evictions += 1
+        return True
+
+    def schedule(self, key: str, rows: np.ndarray, pin: bool=False) -> tuple:
+        """
+        Start decoding the chunks of key containing rows, in order.
+        Stops early when the buffer is full of pending or pinned chunks.
+        pin: keep the chunks until released with unpin.
+        Returns (chunk keys in the buffer, whether all chunks are).
+        """
+        chunk_len = self.arrays[key].chunks[0]
+        chunk_idxs = np.asarray(rows, dtype=np.int64).reshape(-1) // chunk_len
+        # unique, in order of first use
+        _, first = np.unique(chunk_idxs, return_index=True)
+        chunk_keys = list()
+        complete = True
+        with self.lock:
+            for chunk_idx in chunk_idxs[np.sort(first)]:
+                chunk_key = (key, int(chunk_idx))
+                if chunk_key not in self.chunks:
+                    if not self._make_room(self._chunk_nbytes(key)):
+                        complete = False
+                        break
+                    self.chunks[chunk_key] = self.executor.submit(
+                        self._read_chunk, key, int(chunk_idx))
+                    self.n_bytes += self._chunk_nbytes(key)
+                if pin:
+                    self.pins[chunk_key] += 1
+                chunk_keys.append(chunk_key)
+        return chunk_keys, complete
+
+    def unpin(self, chunk_keys: Sequence[tuple]):
+        with self.lock:
+            for chunk_key in chunk_keys:
+                self.pins[chunk_key] -= 1
+                if self.pins[chunk_key] <= 0:
+                    del self.pins[chunk_key]
+
+    def get_chunk(self, key: str, chunk_idx: int) -> np.ndarray:
+        chunk_key = (key, int(chunk_idx))
+        with self.lock:
+            future = self.chunks.get(chunk_key)
+            if future is not None:
+                self.chunks.move_to_end(chunk_key)
+        if future is None:
+            # not scheduled, or already evicted
+            start = time.monotonic()
+            chunk = self._read_chunk(key, chunk_idx)
+            with self.lock:
+                self.n_misses += 1
+                self.miss_time += time.monotonic() - start
+                if (chunk_key not in self.chunks) \
+                        and self._make_room(self._chunk_nbytes(key)):
+                    future = concurrent.futures.Future()
+                    future.set_result(chunk)
+                    self.chunks[chunk_key] = future
+                    self.n_bytes += self._chunk_nbytes(key)
+            return chunk
+
+        if future.done():
+            chunk = future.result()
+            with self.lock:
+                self.n_hits += 1
+        else:
+            start = time.monotonic()
+            chunk = future.result()
+            with self.lock:
+                self.n_stalls += 1
+                self.stall_time += time.monotonic() - start
+        return chunk
+
+    def get_rows(self, key: str, idxs: np.ndarray) -> np.ndarray:
+        arr = self.arrays[key]
+        chunk_len = arr.chunks[0]
+        idxs = np.asarray(idxs, dtype=np.int64)
+        result = np.empty((len(idxs),) + tuple(arr.shape[1:]), dtype=arr.dtype)
+        chunk_idxs = idxs // chunk_len
+        for chunk_idx in np.unique(chunk_idxs):
+            mask = chunk_idxs == chunk_idx
+            chunk = self.get_chunk(key, chunk_idx)
+            result[mask] = chunk[idxs[mask] - chunk_idx * chunk_len]
+        return result
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                'n_hits': self.n_hits,
+                'n_stalls': self.n_stalls,
+                'stall_time': self.stall_time,
+                'n_misses': self.n_misses,
+                'miss_time': self.miss_time,
+                'n_evictions': self.n_evictions,
+                'n_bytes': self.n_bytes
+            }
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            self.chunks.clear()
+            self.pins.clear()
+            self.n_bytes = 0
+
+
+class PrefetchedArray:
+    """
+    Read-only view of a chunked array served by a ChunkPrefetcher.
+    Supports the indexing used by SequenceSampler, see CachedFrameArray.
+    """
+    def __init__(self, key: str, prefetcher: ChunkPrefetcher):
+        self.key = key
+        self.array = prefetcher.arrays[key]
+        self.prefetcher = prefetcher
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    @property
+    def chunks(self):
+        return self.array.chunks
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, numbers.Integral):
+            idx = range(len(self))[key]
+            return self.prefetcher.get_rows(self.key, np.array([idx]))[0]
+        elif isinstance(key, slice) and (key.step in (None, 1)):
+            start, stop, _ = key.indices(len(self))
+            return self.prefetcher.get_rows(self.key, np.arange(start, stop))
+        return self.array[key]
+
+    def get_orthogonal_selection(self, selection):
+        if isinstance(selection, np.ndarray) and (selection.ndim == 1) \
+                and np.issubdtype(selection.dtype, np.integer):
+            return self.prefetcher.get_rows(self.key, selection)
+        return self.array.get_orthogonal_selection(selection)
+
+
+class ChunkPrefetchLoader(torch.utils.data.IterableDataset):
+    """
+    Yields dataset.get_batch(idxs) for idxs from batch_sampler,
+    with chunks of the next lookahead batches scheduled on the prefetcher.
+    dataset needs a SequenceSampler as dataset.sampler.
+    Runs in a single process, use with DataLoader(num_workers=0, batch_size=None).
+    """
+    def __init__(self, dataset, batch_sampler: Sequence,
+            prefetcher: ChunkPrefetcher, lookahead: int=8):
+        super().__init__()
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.prefetcher = prefetcher
+        self.lookahead = lookahead
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def _schedule(self, idxs) -> tuple:
+        """
+        Returns (pinned chunk keys, whether all chunks are scheduled).
+        """
+        sampler = self.dataset.sampler
+        gather_idx = sampler.get_gather_indices(idxs)
+        chunk_keys = list()
+        complete = True
+        for key in self.prefetcher.arrays.keys():
+            k = sampler.key_first_k.get(key)
+            rows = gather_idx if k is None else gather_idx[:,:k]
+            this_keys, this_complete = self.prefetcher.schedule(key, rows, pin=True)
+            chunk_keys.extend(this_keys)
+            complete = complete and this_complete
+        return chunk_keys, complete
+
+    def __iter__(self):
+        batches = iter(self.batch_sampler)
+        # [idxs, pinned chunk keys, complete]
+        queue = collections.deque()
+        try:
+            while True:
+                # retry batches that did not fit, in order of use
+                for entry in queue:
+                    if not entry[2]:
+                        chunk_keys, entry[2] = self._schedule(entry[0])
+                        self.prefetcher.unpin(entry[1])
+                        entry[1] = chunk_keys
+                        if not entry[2]:
+                            break
+                while len(queue) < self.lookahead:
+                    if (len(queue) > 0) and (not queue[-1][2]):
+                        # buffer full of pinned chunks
+                        break
+                    idxs = next(batches, None)
+                    if idxs is None:
+                        break
+                    queue.append([idxs, *self._schedule(idxs)])
+                if len(queue) == 0:
+                    break
+                idxs, chunk_keys, _ = queue.popleft()
+                batch = self.dataset.get_batch(idxs)
+                self.prefetcher.unpin(chunk_keys)
+                yield batch
+        finally:
+            # iteration stopped early
+            for _, chunk_keys, _ in queue:
+                self.prefetcher.unpin(chunk_keys)
+
+    def get_stats(self) -> dict:
+        return self.prefetcher.get_stats()
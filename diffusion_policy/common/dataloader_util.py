@@ -0,0 +1,178 @@
+from typing import Optional
+import numpy as np
+import torch
+import torch.utils.data
+from torch.utils.data import (
+    DataLoader, BatchSampler, RandomSampler, SequentialSampler)
+from diffusion_policy.common.chunk_prefetcher import ChunkPrefetchLoader
+from diffusion_policy.common import dist_util
+
+
+class BatchSampleDataset(torch.utils.data.Dataset):
+    """
+    Wraps a dataset implementing get_batch(idxs).
+    Indexed by a list of indices (from a BatchSampler),
+    returns a whole collated batch.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idxs):
+        return self.dataset.get_batch(idxs)
+
+
+class ChunkLocalitySampler(torch.utils.data.Sampler):
+    """
+    Shuffle for datasets read from compressed on-disk chunks.
+    Samples are grouped into blocks (e.g. all samples starting in the
+    same zarr chunk), the block order is shuffled, and samples are
+    shuffled within a window of window_size consecutive blocks.
+    Every chunk is then decoded about once per epoch and worker, instead of
+    once per sample, as long as the window fits the worker's frame cache.
+    window_size trades locality (1) for randomness (n_blocks = uniform shuffle).
+    """
+    def __init__(self, block_ids: np.ndarray, window_size: int=8,
+            generator: Optional[torch.Generator]=None):
+        assert window_size >= 1
+        block_ids = np.asarray(block_ids)
+        order = np.argsort(block_ids, kind='stable')
+        _, block_starts = np.unique(block_ids[order], return_index=True)
+        self.order = order
+        self.block_starts = np.append(block_starts, len(order))
+        self.window_size = window_size
+        self.generator = generator
+
+    @property
+    def n_blocks(self):
+        return len(self.block_starts) - 1
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        # seed from torch so that torch.manual_seed controls the order
+        seed = int(torch.empty((), dtype=torch.int64).random_(
+            generator=self.generator).item())
+        rng = np.random.default_rng(seed)
+        block_perm = rng.permutation(self.n_blocks)
+        for i in range(0, self.n_blocks, self.window_size):
+            idxs = np.concatenate([
+                self.order[self.block_starts[b]:self.block_starts[b+1]]
+                for b in block_perm[i:i+self.window_size]])
+            rng.shuffle(idxs)
+            yield from idxs.tolist()
+
+
+class DistributedShardSampler(torch.utils.data.Sampler):
+    """
+    Shards the indices yielded by sampler across distributed ranks:
+    rank r takes every num_replicas-th index starting at r, after
+    padding with the first indices to a multiple of num_replicas,
+    so that every rank runs the same number of batches.
+    sampler has to yield the same order on every rank: its generator
+    is seeded with seed + epoch at the start of each epoch.
+    """
+    def __init__(self, sampler, generator: Optional[torch.Generator]=None,
+            seed: int=0, num_replicas: Optional[int]=None, rank: Optional[int]=None):
+        if num_replicas is None:
+            num_replicas = dist_util.get_world_size()
+        if rank is None:
+            rank = dist_util.get_rank()
+        assert 0 <= rank < num_replicas
+        self.sampler = sampler
+        self.generator = generator
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return -(-len(self.sampler) // self.num_replicas)
+
+    def __iter__(self):
+        if self.generator is not None:
+            self.generator.manual_seed(self.seed + self.epoch)
+        # advance automatically, every rank iterates once per epoch
+        self.epoch += 1
+        idxs = list(self.sampler)
+        n_pad = len(self) * self.num_replicas - len(idxs)
+        idxs = idxs + (idxs * (n_pad // max(len(idxs), 1) + 1))[:n_pad]
+        return iter(idxs[self.rank::self.num_replicas])
+
+
+def create_dataloader(dataset, batch_sample=False,
+        batch_size=1, shuffle=False, drop_last=False,
+        sampler=None, locality_window=None,
+        chunk_prefetch=None, shard=False, seed=0, **kwargs) -> DataLoader:
+    """
+    Drop-in replacement for DataLoader(dataset, **cfg.dataloader).
+    batch_sample: if True, each worker pulls a whole batch
+        with a single dataset.get_batch(idxs) call
+        instead of batch_size __getitem__ calls + collate.
+    locality_window: if set and shuffle, shuffle with a
+        ChunkLocalitySampler over dataset.sampler chunks
+        mixing this many chunks at a time.
+    chunk_prefetch: dict(max_bytes, n_threads, lookahead) to read
+        batches of an on-disk zarr dataset in the main process,
+        decoding the chunks of upcoming batches on a thread pool
+        (see chunk_prefetcher.py). Replaces worker processes.
+    shard: if True and training is distributed (see dist_util.py),
+        each rank loads a disjoint shard of the dataset,
+        shuffled identically on all ranks from seed.
+    """
+    generator = None
+    if shard and (dist_util.get_world_size() > 1):
+        generator = torch.Generator()
+    if shuffle and (locality_window is not None) and (sampler is None):
+        sampler = ChunkLocalitySampler(
+            dataset.sampler.get_sample_block_ids(),
+            window_size=locality_window,
+            generator=generator)
+        shuffle = False
+    if generator is not None:
+        if sampler is None:
+            if shuffle:
+                sampler = RandomSampler(dataset, generator=generator)
+            else:
+                sampler = SequentialSampler(dataset)
+        sampler = DistributedShardSampler(sampler,
+            generator=generator, seed=seed)
+        shuffle = False
+    if (not batch_sample) and (chunk_prefetch is None):
+        return DataLoader(dataset, batch_size=batch_size,
+            shuffle=shuffle, drop_last=drop_last,
+            sampler=sampler, **kwargs)
+
+    if sampler is None:
+        if shuffle:
+            sampler = RandomSampler(dataset)
+        else:
+            sampler = SequentialSampler(dataset)
+    batch_sampler = BatchSampler(sampler,
+        batch_size=batch_size, drop_last=drop_last)
+    if chunk_prefetch is not None:
+        chunk_prefetch = dict(chunk_prefetch)
+        lookahead = chunk_prefetch.pop('lookahead', 8)
+        replay_buffer = dataset.replay_buffer
+        # shared by train and val dataloaders
+        prefetcher = getattr(replay_buffer, 'chunk_prefetcher', None)
+        if prefetcher is None:
+            prefetcher = replay_buffer.set_chunk_prefetcher(
+                keys=dataset.sampler.keys, **chunk_prefetch)
+        if prefetcher is not None:
+            # decoding runs on the prefetcher threads
+            for key in ['num_workers', 'persistent_workers', 'prefetch_factor']:
+                kwargs.pop(key, None)
+            return DataLoader(ChunkPrefetchLoader(dataset, batch_sampler,
+                prefetcher=prefetcher, lookahead=lookahead),
+                batch_size=None, **kwargs)
+    # batch_size=None disables automatic batching,
+    # each element yielded by the sampler is a list of indices
+    return DataLoader(BatchSampleDataset(dataset),
+        batch_size=None, sampler=batch_sampler, **kwargs)
@@ -0,0 +1,122 @@
+"""
+DistributedDataParallel training, one process per rank, launched by torchrun:
+
+    torchrun --nproc_per_node=4 train.py --config-name=... \
+        hydra.run.dir=data/outputs/my_run
+
+Every rank trains on a disjoint shard of the dataset and gradients are
+all-reduced in backward. EMA, checkpointing, logging, validation and
+env rollouts run on rank 0 only, the other ranks wait for it at the
+end of each epoch. Backend is nccl if cuda is available, otherwise gloo
+(CPU-only hosts). Without torchrun (WORLD_SIZE unset) training runs in
+a single process as before.
+"""
+from typing import Any, Optional
+import os
+import datetime
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    if not is_distributed():
+        return 0
+    return dist.get_rank()
+
+
+def get_world_size() -> int:
+    if not is_distributed():
+        return 1
+    return dist.get_world_size()
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def init_distributed(device='cuda:0', backend: Optional[str]=None,
+        timeout_sec: float=7200) -> torch.device:
+    """
+    Joins the process group described by the torchrun env variables
+    (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, MASTER_PORT), if any.
+    timeout_sec: how long ranks wait for each other in collectives,
+        has to cover rank 0 rollouts and checkpointing.
+    returns: device of this rank, cuda:LOCAL_RANK for cuda devices.
+    """
+    device = torch.device(device)
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return device
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if backend is None:
+        # nccl can't reduce cpu tensors
+        backend = 'nccl' if device.type == 'cuda' else 'gloo'
+    if device.type == 'cuda':
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+    if not is_distributed():
+        dist.init_process_group(backend=backend,
+            timeout=datetime.timedelta(seconds=timeout_sec))
+    return device
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj: Any, src: int=0) -> Any:
+    """
+    Returns obj of rank src on all ranks.
+    """
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
+
+
+def all_reduce_mean(tensor: torch.Tensor) -> torch.Tensor:
+    """
+    Mean of tensor over ranks, not differentiable.
+    """
+    if not is_distributed():
+        return tensor
+    tensor = tensor.detach().clone()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor / get_world_size()
+
+
+class ComputeLoss(nn.Module):
+    """
+    model.compute_loss as forward, so that DistributedDataParallel
+    hooks into the backward of the loss.
+    """
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *args, **kwargs):
+        return self.model.compute_loss(*args, **kwargs)
+
+
+def wrap_compute_loss(model: nn.Module, device: torch.device, **kwargs) -> nn.Module:
+    """
+    returns: a module computing model.compute_loss(batch),
+        wrapped in DistributedDataParallel if distributed.
+        Parameters are shared with model.
+    kwargs: passed to DistributedDataParallel
+        (e.g. find_unused_parameters)
+    """
+    module = ComputeLoss(model)
+    if not is_distributed():
+        return module
+    device_ids = None
+    if device.type == 'cuda':
+        device_ids = [device]
+    return DistributedDataParallel(module, device_ids=device_ids, **kwargs)
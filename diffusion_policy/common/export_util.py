@@ -0,0 +1,191 @@
+"""
+Export a trained policy to a self-contained TorchScript or ONNX artifact
+and run it with ExportedPolicy, which mirrors predict_action.
+
+The exported graph contains the obs normalizer, obs encoder, the
+denoising network, the unrolled sampling loop for a fixed
+num_inference_steps and the action unnormalizer.
+Loading it only requires torch (and onnxruntime for ONNX),
+no hydra, robomimic or pickled workspaces.
+
+This module only imports torch, keep it that way.
+"""
+from typing import Dict, Optional, Sequence
+import json
+import inspect
+import torch
+import torch.nn as nn
+
+META_NAME = 'meta.json'
+
+
+class _PolicyExportWrapper(nn.Module):
+    """
+    Positional tensor interface around policy.predict_action for tracing.
+    """
+    def __init__(self, policy, obs_keys: Sequence[str], output_keys: Sequence[str]):
+        super().__init__()
+        self.policy = policy
+        self.obs_keys = list(obs_keys)
+        self.output_keys = list(output_keys)
+
+    def forward(self, *obs):
+        obs_dict = dict(zip(self.obs_keys, obs))
+        result = self.policy.predict_action(obs_dict)
+        return tuple(result[key] for key in self.output_keys)
+
+
+def get_example_obs(policy, shape_meta: Optional[dict]=None,
+        batch_size: int=1) -> Dict[str, torch.Tensor]:
+    """
+    Zero observations with n_obs_steps, from shape_meta (image policies)
+    or policy.obs_dim (lowdim policies).
+    """
+    To = policy.n_obs_steps
+    obs = dict()
+    if shape_meta is not None:
+        for key, attr in shape_meta['obs'].items():
+            shape = tuple(attr['shape'])
+            obs[key] = torch.zeros((batch_size, To) + shape,
+                dtype=policy.dtype, device=policy.device)
+    else:
+        obs['obs'] = torch.zeros((batch_size, To, policy.obs_dim),
+            dtype=policy.dtype, device=policy.device)
+    return obs
+
+
+def export_policy(policy, path: str,
+        example_obs: Dict[str, torch.Tensor],
+        format: str='torchscript',
+        output_keys: Sequence[str]=('action', 'action_pred'),
+        optimize: bool=True,
+        opset_version: int=17):
+    """
+    Trace policy.predict_action on example_obs and save to path.
+    The artifact runs at the batch size of example_obs,
+    ExportedPolicy splits and pads other batch sizes.
+    Policy settings (num_inference_steps, n_action_steps, sampling solver)
+    are baked in, set them before exporting. Diffusion policies should use
+    a deterministic solver (e.g. inference_solver='ddim') for ONNX.
+    """
+    assert format in ('torchscript', 'onnx')
+    policy.eval()
+    obs_keys = list(example_obs.keys())
+    obs = tuple(example_obs[key] for key in obs_keys)
+    wrapper = _PolicyExportWrapper(policy, obs_keys, output_keys).eval()
+    with torch.no_grad():
+        example_result = wrapper(*obs)
+
+    meta = {
+        'format': format,
+        'obs_keys': obs_keys,
+        'obs_shapes': {k: list(v.shape[1:]) for k, v in example_obs.items()},
+        'obs_dtypes': {k: str(v.dtype).replace('torch.', '') for k, v in example_obs.items()},
+        'output_keys': list(output_keys),
+        'output_shapes': {k: list(v.shape[1:])
+            for k, v in zip(output_keys, example_result)},
+        'batch_size': int(obs[0].shape[0]),
+        'n_obs_steps': int(policy.n_obs_steps),
+        'optimize': bool(optimize)
+    }
+
+    if format == 'torchscript':
+        with torch.no_grad():
+            module = torch.jit.trace(wrapper, obs, check_trace=False)
+        if optimize:
+            # optimize_for_inference is applied on load, its folded
+            # (e.g. mkldnn) constants can't be serialized
+            module = torch.jit.freeze(module)
+        torch.jit.save(module, path,
+            _extra_files={META_NAME: json.dumps(meta)})
+    else:
+        kwargs = dict()
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            # newer torch defaults to the dynamo exporter, keep tracing
+            kwargs['dynamo'] = False
+        with torch.no_grad():
+            torch.onnx.export(wrapper, obs, path,
+                input_names=obs_keys,
+                output_names=list(output_keys),
+                opset_version=opset_version,
+                **kwargs)
+        with open(path + '.' + META_NAME, 'w') as f:
+            json.dump(meta, f, indent=2)
+    return meta
+
+
+class ExportedPolicy:
+    """
+    Runs an artifact of export_policy with the predict_action interface.
+    Accepts and returns torch tensors or np.ndarray.
+    """
+    def __init__(self, path: str, device='cpu'):
+        self.path = path
+        self.device = torch.device(device)
+        if path.endswith('.onnx'):
+            # optional dependency
+            import onnxruntime
+            with open(path + '.' + META_NAME, 'r') as f:
+                self.meta = json.load(f)
+            providers = ['CPUExecutionProvider']
+            if self.device.type == 'cuda':
+                providers.insert(0, 'CUDAExecutionProvider')
+            self.session = onnxruntime.InferenceSession(path, providers=providers)
+            self.module = None
+        else:
+            extra_files = {META_NAME: ''}
+            self.module = torch.jit.load(path,
+                map_location=self.device, _extra_files=extra_files)
+            self.meta = json.loads(extra_files[META_NAME])
+            if self.meta.get('optimize', False):
+                self.module = torch.jit.optimize_for_inference(self.module)
+            self.session = None
+        self.n_obs_steps = self.meta['n_obs_steps']
+        self.batch_size = self.meta['batch_size']
+
+    @property
+    def dtype(self):
+        return torch.float32
+
+    def reset(self):
+        pass
+
+    def _run(self, obs: Sequence[torch.Tensor]) -> Sequence[torch.Tensor]:
+        if self.session is not None:
+            feed = {key: x.cpu().numpy()
+                for key, x in zip(self.meta['obs_keys'], obs)}
+            result = self.session.run(self.meta['output_keys'], feed)
+            return [torch.from_numpy(x) for x in result]
+        with torch.no_grad():
+            return self.module(*obs)
+
+    def predict_action(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        is_torch = torch.is_tensor(next(iter(obs_dict.values())))
+        To = self.n_obs_steps
+        obs = list()
+        for key in self.meta['obs_keys']:
+            x = obs_dict[key]
+            if not is_torch:
+                x = torch.from_numpy(x)
+            obs.append(x[:,:To].to(device=self.device,
+                dtype=getattr(torch, self.meta['obs_dtypes'][key])))
+
+        # run in chunks of the exported batch size
+        B = obs[0].shape[0]
+        bs = self.batch_size
+        outputs = list()
+        for start in range(0, B, bs):
+            chunk = [x[start:start+bs] for x in obs]
+            n = chunk[0].shape[0]
+            if n < bs:
+                chunk = [torch.cat([x, x[-1:].expand(bs - n, *x.shape[1:])])
+                    for x in chunk]
+            outputs.append([y[:n] for y in self._run(chunk)])
+
+        result = dict()
+        for i, key in enumerate(self.meta['output_keys']):
+            value = torch.cat([out[i] for out in outputs], dim=0)
+            if not is_torch:
+                value = value.detach().cpu().numpy()
+            result[key] = value
+        return result
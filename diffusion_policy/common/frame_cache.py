@@ -0,0 +1,220 @@
+from typing import Optional
+import mmap
+import numbers
+import collections
+import multiprocessing
+import numpy as np
+
+
+class FrameCache:
+    """
+    Process-local, size-aware LRU cache of decoded frames.
+    Keyed by frame index.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = int(max_bytes)
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._frames = collections.OrderedDict()
+
+    def get(self, idx: int) -> Optional[np.ndarray]:
+        frame = self._frames.get(idx)
+        if frame is None:
+            self.misses += 1
+            return None
+        self._frames.move_to_end(idx)
+        self.hits += 1
+        return frame
+
+    def put(self, idx: int, frame: np.ndarray):
+        if (idx in self._frames) or (frame.nbytes > self.max_bytes):
+            return
+        while self.n_bytes + frame.nbytes > self.max_bytes:
+            _, evicted = self._frames.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+            self.evictions += 1
+        # copy to avoid holding a view into a larger array
+        self._frames[idx] = np.array(frame)
+        self.n_bytes += frame.nbytes
+
+    def get_stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'n_bytes': self.n_bytes
+        }
+
+
+class SharedFrameCache:
+    """
+    Set-associative decoded-frame cache with per-set LRU eviction,
+    stored in anonymous shared memory.
+    Created before the DataLoader forks its workers,
+    all workers then read and fill the same cache.
+    Requires the 'fork' multiprocessing start method.
+    """
+    def __init__(self, max_bytes: int, frame_shape: tuple, dtype,
+            n_ways: int=4, n_locks: int=64):
+        dtype = np.dtype(dtype)
+        frame_bytes = int(np.prod(frame_shape)) * dtype.itemsize
+        n_sets = max(int(max_bytes) // (frame_bytes * n_ways), 1)
+        n_slots = n_sets * n_ways
+
+        # layout: frames | tags | last_used | stats
+        frames_bytes = n_slots * frame_bytes
+        tags_bytes = n_slots * 8
+        size = frames_bytes + 2 * tags_bytes + 3 * 8
+        buf = mmap.mmap(-1, size)
+
+        offset = 0
+        self.frames = np.frombuffer(buf, dtype=dtype,
+            count=n_slots * int(np.prod(frame_shape)), offset=offset
+            ).reshape((n_slots,) + tuple(frame_shape))
+        offset += frames_bytes
+        self.tags = np.frombuffer(buf, dtype=np.int64,
+            count=n_slots, offset=offset)
+        offset += tags_bytes
+        self.last_used = np.frombuffer(buf, dtype=np.int64,
+            count=n_slots, offset=offset)
+        offset += tags_bytes
+        # hits, misses, evictions
+        self.stats = np.frombuffer(buf, dtype=np.int64,
+            count=3, offset=offset)
+        self.tags[:] = -1
+        self.last_used[:] = 0
+        self.stats[:] = 0
+
+        self.buf = buf
+        self.n_sets = n_sets
+        self.n_ways = n_ways
+        self.max_bytes = frames_bytes
+        self.locks = [multiprocessing.Lock() for _ in range(n_locks)]
+        self.stats_lock = multiprocessing.Lock()
+
+    def _get_set(self, idx: int):
+        set_idx = idx % self.n_sets
+        start = set_idx * self.n_ways
+        lock = self.locks[set_idx % len(self.locks)]
+        return slice(start, start + self.n_ways), lock
+
+    def _touch(self, ways: slice, slot: int):
+        # per-set logical clock, consistent across processes
+        self.last_used[slot] = self.last_used[ways].max() + 1
+
+    def get(self, idx: int) -> Optional[np.ndarray]:
+        ways, lock = self._get_set(idx)
+        frame = None
+        with lock:
+            match = np.nonzero(self.tags[ways] == idx)[0]
+            if len(match) > 0:
+                slot = ways.start + match[0]
+                frame = self.frames[slot].copy()
+                self._touch(ways, slot)
+        with self.stats_lock:
+            self.stats[0 if frame is not None else 1] += 1
+        return frame
+
+    def put(self, idx: int, frame: np.ndarray):
+        ways, lock = self._get_set(idx)
+        evicted = False
+        with lock:
+            tags = self.tags[ways]
+            if np.any(tags == idx):
+                return
+            empty = np.nonzero(tags < 0)[0]
+            if len(empty) > 0:
+                slot = ways.start + empty[0]
+            else:
+                slot = ways.start + np.argmin(self.last_used[ways])
+                evicted = True
+            self.frames[slot] = frame
+            self.tags[slot] = idx
+            self._touch(ways, slot)
+        if evicted:
+            with self.stats_lock:
+                self.stats[2] += 1
+
+    def get_stats(self) -> dict:
+        return {
+            'hits': int(self.stats[0]),
+            'misses': int(self.stats[1]),
+            'evictions': int(self.stats[2]),
+            'n_bytes': int(np.sum(self.tags >= 0)) * self.frames[0].nbytes
+        }
+
+
+class CachedFrameArray:
+    """
+    Read-only view of a (zarr) array with one frame per row,
+    serving rows from a decoded-frame cache.
+    Supports the indexing used by SequenceSampler:
+    integers, contiguous slices and get_orthogonal_selection
+    with a 1D integer array. Everything else bypasses the cache.
+    """
+    def __init__(self, array, cache):
+        self.array = array
+        self.cache = cache
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    @property
+    def chunks(self):
+        return self.array.chunks
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _get_rows(self, idxs: np.ndarray) -> np.ndarray:
+        result = np.empty((len(idxs),) + self.shape[1:], dtype=self.dtype)
+        miss = list()
+        for i, idx in enumerate(idxs):
+            frame = self.cache.get(int(idx))
+            if frame is None:
+                miss.append(i)
+            else:
+                result[i] = frame
+        if len(miss) > 0:
+            miss_idxs = idxs[miss]
+            if isinstance(self.array, np.ndarray):
+                frames = self.array[miss_idxs]
+            else:
+                frames = self.array.get_orthogonal_selection(miss_idxs)
+            result[miss] = frames
+            for idx, frame in zip(miss_idxs, frames):
+                self.cache.put(int(idx), frame)
+        return result
+
+    def __getitem__(self, key):
+        if isinstance(key, numbers.Integral):
+            idx = range(len(self))[key]
+            return self._get_rows(np.array([idx], dtype=np.int64))[0]
+        elif isinstance(key, slice) and (key.step in (None, 1)):
+            start, stop, _ = key.indices(len(self))
+            return self._get_rows(np.arange(start, stop, dtype=np.int64))
+        return self.array[key]
+
+    def get_orthogonal_selection(self, selection):
+        if isinstance(selection, np.ndarray) and (selection.ndim == 1) \
+                and np.issubdtype(selection.dtype, np.integer):
+            return self._get_rows(selection)
+        return self.array.get_orthogonal_selection(selection)
+
+
+def create_frame_cache(max_bytes: int, frame_shape: tuple, dtype, shared=False):
+    if shared:
+        return SharedFrameCache(max_bytes=max_bytes,
+            frame_shape=frame_shape, dtype=dtype)
+    return FrameCache(max_bytes=max_bytes)
@@ -0,0 +1,118 @@
+"""
+Flat, uncompressed on-disk layout for ReplayBuffer, opened with np.memmap.
+
+<path>/
+    header.json             {"version": 1, "arrays": {"data/obs": {"dtype": "<f4", "shape": [N, D]}, ...}}
+    data/<key>.bin          raw C-order bytes
+    meta/episode_ends.bin
+
+Arrays are opened as np.memmap (a np.ndarray subclass), so a memmap
+ReplayBuffer is a numpy-backend ReplayBuffer whose pages live in the
+OS page cache and are shared between all forked DataLoader workers.
+"""
+from typing import Optional, Sequence
+import os
+import json
+import pathlib
+import shutil
+import numpy as np
+
+HEADER_NAME = 'header.json'
+FORMAT_VERSION = 1
+
+
+def is_memmap_path(path) -> bool:
+    path = pathlib.Path(os.path.expanduser(str(path)))
+    return path.joinpath(HEADER_NAME).is_file()
+
+
+def _iter_row_slices(arr, max_bytes=2**27):
+    """
+    Yield slices along the first dim, aligned to zarr chunks if possible,
+    so that copying a compressed array never decodes it fully into RAM.
+    """
+    n = arr.shape[0]
+    if n == 0:
+        return
+    row_bytes = max(np.dtype(arr.dtype).itemsize
+        * int(np.prod(arr.shape[1:])), 1)
+    step = max(max_bytes // row_bytes, 1)
+    chunks = getattr(arr, 'chunks', None)
+    if chunks is not None:
+        step = max(step // chunks[0], 1) * chunks[0]
+    for start in range(0, n, step):
+        yield slice(start, min(start + step, n))
+
+
+def save_memmap(path, root: dict, if_exists='replace'):
+    """
+    root: {'data': {key: array}, 'meta': {key: array}}
+    arrays can be np.ndarray or zarr.Array
+    """
+    path = pathlib.Path(os.path.expanduser(str(path)))
+    if path.exists():
+        if if_exists == 'replace':
+            shutil.rmtree(path)
+        else:
+            raise FileExistsError(str(path))
+    header = {
+        'version': FORMAT_VERSION,
+        'arrays': dict()
+    }
+    for group in ['data', 'meta']:
+        path.joinpath(group).mkdir(parents=True, exist_ok=True)
+        for key, value in root[group].items():
+            name = group + '/' + key
+            shape = tuple(value.shape)
+            dtype = np.dtype(value.dtype)
+            file_path = path.joinpath(name + '.bin')
+            if len(shape) == 0 or np.prod(shape) == 0:
+                np.asarray(value[...], dtype=dtype).tofile(file_path)
+            else:
+                out = np.memmap(file_path, dtype=dtype, mode='w+', shape=shape)
+                for s in _iter_row_slices(value):
+                    out[s] = value[s]
+                out.flush()
+                del out
+            header['arrays'][name] = {
+                'dtype': dtype.str,
+                'shape': list(shape)
+            }
+    # header is written last, a directory without header is incomplete
+    tmp_path = path.joinpath(HEADER_NAME + '.tmp')
+    with tmp_path.open('w') as f:
+        json.dump(header, f, indent=2)
+    os.replace(tmp_path, path.joinpath(HEADER_NAME))
+    return path
+
+
+def load_memmap(path, mode='r', keys: Optional[Sequence[str]]=None) -> dict:
+    """
+    Returns a numpy-backend ReplayBuffer root.
+    data arrays are np.memmap in mode ('r', 'r+' or 'c' for copy-on-write).
+    meta arrays are small and loaded to memory.
+    """
+    path = pathlib.Path(os.path.expanduser(str(path)))
+    with path.joinpath(HEADER_NAME).open('r') as f:
+        header = json.load(f)
+    if header['version'] != FORMAT_VERSION:
+        raise RuntimeError(f"Unsupported memmap format version {header['version']}")
+
+    root = {
+        'data': dict(),
+        'meta': dict()
+    }
+    for name, attr in header['arrays'].items():
+        group, key = name.split('/', 1)
+        if (group == 'data') and (keys is not None) and (key not in keys):
+            continue
+        shape = tuple(attr['shape'])
+        dtype = np.dtype(attr['dtype'])
+        file_path = path.joinpath(name + '.bin')
+        if (group == 'meta') or len(shape) == 0 or np.prod(shape) == 0:
+            # np.memmap can't map empty files
+            arr = np.fromfile(file_path, dtype=dtype).reshape(shape)
+        else:
+            arr = np.memmap(file_path, dtype=dtype, mode=mode, shape=shape)
+        root[group][key] = arr
+    return root
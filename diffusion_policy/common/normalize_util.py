@@ -1,5 +1,7 @@
+from typing import Optional
 from diffusion_policy.model.common.normalizer import SingleFieldLinearNormalizer
 from diffusion_policy.common.pytorch_util import dict_apply, dict_apply_reduce, dict_apply_split
+from diffusion_policy.common.stats_util import get_array_stats
 import numpy as np
 
 
@@ -213,11 +215,15 @@ def robomimic_abs_action_only_dual_arm_normalizer_from_stat(stat):
     )
 
 
-def array_to_stats(arr: np.ndarray):
-    stat = {
-        'min': np.min(arr, axis=0),
-        'max': np.max(arr, axis=0),
-        'mean': np.mean(arr, axis=0),
-        'std': np.std(arr, axis=0)
-    }
+def array_to_stats(arr: np.ndarray, cache_path: Optional[str]=None,
+        cache_key: Optional[str]=None):
+    """
+    Statistics along the first dim, computed in chunks without
+    loading arr (np.ndarray, np.memmap or zarr.Array) into memory.
+    cache_path: json file to persist stats, see get_array_stats.
+    """
+    stat = get_array_stats(arr, cache_path=cache_path, cache_key=cache_key,
+        last_n_dims=len(arr.shape)-1)
+    dtype = arr.dtype if np.issubdtype(arr.dtype, np.floating) else np.float64
+    stat = dict_apply(stat, lambda x: x.astype(dtype).reshape(arr.shape[1:]))
     return stat
@@ -15,6 +15,17 @@ def dict_apply(
             result[key] = func(value)
     return result
 
+def uint8_images_to_float(x: torch.Tensor) -> torch.Tensor:
+    """
+    Converts uint8 images in [0,255] to float32 in [0,1],
+    the range of get_image_range_normalizer. Other tensors are unchanged.
+    Call after moving the batch to device, so that the
+    DataLoader only transfers uint8 data.
+    """
+    if x.dtype == torch.uint8:
+        return x.to(dtype=torch.float32) / 255.
+    return x
+
 def pad_remaining_dims(x, target):
     assert x.shape == target.shape[:len(x.shape)]
     return x.reshape(x.shape + (1,)*(len(target.shape) - len(x.shape)))
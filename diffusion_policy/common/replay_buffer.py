@@ -1,4 +1,4 @@
-from typing import Union, Dict, Optional
+from typing import Union, Dict, Optional, Sequence
 import os
 import math
 import numbers
@@ -6,6 +6,12 @@ import zarr
 import numcodecs
 import numpy as np
 from functools import cached_property
+from diffusion_policy.common.memmap_util import (
+    is_memmap_path, save_memmap, load_memmap)
+from diffusion_policy.common.frame_cache import (
+    CachedFrameArray, create_frame_cache)
+from diffusion_policy.common.chunk_prefetcher import (
+    ChunkPrefetcher, PrefetchedArray)
 
 def check_chunks_compatible(chunks: tuple, shape: tuple):
     assert len(shape) == len(chunks)
@@ -98,6 +104,11 @@ class ReplayBuffer:
         for key, value in root['data'].items():
             assert(value.shape[0] == root['meta']['episode_ends'][-1])
         self.root = root
+        # key: CachedFrameArray, see set_frame_cache
+        self.cached_arrays = dict()
+        # (group_name, key): over-allocated numpy buffer, see _reserve_numpy
+        self._capacity_buffers = dict()
+        self.chunk_prefetcher = None
     
     # ============= create constructors ===============
     @classmethod
@@ -137,10 +148,22 @@ class ReplayBuffer:
     def create_from_path(cls, zarr_path, mode='r', **kwargs):
         """
         Open a on-disk zarr directly (for dataset larger than memory).
-        Slower.
+        Slower, train with dataloader locality_window
+        (dataloader_util.ChunkLocalitySampler) to decode each chunk less often.
         """
         group = zarr.open(os.path.expanduser(zarr_path), mode)
         return cls.create_from_group(group, **kwargs)
+
+    @classmethod
+    def create_from_memmap(cls, memmap_path, mode='r', keys=None):
+        """
+        Open a flat uncompressed memmap directory (see save_to_memmap).
+        Zero-copy: pages are shared through the OS page cache 
+        between processes, including forked DataLoader workers.
+        mode='c' is copy-on-write, writes are private to the process.
+        """
+        root = load_memmap(memmap_path, mode=mode, keys=keys)
+        return cls(root=root)
     
     # ============= copy constructors ===============
     @classmethod
@@ -214,7 +237,11 @@ class ReplayBuffer:
         """
         Copy a on-disk zarr to in-memory compressed.
         Recommended
+        If zarr_path is a memmap directory, it is opened 
+        copy-on-write instead (no copy).
         """
+        if is_memmap_path(zarr_path):
+            return cls.create_from_memmap(zarr_path, mode='c', keys=keys)
         if backend == 'numpy':
             print('backend argument is deprecated!')
             store = None
@@ -285,6 +312,16 @@ class ReplayBuffer:
         return self.save_to_store(store, chunks=chunks, 
             compressors=compressors, if_exists=if_exists, **kwargs)
 
+    def save_to_memmap(self, memmap_path, if_exists='replace'):
+        """
+        Save as flat uncompressed files with a json header.
+        Compressed zarr arrays are decoded chunk by chunk.
+        """
+        return save_memmap(memmap_path, root={
+            'data': self.data,
+            'meta': self.meta
+        }, if_exists=if_exists)
+
     @staticmethod
     def resolve_compressor(compressor='default'):
         if compressor == 'default':
@@ -395,6 +432,12 @@ class ReplayBuffer:
         return backend
     
     # =========== dict-like API ==============
+    def __getstate__(self):
+        # views are pickled without the spare capacity
+        state = self.__dict__.copy()
+        state['_capacity_buffers'] = dict()
+        return state
+
     def __repr__(self) -> str:
         if self.backend == 'zarr':
             return str(self.root.tree())
@@ -411,6 +454,8 @@ class ReplayBuffer:
         return self.data.items()
     
     def __getitem__(self, key):
+        if key in self.cached_arrays:
+            return self.cached_arrays[key]
         return self.data[key]
 
     def __contains__(self, key):
@@ -444,18 +489,72 @@ class ReplayBuffer:
             data: Dict[str, np.ndarray], 
             chunks: Optional[Dict[str,tuple]]=dict(),
             compressors: Union[str, numcodecs.abc.Codec, dict]=dict()):
-        assert(len(data) > 0)
+        self.add_episodes([data], chunks=chunks, compressors=compressors)
+
+    def add_episodes(self,
+            episodes: Sequence[Dict[str, np.ndarray]],
+            chunks: Optional[Dict[str,tuple]]=dict(),
+            compressors: Union[str, numcodecs.abc.Codec, dict]=dict()):
+        """
+        Append multiple episodes with a single resize and write per key.
+        The numpy backend over-allocates geometrically (see _reserve_numpy),
+        so building a buffer episode by episode takes linear time.
+        """
+        assert(len(episodes) > 0)
+        keys = list(episodes[0].keys())
+        assert(len(keys) > 0)
+        episode_lengths = list()
+        for episode in episodes:
+            assert(set(episode.keys()) == set(keys))
+            episode_length = None
+            for key, value in episode.items():
+                assert(len(value.shape) >= 1)
+                if episode_length is None:
+                    episode_length = len(value)
+                else:
+                    assert(episode_length == len(value))
+            episode_lengths.append(episode_length)
+        if len(episodes) == 1:
+            data = episodes[0]
+        else:
+            data = {key: np.concatenate([e[key] for e in episodes], axis=0)
+                for key in keys}
+        self._append(data, episode_lengths,
+            chunks=chunks, compressors=compressors)
+
+    def _reserve_numpy(self, group_name: str, key: str,
+            new_len: int, shape: tuple, dtype):
+        """
+        Set root[group_name][key] to a length new_len view of a buffer
+        with capacity >= new_len, growing the buffer by 1.5x when full.
+        Existing rows are preserved.
+        """
+        group = self.root[group_name]
+        arr = group.get(key)
+        base = self._capacity_buffers.get((group_name, key))
+        if (base is None) or (arr is None) or (arr.base is not base):
+            # not allocated by us (e.g. loaded from disk)
+            base = arr
+        if (base is None) or (base.shape[0] < new_len):
+            capacity = new_len
+            if base is not None:
+                capacity = max(new_len, int(base.shape[0] * 1.5))
+            new_base = np.zeros((capacity,) + tuple(shape), dtype=dtype)
+            if arr is not None:
+                new_base[:len(arr)] = arr
+            base = new_base
+            self._capacity_buffers[(group_name, key)] = base
+        group[key] = base[:new_len]
+        return group[key]
+
+    def _append(self, data: Dict[str, np.ndarray], episode_lengths,
+            chunks: Optional[Dict[str,tuple]]=dict(),
+            compressors: Union[str, numcodecs.abc.Codec, dict]=dict()):
         is_zarr = (self.backend == 'zarr')
 
         curr_len = self.n_steps
-        episode_length = None
-        for key, value in data.items():
-            assert(len(value.shape) >= 1)
-            if episode_length is None:
-                episode_length = len(value)
-            else:
-                assert(episode_length == len(value))
-        new_len = curr_len + episode_length
+        n_new = int(np.sum(episode_lengths))
+        new_len = curr_len + n_new
 
         for key, value in data.items():
             new_shape = (new_len,) + value.shape[1:]
@@ -473,26 +572,38 @@ class ReplayBuffer:
                         compressor=cpr)
                 else:
                     # copy data to prevent modify
-                    arr = np.zeros(shape=new_shape, dtype=value.dtype)
-                    self.data[key] = arr
+                    arr = self._reserve_numpy('data', key,
+                        new_len, value.shape[1:], value.dtype)
             else:
                 arr = self.data[key]
                 assert(value.shape[1:] == arr.shape[1:])
-                # same method for both zarr and numpy
                 if is_zarr:
+                    # metadata only
                     arr.resize(new_shape)
                 else:
-                    arr.resize(new_shape, refcheck=False)
+                    arr = self._reserve_numpy('data', key,
+                        new_len, arr.shape[1:], arr.dtype)
             # copy data
-            arr[-value.shape[0]:] = value
+            if n_new > 0:
+                arr[curr_len:new_len] = value
         
         # append to episode ends
-        episode_ends = self.episode_ends
+        n_episodes = len(self.episode_ends)
+        new_ends = curr_len + np.cumsum(episode_lengths)
         if is_zarr:
-            episode_ends.resize(episode_ends.shape[0] + 1)
+            # write the new ends past the current shape first,
+            # the metadata-only resize then commits them atomically
+            episode_ends = self.episode_ends
+            new_n_episodes = n_episodes + len(episode_lengths)
+            staging = zarr.Array(episode_ends.store, path=episode_ends.path,
+                chunk_store=episode_ends.chunk_store)
+            staging._shape = (new_n_episodes,)
+            staging[n_episodes:] = new_ends
+            episode_ends.resize(new_n_episodes)
         else:
-            episode_ends.resize(episode_ends.shape[0] + 1, refcheck=False)
-        episode_ends[-1] = new_len
+            episode_ends = self._reserve_numpy('meta', 'episode_ends',
+                n_episodes + len(episode_lengths), (), self.episode_ends.dtype)
+            episode_ends[n_episodes:] = new_ends
 
         # rechunk
         if is_zarr:
@@ -512,11 +623,22 @@ class ReplayBuffer:
             if is_zarr:
                 value.resize(new_shape)
             else:
-                value.resize(new_shape, refcheck=False)
+                # keep capacity
+                self.data[key] = value[:start_idx]
         if is_zarr:
             self.episode_ends.resize(len(episode_ends)-1)
         else:
-            self.episode_ends.resize(len(episode_ends)-1, refcheck=False)
+            self.meta['episode_ends'] = self.episode_ends[:len(episode_ends)-1]
+
+    def shrink_to_fit(self):
+        """
+        Release over-allocated capacity of the numpy backend.
+        Saving never includes it.
+        """
+        for group_name, key in self._capacity_buffers.keys():
+            group = self.root[group_name]
+            group[key] = group[key].copy()
+        self._capacity_buffers = dict()
     
     def pop_episode(self):
         assert(self.n_episodes > 0)
@@ -554,6 +676,61 @@ class ReplayBuffer:
             result[key] = x
         return result
     
+    # =========== decoded frame cache =============
+    def set_frame_cache(self, keys, max_bytes: int, shared=False):
+        """
+        Serve reads of keys (e.g. Jpeg2k image arrays) through a 
+        decoded-frame cache. max_bytes is split evenly across keys.
+        shared: place the cache in shared memory, call before
+            the DataLoader forks its workers.
+        """
+        keys = list(keys)
+        self.cached_arrays = dict()
+        if (max_bytes is None) or (max_bytes <= 0) or (len(keys) == 0):
+            return
+        for key in keys:
+            arr = self.data[key]
+            cache = create_frame_cache(
+                max_bytes=max_bytes // len(keys),
+                frame_shape=arr.shape[1:],
+                dtype=arr.dtype,
+                shared=shared)
+            self.cached_arrays[key] = CachedFrameArray(arr, cache)
+
+    def set_chunk_prefetcher(self, keys=None, max_bytes: int=2**30,
+            n_threads: int=8) -> Optional[ChunkPrefetcher]:
+        """
+        Serve reads of chunked (zarr) arrays in keys through a
+        ChunkPrefetcher, replacing any frame cache on these keys.
+        Schedule reads with the returned prefetcher (see ChunkPrefetchLoader).
+        Process-local, don't use in forked DataLoader workers.
+        """
+        if keys is None:
+            keys = self.keys()
+        arrays = dict()
+        for key in keys:
+            arr = self.data[key]
+            if isinstance(arr, zarr.Array):
+                arrays[key] = arr
+        if len(arrays) == 0:
+            return None
+        prefetcher = ChunkPrefetcher(arrays,
+            max_bytes=max_bytes, n_threads=n_threads)
+        for key in arrays.keys():
+            self.cached_arrays[key] = PrefetchedArray(key, prefetcher)
+        self.chunk_prefetcher = prefetcher
+        return prefetcher
+
+    def get_frame_cache_stats(self) -> dict:
+        """
+        Per-key hits, misses, evictions and n_bytes.
+        Process-local unless the cache is shared.
+        """
+        stats = dict()
+        for key, value in self.cached_arrays.items():
+            stats[key] = value.cache.get_stats()
+        return stats
+
     # =========== chunking =============
     def get_chunks(self) -> dict:
         assert self.backend == 'zarr'
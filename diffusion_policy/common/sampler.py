@@ -47,6 +47,78 @@ def create_indices(
     return indices
 
 
+class LazySequenceIndex:
+    """
+    Drop-in replacement for the (n_samples, 4) array of create_indices.
+    Only stores per-episode window counts, rows
+    (buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx)
+    are computed on access for an int, an int array or (idxs, column).
+    """
+    def __init__(self,
+            episode_ends: np.ndarray, sequence_length: int,
+            episode_mask: np.ndarray,
+            pad_before: int=0, pad_after: int=0):
+        assert episode_mask.shape == episode_ends.shape
+        pad_before = min(max(pad_before, 0), sequence_length-1)
+        pad_after = min(max(pad_after, 0), sequence_length-1)
+        episode_ends = np.asarray(episode_ends, dtype=np.int64)
+        episode_starts = np.zeros_like(episode_ends)
+        episode_starts[1:] = episode_ends[:-1]
+        episode_starts = episode_starts[episode_mask]
+        episode_lengths = episode_ends[episode_mask] - episode_starts
+        n_windows = np.maximum(
+            episode_lengths - sequence_length + pad_before + pad_after + 1, 0)
+
+        self.episode_starts = episode_starts
+        self.episode_lengths = episode_lengths
+        # cumulative window counts, exclusive
+        self.window_starts = np.zeros(len(n_windows) + 1, dtype=np.int64)
+        self.window_starts[1:] = np.cumsum(n_windows)
+        self.sequence_length = sequence_length
+        self.pad_before = pad_before
+
+    def __len__(self):
+        return int(self.window_starts[-1])
+
+    @property
+    def shape(self):
+        return (len(self), 4)
+
+    def _compute(self, idxs: np.ndarray) -> np.ndarray:
+        n = len(self)
+        if np.any((idxs >= n) | (idxs < -n)):
+            raise IndexError(f'index out of range for {n} samples')
+        idxs = np.where(idxs < 0, idxs + n, idxs)
+        episode_idx = np.searchsorted(self.window_starts, idxs, side='right') - 1
+        start_idx = self.episode_starts[episode_idx]
+        episode_length = self.episode_lengths[episode_idx]
+        idx = idxs - self.window_starts[episode_idx] - self.pad_before
+        L = self.sequence_length
+
+        buffer_start_idx = np.maximum(idx, 0) + start_idx
+        buffer_end_idx = np.minimum(idx+L, episode_length) + start_idx
+        sample_start_idx = buffer_start_idx - (idx+start_idx)
+        sample_end_idx = L - ((idx+L+start_idx) - buffer_end_idx)
+        return np.stack([
+            buffer_start_idx, buffer_end_idx,
+            sample_start_idx, sample_end_idx], axis=-1)
+
+    def __getitem__(self, key):
+        col = slice(None)
+        if isinstance(key, tuple):
+            key, col = key
+        if isinstance(key, slice):
+            key = np.arange(*key.indices(len(self)))
+        result = self._compute(np.asarray(key, dtype=np.int64))
+        return result[..., col]
+
+    def __array__(self, dtype=None):
+        result = self[np.arange(len(self))]
+        if dtype is not None:
+            result = result.astype(dtype)
+        return result
+
+
 def get_val_mask(n_episodes, val_ratio, seed=0):
     val_mask = np.zeros(n_episodes, dtype=bool)
     if val_ratio <= 0:
@@ -74,6 +146,20 @@ def downsample_mask(mask, max_n, seed=0):
         assert np.sum(train_mask) == n_train
     return train_mask
 
+
+def gather_rows(input_arr, idxs: np.ndarray) -> np.ndarray:
+    """
+    Gather rows idxs (1D int array) along the first (time) dimension.
+    For zarr arrays, each unique row is read (and each chunk decoded) once.
+    """
+    if isinstance(input_arr, np.ndarray):
+        return input_arr[idxs]
+    if len(idxs) == 0:
+        return np.zeros((0,) + input_arr.shape[1:], dtype=input_arr.dtype)
+    unique_idxs, inverse = np.unique(idxs, return_inverse=True)
+    rows = input_arr.get_orthogonal_selection(unique_idxs)
+    return rows[inverse.reshape(-1)]
+
 class SequenceSampler:
     def __init__(self, 
         replay_buffer: ReplayBuffer, 
@@ -83,10 +169,13 @@ class SequenceSampler:
         keys=None,
         key_first_k=dict(),
         episode_mask: Optional[np.ndarray]=None,
+        lazy_index: bool=False
         ):
         """
         key_first_k: dict str: int
             Only take first k data from these keys (to improve perf)
+        lazy_index: use LazySequenceIndex instead of materializing
+            all sample indices, O(n_episodes) memory for large datasets
         """
 
         super().__init__()
@@ -98,7 +187,14 @@ class SequenceSampler:
         if episode_mask is None:
             episode_mask = np.ones(episode_ends.shape, dtype=bool)
 
-        if np.any(episode_mask):
+        if lazy_index:
+            indices = LazySequenceIndex(episode_ends,
+                sequence_length=sequence_length,
+                pad_before=pad_before,
+                pad_after=pad_after,
+                episode_mask=episode_mask
+                )
+        elif np.any(episode_mask):
             indices = create_indices(episode_ends, 
                 sequence_length=sequence_length, 
                 pad_before=pad_before, 
@@ -151,3 +247,80 @@ class SequenceSampler:
                 data[sample_start_idx:sample_end_idx] = sample
             result[key] = data
         return result
+
+    def get_sample_block_ids(self, group_by: str='chunk') -> np.ndarray:
+        """
+        Block id of every sample, for locality-aware shuffling
+        (see dataloader_util.ChunkLocalitySampler).
+        group_by='chunk': zarr chunk (along time) containing the first frame,
+            for the compressed key with the largest rows and
+            multi-frame chunks (usually images).
+        group_by='episode': episode containing the first frame,
+            also used for non-zarr replay buffers and when every
+            compressed key has one frame per chunk (e.g. Jpeg2k images).
+        """
+        assert group_by in ('chunk', 'episode')
+        buffer_start_idx = self.indices[np.arange(len(self)), 0]
+
+        chunk_len = None
+        if group_by == 'chunk':
+            max_row_bytes = -1
+            for key in self.keys:
+                arr = self.replay_buffer[key]
+                chunks = getattr(arr, 'chunks', None)
+                if (chunks is None) or (chunks[0] <= 1) \
+                        or (getattr(arr, 'compressor', None) is None):
+                    # per-frame blocks have no locality
+                    continue
+                row_bytes = np.dtype(arr.dtype).itemsize * int(np.prod(arr.shape[1:]))
+                if row_bytes > max_row_bytes:
+                    max_row_bytes = row_bytes
+                    chunk_len = chunks[0]
+        if chunk_len is not None:
+            return buffer_start_idx // chunk_len
+        episode_ends = self.replay_buffer.episode_ends[:]
+        return np.searchsorted(episode_ends, buffer_start_idx, side='right')
+
+    def get_gather_indices(self, idxs) -> np.ndarray:
+        """
+        Returns (B, sequence_length) int64 buffer indices for samples idxs.
+        Padding is expressed by repeating the first/last valid index.
+        """
+        indices = self.indices[np.asarray(idxs, dtype=np.int64)]
+        buffer_start_idx = indices[:,0:1]
+        buffer_end_idx = indices[:,1:2]
+        sample_start_idx = indices[:,2:3]
+        t = np.arange(self.sequence_length, dtype=np.int64)[None,:]
+        gather_idx = np.clip(buffer_start_idx - sample_start_idx + t,
+            buffer_start_idx, buffer_end_idx - 1)
+        return gather_idx
+
+    def sample_batch(self, idxs):
+        """
+        Vectorized equivalent of stacking sample_sequence(i) for i in idxs.
+        Returns dict str: (B, sequence_length, *) arrays.
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        gather_idx = self.get_gather_indices(idxs)
+        buffer_start_idx = self.indices[idxs,0]
+        result = dict()
+        for key in self.keys:
+            input_arr = self.replay_buffer[key]
+            out_shape = gather_idx.shape + input_arr.shape[1:]
+            if key not in self.key_first_k:
+                data = gather_rows(input_arr, gather_idx.reshape(-1))
+                data = data.reshape(out_shape)
+            else:
+                # performance optimization, only load used obs steps
+                is_loaded = (gather_idx - buffer_start_idx[:,None]) \
+                    < self.key_first_k[key]
+                # fill value with Nan to catch bugs
+                # the non-loaded region should never be used
+                fill_value = 0
+                if np.issubdtype(input_arr.dtype, np.floating):
+                    fill_value = np.nan
+                data = np.full(out_shape, 
+                    fill_value=fill_value, dtype=input_arr.dtype)
+                data[is_loaded] = gather_rows(input_arr, gather_idx[is_loaded])
+            result[key] = data
+        return result
@@ -0,0 +1,295 @@
+"""
+Sharded checkpoint format, one safetensors-style file per state dict.
+
+<name>.ckpt/
+    manifest.json                   {"version": 1, "state_dicts": {...}, "pickles": {...}}
+    cfg.pkl
+    shards/<key>.safetensors        8 byte header size, json header, raw tensor bytes
+    shards/<key>.skeleton.pkl       state dict structure with tensors replaced by names
+    pickles/<key>.pkl
+
+Tensors are memory mapped on load and state dicts are only read
+when accessed, so loading a single state dict (e.g. ema_model)
+doesn't read the optimizer state.
+With a shard_store, identical shards are hard-linked to one
+content-addressed file (<shard_store>/<sha256>.safetensors) instead
+of being written multiple times.
+"""
+import os
+import json
+import mmap
+import struct
+import shutil
+import hashlib
+import pathlib
+import collections.abc
+import dill
+import torch
+
+MANIFEST_NAME = 'manifest.json'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+DTYPE_NAMES = {
+    torch.float64: 'F64',
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.int16: 'I16',
+    torch.int8: 'I8',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL'
+}
+NAME_DTYPES = {v: k for k, v in DTYPE_NAMES.items()}
+
+
+class _TensorRef:
+    def __init__(self, name: str):
+        self.name = name
+
+
+def is_sharded_checkpoint(path) -> bool:
+    path = pathlib.Path(os.path.expanduser(str(path)))
+    return path.joinpath(MANIFEST_NAME).is_file()
+
+
+# ========= state dict shards ===========
+def _flatten(obj, prefix, tensors):
+    """
+    Replace tensors in a nested dict/list structure with _TensorRef.
+    """
+    if torch.is_tensor(obj):
+        name = prefix
+        assert name not in tensors
+        tensors[name] = obj.detach().to('cpu').contiguous()
+        return _TensorRef(name)
+    elif isinstance(obj, dict):
+        return type(obj)((k, _flatten(v, f'{prefix}/{k}' if prefix else str(k), tensors))
+            for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_flatten(v, f'{prefix}/{i}' if prefix else str(i), tensors)
+            for i, v in enumerate(obj))
+    return obj
+
+
+def _unflatten(obj, tensors):
+    if isinstance(obj, _TensorRef):
+        return tensors[obj.name]
+    elif isinstance(obj, dict):
+        return type(obj)((k, _unflatten(v, tensors)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_unflatten(v, tensors) for v in obj)
+    return obj
+
+
+def save_state_dict_shard(path, state_dict) -> str:
+    """
+    Writes path (safetensors layout) and path + '.skeleton.pkl'.
+    Returns the sha256 of the tensor file.
+    """
+    path = pathlib.Path(path)
+    tensors = dict()
+    skeleton = _flatten(state_dict, '', tensors)
+
+    header = dict()
+    offset = 0
+    for name, tensor in tensors.items():
+        n_bytes = tensor.numel() * tensor.element_size()
+        header[name] = {
+            'dtype': DTYPE_NAMES[tensor.dtype],
+            'shape': list(tensor.shape),
+            'data_offsets': [offset, offset + n_bytes]
+        }
+        offset += n_bytes
+        # keep tensors aligned for zero-copy loading
+        offset += (-offset) % ALIGNMENT
+    header_bytes = json.dumps(header).encode('utf-8')
+    # pad so that data starts aligned
+    header_bytes += b' ' * ((-(8 + len(header_bytes))) % ALIGNMENT)
+
+    sha = hashlib.sha256()
+    with path.open('wb') as f:
+        def write(data):
+            f.write(data)
+            sha.update(data)
+        write(struct.pack('<Q', len(header_bytes)))
+        write(header_bytes)
+        pos = 0
+        for name, tensor in tensors.items():
+            start, end = header[name]['data_offsets']
+            if start > pos:
+                write(b'\0' * (start - pos))
+            if end > start:
+                write(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+            pos = end
+    with open(str(path) + '.skeleton.pkl', 'wb') as f:
+        dill.dump(skeleton, f)
+    return sha.hexdigest()
+
+
+def load_state_dict_shard(path):
+    """
+    Tensors are copy-on-write memory maps of the file.
+    """
+    path = pathlib.Path(path)
+    with open(str(path) + '.skeleton.pkl', 'rb') as f:
+        skeleton = dill.load(f)
+    with path.open('rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        data_start = 8 + header_size
+        buf = None
+        if path.stat().st_size > data_start:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    tensors = dict()
+    for name, attr in header.items():
+        dtype = NAME_DTYPES[attr['dtype']]
+        shape = attr['shape']
+        start, end = attr['data_offsets']
+        if end == start:
+            tensors[name] = torch.empty(shape, dtype=dtype)
+            continue
+        itemsize = torch.empty((), dtype=dtype).element_size()
+        tensors[name] = torch.frombuffer(buf, dtype=dtype,
+            count=(end - start) // itemsize,
+            offset=data_start + start).reshape(shape)
+    return _unflatten(skeleton, tensors)
+
+
+class LazyStateDicts(collections.abc.Mapping):
+    """
+    Mapping of state dict name to state dict, loaded on first access.
+    """
+    def __init__(self, root: pathlib.Path, entries: dict):
+        self.root = root
+        self.entries = entries
+        self.loaded = dict()
+
+    def __getitem__(self, key):
+        if key not in self.loaded:
+            entry = self.entries[key]
+            self.loaded[key] = load_state_dict_shard(
+                self.root.joinpath(entry['file']))
+        return self.loaded[key]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# ========= checkpoints ===========
+def _link_to_store(file_path: pathlib.Path, digest: str, shard_store: pathlib.Path):
+    store_path = shard_store.joinpath(digest + '.safetensors')
+    tmp_link = file_path.with_name(file_path.name + '.link')
+    while True:
+        try:
+            os.link(file_path, store_path)
+            return
+        except FileExistsError:
+            pass
+        try:
+            # identical shard already stored, share it
+            os.link(store_path, tmp_link)
+            os.replace(tmp_link, file_path)
+            return
+        except FileNotFoundError:
+            # removed by a concurrent gc, store ours instead
+            continue
+
+
+def _gc_shard_store(shard_store: pathlib.Path):
+    if not shard_store.is_dir():
+        return
+    for store_path in shard_store.glob('*.safetensors'):
+        # only referenced by the store itself
+        if store_path.stat().st_nlink <= 1:
+            store_path.unlink(missing_ok=True)
+
+
+def save_sharded_checkpoint(path, payload: dict, shard_store=None):
+    """
+    payload: {'cfg': cfg, 'state_dicts': {key: state_dict}, 'pickles': {key: bytes}}
+    Written to a temporary directory and moved into place,
+    an existing checkpoint at path is replaced.
+    """
+    path = pathlib.Path(os.path.expanduser(str(path)))
+    tmp_path = path.with_name(path.name + '.tmp')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.joinpath('shards').mkdir(parents=True)
+    tmp_path.joinpath('pickles').mkdir()
+    if shard_store is not None:
+        shard_store = pathlib.Path(shard_store)
+        shard_store.mkdir(parents=True, exist_ok=True)
+
+    manifest = {
+        'version': FORMAT_VERSION,
+        'cfg': 'cfg.pkl',
+        'state_dicts': dict(),
+        'pickles': dict()
+    }
+    with tmp_path.joinpath('cfg.pkl').open('wb') as f:
+        dill.dump(payload['cfg'], f)
+    for key, state_dict in payload['state_dicts'].items():
+        file_name = f'shards/{key}.safetensors'
+        file_path = tmp_path.joinpath(file_name)
+        digest = save_state_dict_shard(file_path, state_dict)
+        if shard_store is not None:
+            _link_to_store(file_path, digest, shard_store)
+        manifest['state_dicts'][key] = {
+            'file': file_name,
+            'sha256': digest
+        }
+    for key, value in payload['pickles'].items():
+        file_name = f'pickles/{key}.pkl'
+        tmp_path.joinpath(file_name).write_bytes(value)
+        manifest['pickles'][key] = file_name
+    with tmp_path.joinpath(MANIFEST_NAME).open('w') as f:
+        json.dump(manifest, f, indent=2)
+
+    # replace existing checkpoint, of either format
+    from diffusion_policy.common.checkpoint_util import remove_checkpoint
+    old_path = path.with_name(path.name + '.old')
+    if path.exists():
+        if old_path.exists():
+            remove_checkpoint(old_path)
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    if old_path.exists():
+        remove_checkpoint(old_path)
+    if shard_store is not None:
+        _gc_shard_store(shard_store)
+    return path
+
+
+def load_sharded_checkpoint(path) -> dict:
+    """
+    Returns a payload in the same structure as torch checkpoints,
+    with lazily loaded state_dicts.
+    """
+    path = pathlib.Path(os.path.expanduser(str(path)))
+    with path.joinpath(MANIFEST_NAME).open('r') as f:
+        manifest = json.load(f)
+    if manifest['version'] != FORMAT_VERSION:
+        raise RuntimeError(f"Unsupported checkpoint format version {manifest['version']}")
+    with path.joinpath(manifest['cfg']).open('rb') as f:
+        cfg = dill.load(f)
+    pickles = dict()
+    for key, file_name in manifest['pickles'].items():
+        pickles[key] = path.joinpath(file_name).read_bytes()
+    return {
+        'cfg': cfg,
+        'state_dicts': LazyStateDicts(path, manifest['state_dicts']),
+        'pickles': pickles
+    }
+
+
+def remove_sharded_checkpoint(path, shard_store=None):
+    shutil.rmtree(path)
+    if shard_store is not None:
+        _gc_shard_store(pathlib.Path(shard_store))
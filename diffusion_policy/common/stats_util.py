@@ -0,0 +1,171 @@
+"""
+Chunked, multi-threaded statistics (min, max, mean, std) for normalizers.
+
+Arrays (np.ndarray, np.memmap or zarr.Array) are processed in row blocks
+aligned to zarr chunks, so no full float copy is ever materialized.
+Per-block results are combined with the parallel variant of
+Welford's algorithm in float64.
+
+With a cache_path, results are stored in a json file so later runs
+skip the computation. Entries are keyed by cache_key, e.g. the
+get_path_fingerprint of the dataset cache file and the array name,
+or by a content hash of the array, which reads all of it.
+"""
+from typing import Dict, Optional
+import os
+import json
+import hashlib
+import concurrent.futures
+import numpy as np
+from filelock import FileLock
+from diffusion_policy.common.memmap_util import _iter_row_slices
+
+
+class RunningStats:
+    """
+    Welford accumulator over rows of (N, D) blocks.
+    """
+    def __init__(self, dim: int):
+        self.n = 0
+        self.mean = np.zeros(dim, dtype=np.float64)
+        self.m2 = np.zeros(dim, dtype=np.float64)
+        self.min = np.full(dim, np.inf, dtype=np.float64)
+        self.max = np.full(dim, -np.inf, dtype=np.float64)
+
+    @classmethod
+    def from_block(cls, block: np.ndarray) -> 'RunningStats':
+        block = np.asarray(block, dtype=np.float64)
+        obj = cls(block.shape[-1])
+        if len(block) > 0:
+            obj.n = len(block)
+            obj.mean = block.mean(axis=0)
+            obj.m2 = np.square(block - obj.mean).sum(axis=0)
+            obj.min = block.min(axis=0)
+            obj.max = block.max(axis=0)
+        return obj
+
+    def merge(self, other: 'RunningStats') -> 'RunningStats':
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.n / n)
+        self.m2 = self.m2 + other.m2 + np.square(delta) * (self.n * other.n / n)
+        self.n = n
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        return self
+
+    def update(self, block: np.ndarray) -> 'RunningStats':
+        return self.merge(RunningStats.from_block(block))
+
+    def get_stats(self, ddof: int=0) -> Dict[str, np.ndarray]:
+        var = self.m2 / max(self.n - ddof, 1)
+        return {
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'std': np.sqrt(var)
+        }
+
+
+def _get_dim(arr, last_n_dims: int) -> int:
+    if last_n_dims > 0:
+        return int(np.prod(arr.shape[-last_n_dims:]))
+    return 1
+
+
+def compute_array_stats(arr, last_n_dims: int=1, ddof: int=0,
+        n_workers: Optional[int]=None, max_block_bytes: int=2**24
+        ) -> Dict[str, np.ndarray]:
+    """
+    Statistics over all but the last last_n_dims dims, each (D,) float64.
+    ddof=0 matches np.std, ddof=1 matches torch.std.
+    """
+    dim = _get_dim(arr, last_n_dims)
+    if n_workers is None:
+        n_workers = min(8, os.cpu_count() or 1)
+
+    def compute_block(row_slice):
+        return RunningStats.from_block(arr[row_slice].reshape(-1, dim))
+
+    row_slices = list(_iter_row_slices(arr, max_bytes=max_block_bytes))
+    result = RunningStats(dim)
+    if n_workers <= 1 or len(row_slices) <= 1:
+        for row_slice in row_slices:
+            result.merge(compute_block(row_slice))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # numpy releases the gil, zarr decompression mostly too
+            for stats in executor.map(compute_block, row_slices):
+                result.merge(stats)
+    return result.get_stats(ddof=ddof)
+
+
+def hash_array(arr, max_block_bytes: int=2**24) -> str:
+    h = hashlib.sha1()
+    h.update(json.dumps([str(np.dtype(arr.dtype)), list(arr.shape)]).encode())
+    for row_slice in _iter_row_slices(arr, max_bytes=max_block_bytes):
+        h.update(np.ascontiguousarray(arr[row_slice]).data)
+    return h.hexdigest()
+
+
+def get_path_fingerprint(path: str, *args) -> str:
+    """
+    Cheap stand-in for a content hash of the file, or all files of the
+    directory at path: sha1 of the path, sizes and mtimes, and args
+    (e.g. parameters of the transforms applied after loading).
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    h = hashlib.sha1()
+    h.update(path.encode())
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                stat = os.stat(file_path)
+                h.update(json.dumps([os.path.relpath(file_path, path),
+                    stat.st_size, stat.st_mtime_ns]).encode())
+    else:
+        stat = os.stat(path)
+        h.update(json.dumps([stat.st_size, stat.st_mtime_ns]).encode())
+    h.update(repr(args).encode())
+    return h.hexdigest()
+
+
+def get_array_stats(arr, cache_path: Optional[str]=None,
+        cache_key: Optional[str]=None,
+        last_n_dims: int=1, ddof: int=0, **kwargs) -> Dict[str, np.ndarray]:
+    """
+    compute_array_stats, persisted in the json file cache_path if given.
+    cache_key: identifies the contents of arr, e.g.
+        '<get_path_fingerprint of the dataset>/<array name>'.
+        Defaults to hash_array, which reads all of arr.
+    """
+    if cache_path is None:
+        return compute_array_stats(arr, last_n_dims=last_n_dims, ddof=ddof, **kwargs)
+
+    if cache_key is None:
+        cache_key = hash_array(arr)
+    key = json.dumps([cache_key, str(np.dtype(arr.dtype)), list(arr.shape),
+        last_n_dims, ddof])
+    with FileLock(cache_path + '.lock'):
+        cache = dict()
+        if os.path.isfile(cache_path):
+            with open(cache_path, 'r') as f:
+                cache = json.load(f)
+        if key in cache:
+            return {k: np.array(v, dtype=np.float64) for k, v in cache[key].items()}
+
+        stats = compute_array_stats(arr, last_n_dims=last_n_dims, ddof=ddof, **kwargs)
+        cache[key] = {k: v.tolist() for k, v in stats.items()}
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    return stats
@@ -1,4 +1,4 @@
-from typing import List, Tuple, Optional, Dict
+from typing import List, Tuple, Optional, Dict, Callable
 import math
 import numpy as np
 
@@ -80,10 +80,16 @@ class TimestampObsAccumulator:
     def __init__(self, 
             start_time: float, 
             dt: float, 
-            eps: float=1e-5):
+            eps: float=1e-5,
+            callback: Optional[Callable[[np.ndarray, Dict[str, np.ndarray]], None]]=None):
+        """
+        callback: called with (global_idxs, data) of newly written rows,
+        e.g. EpisodeWriter.put for journaling.
+        """
         self.start_time = start_time
         self.dt = dt
         self.eps = eps
+        self.callback = callback
         self.obs_buffer = dict()
         self.timestamp_buffer = None
         self.next_global_idx = 0
@@ -149,19 +155,26 @@ class TimestampObsAccumulator:
                 value[global_idxs] = data[key][local_idxs]
             self.timestamp_buffer[global_idxs] = timestamps[local_idxs]
 
+            if self.callback is not None:
+                self.callback(np.array(global_idxs), 
+                    {key: value[global_idxs] for key, value in self.obs_buffer.items()})
+
 
 class TimestampActionAccumulator:
     def __init__(self, 
             start_time: float, 
             dt: float, 
-            eps: float=1e-5):
+            eps: float=1e-5,
+            callback: Optional[Callable[[np.ndarray, np.ndarray], None]]=None):
         """
         Different from Obs accumulator, the action accumulator
         allows overwriting previous values.
+        callback: called with (global_idxs, actions) of written rows.
         """
         self.start_time = start_time
         self.dt = dt
         self.eps = eps
+        self.callback = callback
         self.action_buffer = None
         self.timestamp_buffer = None
         self.size = 0
@@ -220,3 +233,6 @@ class TimestampActionAccumulator:
             self.action_buffer[global_idxs] = actions[local_idxs]
             self.timestamp_buffer[global_idxs] = timestamps[local_idxs]
             self.size = max(self.size, this_max_size)
+            if self.callback is not None:
+                self.callback(np.array(global_idxs), 
+                    self.action_buffer[global_idxs])
@@ -2,6 +2,7 @@ from typing import Dict
 
 import torch
 import torch.nn
+import torch.utils.data
 from diffusion_policy.model.common.normalizer import LinearNormalizer
 
 class BaseLowdimDataset(torch.utils.data.Dataset):
@@ -26,6 +27,13 @@ class BaseLowdimDataset(torch.utils.data.Dataset):
         """
         raise NotImplementedError()
 
+    def get_batch(self, idxs) -> Dict[str, torch.Tensor]:
+        """
+        output: same as __getitem__ with a leading batch dimension B.
+        Override with a vectorized implementation when possible.
+        """
+        return torch.utils.data.default_collate([self[i] for i in idxs])
+
 
 class BaseImageDataset(torch.utils.data.Dataset):
     def get_validation_dataset(self) -> 'BaseLowdimDataset':
@@ -49,3 +57,10 @@ class BaseImageDataset(torch.utils.data.Dataset):
             action: T, Da
         """
         raise NotImplementedError()
+
+    def get_batch(self, idxs) -> Dict[str, torch.Tensor]:
+        """
+        output: same as __getitem__ with a leading batch dimension B.
+        Override with a vectorized implementation when possible.
+        """
+        return torch.utils.data.default_collate([self[i] for i in idxs])
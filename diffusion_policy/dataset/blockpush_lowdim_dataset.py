@@ -111,7 +111,7 @@ class BlockPushLowdimDataset(BaseLowdimDataset):
     def _sample_to_data(self, sample):
         obs = sample[self.obs_key] # T, D_o
         if not self.obs_eef_target:
-            obs[:,8:10] = 0
+            obs[...,8:10] = 0
         data = {
             'obs': obs,
             'action': sample[self.action_key], # T, D_a
@@ -124,3 +124,10 @@ class BlockPushLowdimDataset(BaseLowdimDataset):
 
         torch_data = dict_apply(data, torch.from_numpy)
         return torch_data
+
+    def get_batch(self, idxs) -> Dict[str, torch.Tensor]:
+        sample = self.sampler.sample_batch(idxs)
+        data = self._sample_to_data(sample)
+
+        torch_data = dict_apply(data, torch.from_numpy)
+        return torch_data
@@ -89,3 +89,10 @@ class KitchenLowdimDataset(BaseLowdimDataset):
 
         torch_data = dict_apply(data, torch.from_numpy)
         return torch_data
+
+    def get_batch(self, idxs) -> Dict[str, torch.Tensor]:
+        sample = self.sampler.sample_batch(idxs)
+        data = sample
+
+        torch_data = dict_apply(data, torch.from_numpy)
+        return torch_data
@@ -35,6 +35,7 @@ class KitchenMjlLowdimDataset(BaseLowdimDataset):
 
         data_directory = pathlib.Path(dataset_dir)
         self.replay_buffer = ReplayBuffer.create_empty_numpy()
+        episodes = list()
         for i, mjl_path in enumerate(tqdm(list(data_directory.glob('*/*.mjl')))):
             try:
                 data = parse_mjl_logs(str(mjl_path.absolute()), skipamount=40)
@@ -53,9 +54,11 @@ class KitchenMjlLowdimDataset(BaseLowdimDataset):
                     'obs': obs,
                     'action': data['ctrl'].astype(np.float32)
                 }
-                self.replay_buffer.add_episode(episode)
+                episodes.append(episode)
             except Exception as e:
                 print(i, e)
+        if len(episodes) > 0:
+            self.replay_buffer.add_episodes(episodes)
 
         val_mask = get_val_mask(
             n_episodes=self.replay_buffer.n_episodes, 
@@ -110,3 +113,10 @@ class KitchenMjlLowdimDataset(BaseLowdimDataset):
 
         torch_data = dict_apply(data, torch.from_numpy)
         return torch_data
+
+    def get_batch(self, idxs) -> Dict[str, torch.Tensor]:
+        sample = self.sampler.sample_batch(idxs)
+        data = sample
+
+        torch_data = dict_apply(data, torch.from_numpy)
+        return torch_data
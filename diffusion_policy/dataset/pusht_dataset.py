@@ -78,9 +78,9 @@ class PushTLowdimDataset(BaseLowdimDataset):
     def _sample_to_data(self, sample):
         keypoint = sample[self.obs_key]
         state = sample[self.state_key]
-        agent_pos = state[:,:2]
+        agent_pos = state[...,:2]
         obs = np.concatenate([
-            keypoint.reshape(keypoint.shape[0], -1), 
+            keypoint.reshape(keypoint.shape[:-2] + (-1,)), 
             agent_pos], axis=-1)
 
         data = {
@@ -95,3 +95,10 @@ class PushTLowdimDataset(BaseLowdimDataset):
 
         torch_data = dict_apply(data, torch.from_numpy)
         return torch_data
+
+    def get_batch(self, idxs) -> Dict[str, torch.Tensor]:
+        sample = self.sampler.sample_batch(idxs)
+        data = self._sample_to_data(sample)
+
+        torch_data = dict_apply(data, torch.from_numpy)
+        return torch_data
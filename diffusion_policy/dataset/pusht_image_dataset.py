@@ -18,7 +18,8 @@ class PushTImageDataset(BaseImageDataset):
             pad_after=0,
             seed=42,
             val_ratio=0.0,
-            max_train_episodes=None
+            max_train_episodes=None,
+            uint8_images=False
             ):
         
         super().__init__()
@@ -44,6 +45,7 @@ class PushTImageDataset(BaseImageDataset):
         self.horizon = horizon
         self.pad_before = pad_before
         self.pad_after = pad_after
+        self.uint8_images = uint8_images
 
     def get_validation_dataset(self):
         val_set = copy.copy(self)
@@ -71,8 +73,13 @@ class PushTImageDataset(BaseImageDataset):
         return len(self.sampler)
 
     def _sample_to_data(self, sample):
-        agent_pos = sample['state'][:,:2].astype(np.float32) # (agent_posx2, block_posex3)
-        image = np.moveaxis(sample['img'],-1,1)/255
+        agent_pos = sample['state'][...,:2].astype(np.float32) # (agent_posx2, block_posex3)
+        if self.uint8_images:
+            # keep uint8, converted to float on device
+            image = np.ascontiguousarray(
+                np.moveaxis(sample['img'],-1,-3), dtype=np.uint8)
+        else:
+            image = np.moveaxis(sample['img'],-1,-3)/255
 
         data = {
             'obs': {
@@ -89,6 +96,13 @@ class PushTImageDataset(BaseImageDataset):
         torch_data = dict_apply(data, torch.from_numpy)
         return torch_data
 
+    def get_batch(self, idxs) -> Dict[str, torch.Tensor]:
+        sample = self.sampler.sample_batch(idxs)
+        data = self._sample_to_data(sample)
+
+        torch_data = dict_apply(data, torch.from_numpy)
+        return torch_data
+
 
 def test():
     import os
@@ -15,6 +15,8 @@ from diffusion_policy.common.pytorch_util import dict_apply
 from diffusion_policy.dataset.base_dataset import BaseImageDataset
 from diffusion_policy.model.common.normalizer import LinearNormalizer, SingleFieldLinearNormalizer
 from diffusion_policy.common.replay_buffer import ReplayBuffer
+from diffusion_policy.common.memmap_util import is_memmap_path
+from diffusion_policy.common.stats_util import get_path_fingerprint
 from diffusion_policy.common.sampler import (
     SequenceSampler, get_val_mask, downsample_mask)
 from diffusion_policy.real_world.real_data_conversion import real_data_to_replay_buffer
@@ -35,23 +37,36 @@ class RealPushTImageDataset(BaseImageDataset):
             n_obs_steps=None,
             n_latency_steps=0,
             use_cache=False,
+            use_memmap=False,
+            frame_cache_bytes=0,
+            share_frame_cache=False,
             seed=42,
             val_ratio=0.0,
             max_train_episodes=None,
             delta_action=False,
+            uint8_images=False,
+            lazy_index=False,
         ):
         assert os.path.isdir(dataset_path)
         
         replay_buffer = None
+        stats_cache_path = None
+        stats_fingerprint = None
         if use_cache:
             # fingerprint shape_meta
             shape_meta_json = json.dumps(OmegaConf.to_container(shape_meta), sort_keys=True)
             shape_meta_hash = hashlib.md5(shape_meta_json.encode('utf-8')).hexdigest()
             cache_zarr_path = os.path.join(dataset_path, shape_meta_hash + '.zarr.zip')
+            cache_memmap_path = os.path.join(dataset_path, shape_meta_hash + '.memmap')
             cache_lock_path = cache_zarr_path + '.lock'
+            # normalizer stats, keyed by fingerprint of the cache file
+            stats_cache_path = os.path.join(dataset_path, shape_meta_hash + '.stats.json')
             print('Acquiring lock on cache.')
             with FileLock(cache_lock_path):
-                if not os.path.exists(cache_zarr_path):
+                if use_memmap and is_memmap_path(cache_memmap_path):
+                    # opened below
+                    pass
+                elif not os.path.exists(cache_zarr_path):
                     # cache does not exists
                     try:
                         print('Cache does not exist. Creating!')
@@ -68,12 +83,28 @@ class RealPushTImageDataset(BaseImageDataset):
                     except Exception as e:
                         shutil.rmtree(cache_zarr_path)
                         raise e
-                else:
+                elif not use_memmap:
                     print('Loading cached ReplayBuffer from Disk.')
                     with zarr.ZipStore(cache_zarr_path, mode='r') as zip_store:
                         replay_buffer = ReplayBuffer.copy_from_store(
                             src_store=zip_store, store=zarr.MemoryStore())
                     print('Loaded!')
+
+                if use_memmap:
+                    if not is_memmap_path(cache_memmap_path):
+                        # decode chunk by chunk from the zarr cache
+                        print('Saving memmap cache to disk.')
+                        with zarr.ZipStore(cache_zarr_path, mode='r') as zip_store:
+                            ReplayBuffer(zarr.group(zip_store)).save_to_memmap(
+                                cache_memmap_path)
+                    # copy-on-write, delta_action below stays private
+                    print('Opening memmap ReplayBuffer from Disk.')
+                    replay_buffer = ReplayBuffer.create_from_memmap(
+                        cache_memmap_path, mode='c')
+                # delta_action changes action after loading
+                stats_fingerprint = get_path_fingerprint(
+                    cache_memmap_path if use_memmap else cache_zarr_path,
+                    delta_action)
         else:
             replay_buffer = _get_replay_buffer(
                 dataset_path=dataset_path,
@@ -115,6 +146,11 @@ class RealPushTImageDataset(BaseImageDataset):
             for key in rgb_keys + lowdim_keys:
                 key_first_k[key] = n_obs_steps
 
+        if frame_cache_bytes > 0:
+            # overlapping windows decode the same frames repeatedly
+            replay_buffer.set_frame_cache(rgb_keys, 
+                max_bytes=frame_cache_bytes, shared=share_frame_cache)
+
         val_mask = get_val_mask(
             n_episodes=replay_buffer.n_episodes, 
             val_ratio=val_ratio,
@@ -131,7 +167,8 @@ class RealPushTImageDataset(BaseImageDataset):
             pad_before=pad_before, 
             pad_after=pad_after,
             episode_mask=train_mask,
-            key_first_k=key_first_k)
+            key_first_k=key_first_k,
+            lazy_index=lazy_index)
         
         self.replay_buffer = replay_buffer
         self.sampler = sampler
@@ -139,6 +176,10 @@ class RealPushTImageDataset(BaseImageDataset):
         self.rgb_keys = rgb_keys
         self.lowdim_keys = lowdim_keys
         self.n_obs_steps = n_obs_steps
+        self.uint8_images = uint8_images
+        self.stats_cache_path = stats_cache_path
+        self.stats_fingerprint = stats_fingerprint
+        self.lazy_index = lazy_index
         self.val_mask = val_mask
         self.horizon = horizon
         self.n_latency_steps = n_latency_steps
@@ -152,51 +193,59 @@ class RealPushTImageDataset(BaseImageDataset):
             sequence_length=self.horizon+self.n_latency_steps,
             pad_before=self.pad_before, 
             pad_after=self.pad_after,
-            episode_mask=self.val_mask
+            episode_mask=self.val_mask,
+            lazy_index=self.lazy_index
             )
         val_set.val_mask = ~self.val_mask
         return val_set
 
+    def get_stats_cache_key(self, key):
+        if self.stats_fingerprint is None:
+            return None
+        return f'{self.stats_fingerprint}/{key}'
+
     def get_normalizer(self, **kwargs) -> LinearNormalizer:
         normalizer = LinearNormalizer()
 
         # action
         normalizer['action'] = SingleFieldLinearNormalizer.create_fit(
-            self.replay_buffer['action'])
+            self.replay_buffer['action'], cache_path=self.stats_cache_path,
+            cache_key=self.get_stats_cache_key('action'))
         
         # obs
         for key in self.lowdim_keys:
             normalizer[key] = SingleFieldLinearNormalizer.create_fit(
-                self.replay_buffer[key])
+                self.replay_buffer[key], cache_path=self.stats_cache_path,
+                cache_key=self.get_stats_cache_key(key))
         
         # image
         for key in self.rgb_keys:
             normalizer[key] = get_image_range_normalizer()
         return normalizer
 
+    def get_frame_cache_stats(self) -> dict:
+        return self.replay_buffer.get_frame_cache_stats()
+
     def get_all_actions(self) -> torch.Tensor:
         return torch.from_numpy(self.replay_buffer['action'])
 
     def __len__(self):
         return len(self.sampler)
 
-    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
-        threadpool_limits(1)
-        data = self.sampler.sample_sequence(idx)
-
-        # to save RAM, only return first n_obs_steps of OBS
-        # since the rest will be discarded anyway.
-        # when self.n_obs_steps is None
-        # this slice does nothing (takes all)
-        T_slice = slice(self.n_obs_steps)
-
+    def _sample_to_data(self, data, T_slice):
         obs_dict = dict()
         for key in self.rgb_keys:
             # move channel last to channel first
             # T,H,W,C
-            # convert uint8 image to float32
-            obs_dict[key] = np.moveaxis(data[key][T_slice],-1,1
-                ).astype(np.float32) / 255.
+            if self.uint8_images:
+                # keep uint8, converted to float on device
+                # see pytorch_util.uint8_images_to_float
+                obs_dict[key] = np.ascontiguousarray(
+                    np.moveaxis(data[key][T_slice],-1,-3))
+            else:
+                # convert uint8 image to float32
+                obs_dict[key] = np.moveaxis(data[key][T_slice],-1,-3
+                    ).astype(np.float32) / 255.
             # T,C,H,W
             # save ram
             del data[key]
@@ -209,7 +258,7 @@ class RealPushTImageDataset(BaseImageDataset):
         # handle latency by dropping first n_latency_steps action
         # observations are already taken care of by T_slice
         if self.n_latency_steps > 0:
-            action = action[self.n_latency_steps:]
+            action = action[...,self.n_latency_steps:,:]
 
         torch_data = {
             'obs': dict_apply(obs_dict, torch.from_numpy),
@@ -217,6 +266,24 @@ class RealPushTImageDataset(BaseImageDataset):
         }
         return torch_data
 
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        threadpool_limits(1)
+        data = self.sampler.sample_sequence(idx)
+
+        # to save RAM, only return first n_obs_steps of OBS
+        # since the rest will be discarded anyway.
+        # when self.n_obs_steps is None
+        # this slice does nothing (takes all)
+        T_slice = slice(self.n_obs_steps)
+        return self._sample_to_data(data, T_slice)
+
+    def get_batch(self, idxs) -> Dict[str, torch.Tensor]:
+        threadpool_limits(1)
+        data = self.sampler.sample_batch(idxs)
+        # B,T,* slice along time
+        T_slice = (slice(None), slice(self.n_obs_steps))
+        return self._sample_to_data(data, T_slice)
+
 def zarr_resize_index_last_dim(zarr_arr, idxs):
     actions = zarr_arr[:]
     actions = actions[...,idxs]
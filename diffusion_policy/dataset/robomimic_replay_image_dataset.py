@@ -11,16 +11,18 @@ import json
 import hashlib
 from filelock import FileLock
 from threadpoolctl import threadpool_limits
-import concurrent.futures
-import multiprocessing
 from omegaconf import OmegaConf
 from diffusion_policy.common.pytorch_util import dict_apply
 from diffusion_policy.dataset.base_dataset import BaseImageDataset, LinearNormalizer
 from diffusion_policy.model.common.normalizer import LinearNormalizer, SingleFieldLinearNormalizer
 from diffusion_policy.model.common.rotation_transformer import RotationTransformer
 from diffusion_policy.codecs.imagecodecs_numcodecs import register_codecs, Jpeg2k
-from diffusion_policy.common.replay_buffer import ReplayBuffer
+from diffusion_policy.common.replay_buffer import ReplayBuffer, get_optimal_chunks
+from diffusion_policy.common.memmap_util import is_memmap_path
+from diffusion_policy.common.stats_util import get_path_fingerprint
+from diffusion_policy.common.chunk_encoder import ChunkEncoder
 from diffusion_policy.common.sampler import SequenceSampler, get_val_mask
+from diffusion_policy.model.vision.feature_cache import get_rgb_features, get_feature_key
 from diffusion_policy.common.normalize_util import (
     robomimic_abs_action_only_normalizer_from_stat,
     robomimic_abs_action_only_dual_arm_normalizer_from_stat,
@@ -44,50 +46,95 @@ class RobomimicReplayImageDataset(BaseImageDataset):
             rotation_rep='rotation_6d', # ignored when abs_action=False
             use_legacy_normalizer=False,
             use_cache=False,
+            use_memmap=False,
+            streaming_cache=False,
+            encode_mode='thread',
+            frame_cache_bytes=0,
+            share_frame_cache=False,
             seed=42,
-            val_ratio=0.0
+            val_ratio=0.0,
+            uint8_images=False
         ):
         rotation_transformer = RotationTransformer(
             from_rep='axis_angle', to_rep=rotation_rep)
 
         replay_buffer = None
+        stats_cache_path = None
+        stats_fingerprint = None
+        feature_cache_dir = None
         if use_cache:
             cache_zarr_path = dataset_path + '.zarr.zip'
+            cache_memmap_path = dataset_path + '.memmap'
             cache_lock_path = cache_zarr_path + '.lock'
+            # normalizer stats, keyed by fingerprint of the cache file
+            stats_cache_path = dataset_path + '.stats.json'
+            # frozen encoder features, see precompute_rgb_features
+            feature_cache_dir = dataset_path + '.features'
             print('Acquiring lock on cache.')
             with FileLock(cache_lock_path):
-                if not os.path.exists(cache_zarr_path):
+                if use_memmap and is_memmap_path(cache_memmap_path):
+                    # opened below
+                    pass
+                elif not os.path.exists(cache_zarr_path):
                     # cache does not exists
-                    try:
-                        print('Cache does not exist. Creating!')
-                        # store = zarr.DirectoryStore(cache_zarr_path)
-                        replay_buffer = _convert_robomimic_to_replay(
-                            store=zarr.MemoryStore(), 
+                    if streaming_cache:
+                        # bounded memory, resumes if interrupted
+                        print('Cache does not exist. Creating by streaming!')
+                        _convert_robomimic_to_zarr_streaming(
+                            zarr_path=cache_zarr_path,
                             shape_meta=shape_meta, 
                             dataset_path=dataset_path, 
                             abs_action=abs_action, 
-                            rotation_transformer=rotation_transformer)
-                        print('Saving cache to disk.')
-                        with zarr.ZipStore(cache_zarr_path) as zip_store:
-                            replay_buffer.save_to_store(
-                                store=zip_store
-                            )
-                    except Exception as e:
-                        shutil.rmtree(cache_zarr_path)
-                        raise e
-                else:
+                            rotation_transformer=rotation_transformer,
+                            encode_mode=encode_mode)
+                    else:
+                        try:
+                            print('Cache does not exist. Creating!')
+                            # store = zarr.DirectoryStore(cache_zarr_path)
+                            replay_buffer = _convert_robomimic_to_replay(
+                                store=zarr.MemoryStore(), 
+                                shape_meta=shape_meta, 
+                                dataset_path=dataset_path, 
+                                abs_action=abs_action, 
+                                rotation_transformer=rotation_transformer,
+                                encode_mode=encode_mode)
+                            print('Saving cache to disk.')
+                            with zarr.ZipStore(cache_zarr_path) as zip_store:
+                                replay_buffer.save_to_store(
+                                    store=zip_store
+                                )
+                        except Exception as e:
+                            shutil.rmtree(cache_zarr_path)
+                            raise e
+
+                if (replay_buffer is None) and (not use_memmap):
                     print('Loading cached ReplayBuffer from Disk.')
                     with zarr.ZipStore(cache_zarr_path, mode='r') as zip_store:
                         replay_buffer = ReplayBuffer.copy_from_store(
                             src_store=zip_store, store=zarr.MemoryStore())
                     print('Loaded!')
+
+                if use_memmap:
+                    if not is_memmap_path(cache_memmap_path):
+                        # decode chunk by chunk from the zarr cache
+                        print('Saving memmap cache to disk.')
+                        with zarr.ZipStore(cache_zarr_path, mode='r') as zip_store:
+                            ReplayBuffer(zarr.group(zip_store)).save_to_memmap(
+                                cache_memmap_path)
+                    # copy-on-write, shared by all DataLoader workers
+                    print('Opening memmap ReplayBuffer from Disk.')
+                    replay_buffer = ReplayBuffer.create_from_memmap(
+                        cache_memmap_path, mode='c')
+                stats_fingerprint = get_path_fingerprint(
+                    cache_memmap_path if use_memmap else cache_zarr_path)
         else:
             replay_buffer = _convert_robomimic_to_replay(
                 store=zarr.MemoryStore(), 
                 shape_meta=shape_meta, 
                 dataset_path=dataset_path, 
                 abs_action=abs_action, 
-                rotation_transformer=rotation_transformer)
+                rotation_transformer=rotation_transformer,
+                encode_mode=encode_mode)
 
         rgb_keys = list()
         lowdim_keys = list()
@@ -102,6 +149,11 @@ class RobomimicReplayImageDataset(BaseImageDataset):
         # for key in rgb_keys:
         #     replay_buffer[key].compressor.numthreads=1
 
+        if frame_cache_bytes > 0:
+            # overlapping windows decode the same frames repeatedly
+            replay_buffer.set_frame_cache(rgb_keys, 
+                max_bytes=frame_cache_bytes, shared=share_frame_cache)
+
         key_first_k = dict()
         if n_obs_steps is not None:
             # only take first k obs from images
@@ -128,16 +180,28 @@ class RobomimicReplayImageDataset(BaseImageDataset):
         self.lowdim_keys = lowdim_keys
         self.abs_action = abs_action
         self.n_obs_steps = n_obs_steps
+        self.uint8_images = uint8_images
+        self.stats_cache_path = stats_cache_path
+        self.stats_fingerprint = stats_fingerprint
+        self.feature_cache_dir = feature_cache_dir
+        # rgb key: feature key, returned instead of images
+        self.rgb_feature_keys = dict()
+        self.sampler_keys = None
+        self.key_first_k = key_first_k
         self.train_mask = train_mask
         self.horizon = horizon
         self.pad_before = pad_before
         self.pad_after = pad_after
         self.use_legacy_normalizer = use_legacy_normalizer
+        self.use_memmap = use_memmap
         self.val_dataset_path = val_dataset_path
 
     def get_validation_dataset(self):
         if self.val_dataset_path:
             val_dataset_path_zarr = self.val_dataset_path + '.zarr.zip'
+            val_dataset_path_memmap = self.val_dataset_path + '.memmap'
+            if self.use_memmap and is_memmap_path(val_dataset_path_memmap):
+                val_dataset_path_zarr = val_dataset_path_memmap
             val_replay_buffer = ReplayBuffer.copy_from_path(val_dataset_path_zarr)
             val_sampler = SequenceSampler(
                 replay_buffer=val_replay_buffer, 
@@ -149,6 +213,8 @@ class RobomimicReplayImageDataset(BaseImageDataset):
             val_set = copy.copy(self)
             val_set.replay_buffer = val_replay_buffer
             val_set.sampler = val_sampler
+            # no precomputed features, the encoder runs on images
+            val_set.rgb_feature_keys = dict()
             return val_set
         else:
             val_set = copy.copy(self)
@@ -157,16 +223,24 @@ class RobomimicReplayImageDataset(BaseImageDataset):
                 sequence_length=self.horizon,
                 pad_before=self.pad_before, 
                 pad_after=self.pad_after,
-                episode_mask=~self.train_mask
+                episode_mask=~self.train_mask,
+                keys=self.sampler_keys
             )
             val_set.train_mask = ~self.train_mask
             return val_set
 
+    def get_stats_cache_key(self, key):
+        if self.stats_fingerprint is None:
+            return None
+        return f'{self.stats_fingerprint}/{key}'
+
     def get_normalizer(self, **kwargs) -> LinearNormalizer:
         normalizer = LinearNormalizer()
 
         # action
-        stat = array_to_stats(self.replay_buffer['action'])
+        stat = array_to_stats(self.replay_buffer['action'],
+            cache_path=self.stats_cache_path,
+            cache_key=self.get_stats_cache_key('action'))
         if self.abs_action:
             if stat['mean'].shape[-1] > 10:
                 # dual arm
@@ -183,7 +257,9 @@ class RobomimicReplayImageDataset(BaseImageDataset):
 
         # obs
         for key in self.lowdim_keys:
-            stat = array_to_stats(self.replay_buffer[key])
+            stat = array_to_stats(self.replay_buffer[key],
+                cache_path=self.stats_cache_path,
+                cache_key=self.get_stats_cache_key(key))
 
             if key.endswith('pos'):
                 this_normalizer = get_range_normalizer_from_stat(stat)
@@ -199,31 +275,70 @@ class RobomimicReplayImageDataset(BaseImageDataset):
         # image
         for key in self.rgb_keys:
             normalizer[key] = get_image_range_normalizer()
+        for feature_key in self.rgb_feature_keys.values():
+            normalizer[feature_key] = SingleFieldLinearNormalizer.create_identity()
         return normalizer
 
+    def precompute_rgb_features(self, obs_encoder, normalizer, **kwargs):
+        """
+        Compute features of a frozen obs_encoder (MultiImageObsEncoder)
+        once and return them as obs <key>_feature instead of images.
+        normalizer: from get_normalizer, applied to images before the encoder.
+        kwargs: see feature_cache.compute_rgb_features
+        """
+        features = get_rgb_features(
+            {key: self.replay_buffer.data[key] for key in self.rgb_keys},
+            obs_encoder=obs_encoder,
+            normalizer=normalizer,
+            cache_dir=self.feature_cache_dir,
+            **kwargs)
+        for key, value in features.items():
+            feature_key = get_feature_key(key)
+            self.replay_buffer.data[feature_key] = value
+            self.rgb_feature_keys[key] = feature_key
+            if key in self.key_first_k:
+                self.key_first_k[feature_key] = self.key_first_k[key]
+
+        # stop decoding images
+        self.sampler_keys = [key for key in self.replay_buffer.keys()
+            if key not in self.rgb_feature_keys]
+        self.sampler = SequenceSampler(
+            replay_buffer=self.replay_buffer, 
+            sequence_length=self.horizon,
+            pad_before=self.pad_before, 
+            pad_after=self.pad_after,
+            episode_mask=self.train_mask,
+            keys=self.sampler_keys,
+            key_first_k=self.key_first_k)
+
+    def get_frame_cache_stats(self) -> dict:
+        return self.replay_buffer.get_frame_cache_stats()
+
     def get_all_actions(self) -> torch.Tensor:
         return torch.from_numpy(self.replay_buffer['action'])
 
     def __len__(self):
         return len(self.sampler)
 
-    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
-        threadpool_limits(1)
-        data = self.sampler.sample_sequence(idx)
-
-        # to save RAM, only return first n_obs_steps of OBS
-        # since the rest will be discarded anyway.
-        # when self.n_obs_steps is None
-        # this slice does nothing (takes all)
-        T_slice = slice(self.n_obs_steps)
-
+    def _sample_to_data(self, data, T_slice):
         obs_dict = dict()
         for key in self.rgb_keys:
+            if key in self.rgb_feature_keys:
+                feature_key = self.rgb_feature_keys[key]
+                obs_dict[feature_key] = data[feature_key][T_slice].astype(np.float32)
+                del data[feature_key]
+                continue
             # move channel last to channel first
             # T,H,W,C
-            # convert uint8 image to float32
-            obs_dict[key] = np.moveaxis(data[key][T_slice],-1,1
-                ).astype(np.float32) / 255.
+            if self.uint8_images:
+                # keep uint8, converted to float on device
+                # see pytorch_util.uint8_images_to_float
+                obs_dict[key] = np.ascontiguousarray(
+                    np.moveaxis(data[key][T_slice],-1,-3))
+            else:
+                # convert uint8 image to float32
+                obs_dict[key] = np.moveaxis(data[key][T_slice],-1,-3
+                    ).astype(np.float32) / 255.
             # T,C,H,W
             del data[key]
         for key in self.lowdim_keys:
@@ -236,6 +351,24 @@ class RobomimicReplayImageDataset(BaseImageDataset):
         }
         return torch_data
 
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        threadpool_limits(1)
+        data = self.sampler.sample_sequence(idx)
+
+        # to save RAM, only return first n_obs_steps of OBS
+        # since the rest will be discarded anyway.
+        # when self.n_obs_steps is None
+        # this slice does nothing (takes all)
+        T_slice = slice(self.n_obs_steps)
+        return self._sample_to_data(data, T_slice)
+
+    def get_batch(self, idxs) -> Dict[str, torch.Tensor]:
+        threadpool_limits(1)
+        data = self.sampler.sample_batch(idxs)
+        # B,T,* slice along time
+        T_slice = (slice(None), slice(self.n_obs_steps))
+        return self._sample_to_data(data, T_slice)
+
 
 def _convert_actions(raw_actions, abs_action, rotation_transformer):
     actions = raw_actions
@@ -261,11 +394,7 @@ def _convert_actions(raw_actions, abs_action, rotation_transformer):
 
 
 def _convert_robomimic_to_replay(store, shape_meta, dataset_path, abs_action, rotation_transformer, 
-        n_workers=None, max_inflight_tasks=None):
-    if n_workers is None:
-        n_workers = multiprocessing.cpu_count()
-    if max_inflight_tasks is None:
-        max_inflight_tasks = n_workers * 5
+        n_workers=None, max_inflight_tasks=None, encode_mode='thread'):
 
     # parse shape_meta
     rgb_keys = list()
@@ -328,19 +457,11 @@ def _convert_robomimic_to_replay(store, shape_meta, dataset_path, abs_action, ro
                 dtype=this_data.dtype
             )
         
-        def img_copy(zarr_arr, zarr_idx, hdf5_arr, hdf5_idx):
-            try:
-                zarr_arr[zarr_idx] = hdf5_arr[hdf5_idx]
-                # make sure we can successfully decode
-                _ = zarr_arr[zarr_idx]
-                return True
-            except Exception as e:
-                return False
-        
         with tqdm(total=n_steps*len(rgb_keys), desc="Loading image data", mininterval=1.0) as pbar:
-            # one chunk per thread, therefore no synchronization needed
-            with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
-                futures = set()
+            # one chunk per task, therefore no synchronization needed
+            with ChunkEncoder(mode=encode_mode, n_workers=n_workers, 
+                    max_inflight_tasks=max_inflight_tasks,
+                    callback=lambda start, n: pbar.update(n)) as encoder:
                 for key in rgb_keys:
                     data_key = 'obs/' + key
                     shape = tuple(shape_meta['obs'][key]['shape'])
@@ -357,28 +478,161 @@ def _convert_robomimic_to_replay(store, shape_meta, dataset_path, abs_action, ro
                         demo = demos[f'demo_{episode_idx}']
                         hdf5_arr = demo['obs'][key]
                         for hdf5_idx in range(hdf5_arr.shape[0]):
-                            if len(futures) >= max_inflight_tasks:
-                                # limit number of inflight tasks
-                                completed, futures = concurrent.futures.wait(futures, 
-                                    return_when=concurrent.futures.FIRST_COMPLETED)
-                                for f in completed:
-                                    if not f.result():
-                                        raise RuntimeError('Failed to encode image!')
-                                pbar.update(len(completed))
-
                             zarr_idx = episode_starts[episode_idx] + hdf5_idx
-                            futures.add(
-                                executor.submit(img_copy, 
-                                    img_arr, zarr_idx, hdf5_arr, hdf5_idx))
-                completed, futures = concurrent.futures.wait(futures)
-                for f in completed:
-                    if not f.result():
-                        raise RuntimeError('Failed to encode image!')
-                pbar.update(len(completed))
+                            encoder.put(img_arr, zarr_idx, hdf5_arr[hdf5_idx])
 
     replay_buffer = ReplayBuffer(root)
     return replay_buffer
 
+def _convert_robomimic_to_zarr_streaming(zarr_path, shape_meta, dataset_path, 
+        abs_action, rotation_transformer, n_workers=None, max_inflight_tasks=None,
+        encode_mode='thread'):
+    """
+    Write the replay buffer directly to disk, episode by episode.
+    Peak memory is one episode of low-dim data plus max_inflight_tasks frames.
+    Progress is committed to the zarr attrs after each episode, 
+    rerunning after an interruption resumes from the last committed episode.
+    zarr_path: a directory, or a '.zip' file which is packed 
+        from a '.partial' directory once conversion finished.
+    encode_mode: 'thread' or 'process', see ChunkEncoder.
+    """
+
+    is_zip = zarr_path.endswith('.zip')
+    dir_path = zarr_path + '.partial' if is_zip else zarr_path
+
+    # parse shape_meta
+    rgb_keys = list()
+    lowdim_keys = list()
+    obs_shape_meta = shape_meta['obs']
+    for key, attr in obs_shape_meta.items():
+        type = attr.get('type', 'low_dim')
+        if type == 'rgb':
+            rgb_keys.append(key)
+        elif type == 'low_dim':
+            lowdim_keys.append(key)
+
+    # only resume a conversion with identical settings
+    fingerprint = json.dumps({
+        'dataset_path': os.path.abspath(dataset_path),
+        'shape_meta': OmegaConf.to_container(OmegaConf.create(shape_meta)),
+        'abs_action': bool(abs_action)
+    }, sort_keys=True)
+    store = zarr.DirectoryStore(dir_path)
+    root = zarr.group(store)
+    if root.attrs.get('fingerprint') != fingerprint:
+        root = zarr.group(store, overwrite=True)
+        root.attrs['fingerprint'] = fingerprint
+        root.attrs['n_completed_episodes'] = 0
+    n_completed = root.attrs['n_completed_episodes']
+
+    with h5py.File(dataset_path) as file:
+        # count total steps
+        demos = file['data']
+        episode_ends = list()
+        prev_end = 0
+        for i in range(len(demos)):
+            demo = demos[f'demo_{i}']
+            episode_length = demo['actions'].shape[0]
+            episode_end = prev_end + episode_length
+            prev_end = episode_end
+            episode_ends.append(episode_end)
+        n_episodes = len(episode_ends)
+        n_steps = episode_ends[-1]
+        episode_starts = [0] + episode_ends[:-1]
+
+        data_group = root.require_group('data')
+        meta_group = root.require_group('meta')
+        _ = meta_group.array('episode_ends', episode_ends, 
+            dtype=np.int64, compressor=None, overwrite=True)
+        for key in lowdim_keys + ['action']:
+            if key == 'action':
+                shape = (n_steps,) + tuple(shape_meta['action']['shape'])
+            else:
+                shape = (n_steps,) + tuple(shape_meta['obs'][key]['shape'])
+            # chunked in time, episodes are written incrementally
+            _ = data_group.require_dataset(
+                name=key,
+                shape=shape,
+                chunks=get_optimal_chunks(shape=shape, dtype=np.float32),
+                compressor=None,
+                dtype=np.float32
+            )
+        for key in rgb_keys:
+            c,h,w = tuple(shape_meta['obs'][key]['shape'])
+            _ = data_group.require_dataset(
+                name=key,
+                shape=(n_steps,h,w,c),
+                chunks=(1,h,w,c),
+                compressor=Jpeg2k(level=50),
+                dtype=np.uint8
+            )
+
+        n_pending = np.zeros(n_episodes, dtype=np.int64)
+
+        def on_stored(chunk_start, n_frames):
+            # image chunks are single frames
+            episode_idx = np.searchsorted(episode_ends, chunk_start, side='right')
+            n_pending[episode_idx] -= 1
+            pbar.update(n_frames)
+
+        def commit(n_submitted):
+            # episodes before n_submitted are fully submitted
+            nonlocal n_completed
+            prev_completed = n_completed
+            while (n_completed < n_submitted) and (n_pending[n_completed] == 0):
+                n_completed += 1
+            if n_completed != prev_completed:
+                root.attrs['n_completed_episodes'] = n_completed
+
+        n_resumed_steps = episode_starts[n_completed] if n_completed < n_episodes else n_steps
+        with tqdm(total=(n_steps - n_resumed_steps)*len(rgb_keys), 
+                desc="Streaming image data", mininterval=1.0) as pbar:
+            # one chunk per task, therefore no synchronization needed
+            with ChunkEncoder(mode=encode_mode, n_workers=n_workers, 
+                    max_inflight_tasks=max_inflight_tasks,
+                    callback=on_stored) as encoder:
+                for episode_idx in range(n_completed, n_episodes):
+                    demo = demos[f'demo_{episode_idx}']
+                    start = episode_starts[episode_idx]
+                    end = episode_ends[episode_idx]
+
+                    # save lowdim data
+                    for key in lowdim_keys + ['action']:
+                        data_key = 'obs/' + key
+                        if key == 'action':
+                            data_key = 'actions'
+                        this_data = demo[data_key][:].astype(np.float32)
+                        if key == 'action':
+                            this_data = _convert_actions(
+                                raw_actions=this_data,
+                                abs_action=abs_action,
+                                rotation_transformer=rotation_transformer
+                            )
+                        data_group[key][start:end] = this_data
+
+                    # save image data
+                    for key in rgb_keys:
+                        img_arr = data_group[key]
+                        hdf5_arr = demo['obs'][key]
+                        n_pending[episode_idx] += hdf5_arr.shape[0]
+                        for hdf5_idx in range(hdf5_arr.shape[0]):
+                            encoder.put(img_arr, start + hdf5_idx, hdf5_arr[hdf5_idx])
+                            commit(episode_idx)
+                    commit(episode_idx + 1)
+                encoder.flush()
+                commit(n_episodes)
+    assert n_completed == n_episodes
+
+    if is_zip:
+        # pack chunk by chunk, then atomically move into place
+        tmp_path = zarr_path + '.tmp'
+        with zarr.ZipStore(tmp_path, mode='w') as zip_store:
+            zarr.copy_store(source=store, dest=zip_store)
+        os.replace(tmp_path, zarr_path)
+        shutil.rmtree(dir_path)
+    return zarr_path
+
+
 def normalizer_from_stat(stat):
     max_abs = np.maximum(stat['max'].max(), np.abs(stat['min']).max())
     scale = np.full_like(stat['max'], fill_value=1/max_abs)
@@ -128,6 +128,11 @@ class RobomimicReplayLowdimDataset(BaseLowdimDataset):
         torch_data = dict_apply(data, torch.from_numpy)
         return torch_data
 
+    def get_batch(self, idxs) -> Dict[str, torch.Tensor]:
+        data = self.sampler.sample_batch(idxs)
+        torch_data = dict_apply(data, torch.from_numpy)
+        return torch_data
+
 def normalizer_from_stat(stat):
     max_abs = np.maximum(stat['max'].max(), np.abs(stat['min']).max())
     scale = np.full_like(stat['max'], fill_value=1/max_abs)
@@ -0,0 +1,130 @@
+"""
+Env rollouts off the training critical path.
+
+AsyncEnvRunner instantiates the env runner in a long-lived subprocess.
+submit copies the policy weights into a snapshot in shared memory and
+queues a rollout. The subprocess loads the snapshot into its own copy
+of the policy and runs env_runner.run while training continues.
+poll returns the logs of finished rollouts, tagged with whatever was
+passed to submit (e.g. the epoch of the snapshot).
+"""
+from typing import Any, Dict, List, Tuple
+import os
+import copy
+import queue
+import traceback
+import hydra
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+from omegaconf import OmegaConf
+
+_ctx = mp.get_context('spawn')
+
+
+class AsyncEnvRunner(_ctx.Process):
+    def __init__(self, runner_cfg, output_dir: str, policy: nn.Module,
+            device='cpu', poll_interval: float=1.0):
+        """
+        runner_cfg: hydra config of the env runner, e.g. cfg.task.env_runner
+        policy: template of the submitted policies, e.g. the ema model
+        device: device of the policy in the subprocess
+        """
+        super().__init__(name='AsyncEnvRunner')
+        if OmegaConf.is_config(runner_cfg):
+            # resolvers are registered in the parent only
+            runner_cfg = OmegaConf.to_container(runner_cfg, resolve=True)
+        self.runner_cfg = runner_cfg
+        self.output_dir = output_dir
+        self.device = str(device)
+        self.poll_interval = poll_interval
+
+        self.snapshot = copy.deepcopy(policy).to('cpu').share_memory()
+        self.snapshot_free = _ctx.Event()
+        self.snapshot_free.set()
+        self.request_queue = _ctx.Queue()
+        self.result_queue = _ctx.Queue()
+        self.n_pending = 0
+
+    # ========= parent process ==========
+    def _check_alive(self):
+        if not self.is_alive():
+            raise RuntimeError(
+                f'AsyncEnvRunner exited with code {self.exitcode}')
+
+    def submit(self, policy: nn.Module, tag: Any, **run_kwargs):
+        """
+        Queues a rollout of the current weights of policy,
+        run_kwargs are passed to env_runner.run.
+        Blocks only while the previous snapshot hasn't been
+        loaded yet, i.e. when rollouts fall behind training.
+        """
+        while not self.snapshot_free.wait(self.poll_interval):
+            self._check_alive()
+        self.snapshot_free.clear()
+        with torch.no_grad():
+            self.snapshot.load_state_dict(policy.state_dict())
+        self.request_queue.put((tag, run_kwargs))
+        self.n_pending += 1
+
+    def poll(self, block: bool=False) -> List[Tuple[Any, Dict]]:
+        """
+        returns: (tag, runner_log) of finished rollouts, in order
+            of submission. If block, waits for all pending rollouts.
+        """
+        results = list()
+        while self.n_pending > 0:
+            try:
+                tag, runner_log, error = self.result_queue.get(
+                    block=block, timeout=self.poll_interval)
+            except queue.Empty:
+                if not block:
+                    break
+                self._check_alive()
+                continue
+            self.n_pending -= 1
+            if error is not None:
+                raise RuntimeError(f'Async rollout {tag} failed:\n{error}')
+            results.append((tag, runner_log))
+        return results
+
+    def close(self, timeout=None):
+        """
+        Stops the subprocess, pending rollouts are discarded.
+        """
+        if self.is_alive():
+            self.request_queue.put(None)
+            self.join(timeout=timeout)
+
+    # ========= subprocess ==========
+    def run(self):
+        parent_pid = os.getppid()
+        try:
+            # before cuda init, env workers may fork
+            runner = hydra.utils.instantiate(
+                self.runner_cfg, output_dir=self.output_dir)
+            policy = copy.deepcopy(self.snapshot).to(self.device)
+            policy.eval()
+        except Exception:
+            self.result_queue.put((None, None, traceback.format_exc()))
+            return
+
+        while True:
+            try:
+                request = self.request_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if os.getppid() != parent_pid:
+                    # trainer died
+                    break
+                continue
+            if request is None:
+                break
+            tag, run_kwargs = request
+            with torch.no_grad():
+                policy.load_state_dict(self.snapshot.state_dict())
+            self.snapshot_free.set()
+            try:
+                runner_log = runner.run(policy, **run_kwargs)
+                self.result_queue.put((tag, runner_log, None))
+            except Exception:
+                self.result_queue.put((tag, None, traceback.format_exc()))
@@ -16,6 +16,8 @@ from diffusion_policy.gym_util.video_recording_wrapper import VideoRecordingWrap
 from diffusion_policy.policy.base_image_policy import BaseImagePolicy
 from diffusion_policy.common.pytorch_util import dict_apply
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
+from diffusion_policy.env_runner.rollout_scheduler import (
+    run_rollouts, has_episode_state, SequentialStopping)
 
 class PushTImageRunner(BaseImageRunner):
     def __init__(self,
@@ -35,6 +37,10 @@ class PushTImageRunner(BaseImageRunner):
             render_size=96,
             past_action=False,
             tqdm_interval_sec=5.0,
+            adaptive_eval=False,
+            eval_wave_size=10,
+            eval_ci_half_width=0.05,
+            eval_confidence=0.95,
             n_envs=None
         ):
         super().__init__(output_dir)
@@ -141,80 +147,67 @@ class PushTImageRunner(BaseImageRunner):
         self.past_action = past_action
         self.max_steps = max_steps
         self.tqdm_interval_sec = tqdm_interval_sec
+        self.adaptive_eval = adaptive_eval
+        self.eval_wave_size = eval_wave_size
+        self.eval_ci_half_width = eval_ci_half_width
+        self.eval_confidence = eval_confidence
     
-    def run(self, policy: BaseImagePolicy):
+    def run(self, policy: BaseImagePolicy, score_threshold=None):
+        """
+        score_threshold: with adaptive_eval, stop once test/mean_score
+            is clearly below it, e.g. the worst score in the top-k.
+        """
         device = policy.device
         dtype = policy.dtype
         env = self.env
 
-        # plan for rollout
-        n_envs = len(self.env_fns)
         n_inits = len(self.env_init_fn_dills)
-        n_chunks = math.ceil(n_inits / n_envs)
-
-        # allocate data
-        all_video_paths = [None] * n_inits
-        all_rewards = [None] * n_inits
-
-        for chunk_idx in range(n_chunks):
-            start = chunk_idx * n_envs
-            end = min(n_inits, start + n_envs)
-            this_global_slice = slice(start, end)
-            this_n_active_envs = end - start
-            this_local_slice = slice(0,this_n_active_envs)
-            
-            this_init_fns = self.env_init_fn_dills[this_global_slice]
-            n_diff = n_envs - len(this_init_fns)
-            if n_diff > 0:
-                this_init_fns.extend([self.env_init_fn_dills[0]]*n_diff)
-            assert len(this_init_fns) == n_envs
-
-            # init envs
-            env.call_each('run_dill_function', 
-                args_list=[(x,) for x in this_init_fns])
-
-            # start rollout
-            obs = env.reset()
-            past_action = None
-            policy.reset()
-
-            pbar = tqdm.tqdm(total=self.max_steps, desc=f"Eval PushtImageRunner {chunk_idx+1}/{n_chunks}", 
-                leave=False, mininterval=self.tqdm_interval_sec)
-            done = False
-            while not done:
-                # create obs dict
-                np_obs_dict = dict(obs)
-                if self.past_action and (past_action is not None):
-                    # TODO: not tested
-                    np_obs_dict['past_action'] = past_action[
-                        :,-(self.n_obs_steps-1):].astype(np.float32)
-                
-                # device transfer
-                obs_dict = dict_apply(np_obs_dict, 
-                    lambda x: torch.from_numpy(x).to(
-                        device=device))
-
-                # run policy
-                with torch.no_grad():
-                    action_dict = policy.predict_action(obs_dict)
-
-                # device_transfer
-                np_action_dict = dict_apply(action_dict,
-                    lambda x: x.detach().to('cpu').numpy())
-
-                action = np_action_dict['action']
-
-                # step env
-                obs, reward, done, info = env.step(action)
-                done = np.all(done)
-                past_action = action
-
-                # update pbar
-                pbar.update(action.shape[1])
-            pbar.close()
-
-            all_video_paths[this_global_slice] = env.render()[this_local_slice]
-            all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
+
+        def predict_action(obs, past_action):
+            # create obs dict
+            np_obs_dict = dict(obs)
+            if self.past_action and (past_action is not None):
+                # TODO: not tested
+                np_obs_dict['past_action'] = past_action[
+                    :,-(self.n_obs_steps-1):].astype(np.float32)
+
+            # device transfer
+            obs_dict = dict_apply(np_obs_dict, 
+                lambda x: torch.from_numpy(x).to(
+                    device=device))
+
+            # run policy
+            with torch.no_grad():
+                action_dict = policy.predict_action(obs_dict)
+
+            # device_transfer
+            np_action_dict = dict_apply(action_dict,
+                lambda x: x.detach().to('cpu').numpy())
+            return np_action_dict['action']
+
+        stop_fn = None
+        if self.adaptive_eval:
+            # test seeds in waves until the mean score is known well enough
+            stopping = SequentialStopping(
+                wave_size=self.eval_wave_size,
+                ci_half_width=self.eval_ci_half_width,
+                confidence=self.eval_confidence,
+                score_threshold=score_threshold)
+            def stop_fn(rewards):
+                scores = [np.max(x) for x, prefix
+                    in zip(rewards, self.env_prefixs) if prefix.endswith('test/')]
+                return stopping(scores)
+
+        # envs start the next init condition as soon as they are done
+        all_video_paths, all_rewards, _ = run_rollouts(
+            env=env,
+            env_init_fn_dills=self.env_init_fn_dills,
+            predict_action=predict_action,
+            reset_policy=policy.reset,
+            continuous=not has_episode_state(policy),
+            desc="Eval PushtImageRunner",
+            stop_fn=stop_fn,
+            tqdm_interval_sec=self.tqdm_interval_sec)
         # clear out video buffer
         _ = env.reset()
 
@@ -230,6 +223,9 @@ class PushTImageRunner(BaseImageRunner):
         # for i in range(len(self.env_fns)):
         # and comment out this line
         for i in range(n_inits):
+            if all_rewards[i] is None:
+                # skipped by adaptive eval
+                continue
             seed = self.env_seeds[i]
             prefix = self.env_prefixs[i]
             max_reward = np.max(all_rewards[i])
@@ -245,6 +241,7 @@ class PushTImageRunner(BaseImageRunner):
         # log aggregate metrics
         for prefix, value in max_rewards.items():
             name = prefix+'mean_score'
+            log_data[prefix+'n_episodes'] = len(value)
             value = np.mean(value)
             log_data[name] = value
 
@@ -19,6 +19,8 @@ from diffusion_policy.model.common.rotation_transformer import RotationTransform
 from diffusion_policy.policy.base_image_policy import BaseImagePolicy
 from diffusion_policy.common.pytorch_util import dict_apply
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
+from diffusion_policy.env_runner.rollout_scheduler import (
+    run_rollouts, has_episode_state, SequentialStopping)
 from diffusion_policy.env.robomimic.robomimic_image_wrapper import RobomimicImageWrapper
 import robomimic.utils.file_utils as FileUtils
 import robomimic.utils.env_utils as EnvUtils
@@ -72,6 +74,10 @@ class RobomimicImageRunner(BaseImageRunner):
             past_action=False,
             abs_action=False,
             tqdm_interval_sec=5.0,
+            adaptive_eval=False,
+            eval_wave_size=10,
+            eval_ci_half_width=0.05,
+            eval_confidence=0.95,
             
             ### Yilong
             ###########################################################################
@@ -171,13 +177,18 @@ class RobomimicImageRunner(BaseImageRunner):
                 )
             return dummy_env_fn
 
-        env_fns = []
-        for robot in robots:
-            for _ in range(n_train + n_test):
-                env_fns.append(make_env_fn(robot, render=True))
+        # one pool of envs per robot, inits run on an env of their robot
+        env_fns = list()
+        env_robots = list()
+        for i, robot in enumerate(robots):
+            n_robot_envs = n_envs // len(robots) + int(i < n_envs % len(robots))
+            n_robot_envs = min(max(n_robot_envs, 1), n_train + n_test)
+            env_fns.extend([make_env_fn(robot, render=True)] * n_robot_envs)
+            env_robots.extend([robot] * n_robot_envs)
         env_seeds = list()
         env_prefixs = list()
         env_init_fn_dills = list()
+        env_init_robots = list()
 
         # train
         with h5py.File(dataset_path, 'r') as f:
@@ -206,6 +217,7 @@ class RobomimicImageRunner(BaseImageRunner):
                     env_seeds.append(f"{robot}_train_{train_idx}")
                     env_prefixs.append(f'{robot}/train/')
                     env_init_fn_dills.append(dill.dumps(init_fn))
+                    env_init_robots.append(robot)
         
         # test
         for robot in robots:
@@ -232,6 +244,7 @@ class RobomimicImageRunner(BaseImageRunner):
                 env_seeds.append(f"{robot}_test_{seed}")
                 env_prefixs.append(f'{robot}/test/')
                 env_init_fn_dills.append(dill.dumps(init_fn))
+                env_init_robots.append(robot)
 
         dummy_env_fn = make_dummy_env_fn(robots[0])
         env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn)
@@ -243,6 +256,8 @@ class RobomimicImageRunner(BaseImageRunner):
         self.env_seeds = env_seeds
         self.env_prefixs = env_prefixs
         self.env_init_fn_dills = env_init_fn_dills
+        self.env_robots = env_robots
+        self.env_init_robots = env_init_robots
         self.fps = fps
         self.crf = crf
         self.n_obs_steps = n_obs_steps
@@ -252,6 +267,10 @@ class RobomimicImageRunner(BaseImageRunner):
         self.rotation_transformer = rotation_transformer
         self.abs_action = abs_action
         self.tqdm_interval_sec = tqdm_interval_sec
+        self.adaptive_eval = adaptive_eval
+        self.eval_wave_size = eval_wave_size
+        self.eval_ci_half_width = eval_ci_half_width
+        self.eval_confidence = eval_confidence
         
         
         # Yilong
@@ -285,128 +304,110 @@ class RobomimicImageRunner(BaseImageRunner):
         #     ).to(device)
         ###########################################################################
 
-    def run(self, policy: BaseImagePolicy):
+    def run(self, policy: BaseImagePolicy, score_threshold=None):
+        """
+        score_threshold: with adaptive_eval, stop once the test score of all robots
+            is clearly below it, e.g. the worst score in the top-k.
+        """
         device = policy.device
         dtype = policy.dtype
         env = self.env
         
-        # plan for rollout
-        n_envs = len(self.env_fns)
         n_inits = len(self.env_init_fn_dills)
-        n_chunks = math.ceil(n_inits / n_envs)
-
-        # allocate data
-        all_video_paths = [None] * n_inits
-        all_rewards = [None] * n_inits
-
-        for chunk_idx in range(n_chunks):
-            start = chunk_idx * n_envs
-            end = min(n_inits, start + n_envs)
-            this_global_slice = slice(start, end)
-            this_n_active_envs = end - start
-            this_local_slice = slice(0,this_n_active_envs)
-            
-            this_init_fns = self.env_init_fn_dills[this_global_slice]
-            n_diff = n_envs - len(this_init_fns)
-            if n_diff > 0:
-                this_init_fns.extend([self.env_init_fn_dills[0]]*n_diff)
-            assert len(this_init_fns) == n_envs
-
-            # init envs
-            env.call_each('run_dill_function', 
-                args_list=[(x,) for x in this_init_fns])
-
-            # start rollout
-            obs = env.reset()
-            past_action = None
-            policy.reset()
-
-            env_name = self.env_meta['env_name']
-            pbar = tqdm.tqdm(total=self.max_steps, desc=f"Eval {env_name}Image {chunk_idx+1}/{n_chunks}", 
-                leave=False, mininterval=self.tqdm_interval_sec)
-            
-            done = False
-            while not done:
-                # create obs dict
-                np_obs_dict = dict(obs)
-                if self.past_action and (past_action is not None):
-                    # TODO: not tested
-                    np_obs_dict['past_action'] = past_action[
-                        :,-(self.n_obs_steps-1):].astype(np.float32)
+
+        def predict_action(obs, past_action):
+            # create obs dict
+            np_obs_dict = dict(obs)
+            if self.past_action and (past_action is not None):
+                # TODO: not tested
+                np_obs_dict['past_action'] = past_action[
+                    :,-(self.n_obs_steps-1):].astype(np.float32)
+
+            # device transfer
+            obs_dict = dict_apply(np_obs_dict, 
+                lambda x: torch.from_numpy(x).to(
+                    device=device))
+
+            # run policy
+            with torch.no_grad():
+                action_dict = policy.predict_action(obs_dict)
                 
-                # device transfer
-                obs_dict = dict_apply(np_obs_dict, 
-                    lambda x: torch.from_numpy(x).to(
-                        device=device))
-
-                # run policy
-                with torch.no_grad():
-                    action_dict = policy.predict_action(obs_dict)
+                # Yilong
+                ###########################################################################
+                # if self.decoder_model_path != None:
+                #     action_pred = action_dict['action_pred']
                     
-                    # Yilong
-                    ###########################################################################
-                    # if self.decoder_model_path != None:
-                    #     action_pred = action_dict['action_pred']
-                        
-                    #     batch_size, seq_len, feature_dim = action_pred.shape  # (28, 8, 512)
-
-                    #     # Reshape to combine batch and sequence dimensions
-                    #     flattened_input = action_pred.reshape(-1, feature_dim)  # (224, 512)
-
-                    #     # Process with MLP
-                    #     output = self.action_identifier.decode(flattened_input)  # (224, 4)
-
-                    #     # Reshape back to (28, 8, 4)
-                    #     output = output.view(batch_size, seq_len, -1)
-                        
-                    #     rotation_zeros = torch.zeros(output.shape[0], output.shape[1], 3).to(next(self.action_identifier.parameters()).device)
-
-                    #     # Concatenate the tensors along the third axis
-                    #     action_pred = torch.cat((output[:, :, :3] * 40, rotation_zeros, output[:, :, 3:]), dim=2)
-                        
-                    #     # norms = torch.norm(action_pred[:, :, :3], dim=2, keepdim=True)
-                    #     # normalized_first_three = action_pred[:, :, :3] / norms
-
-                    #     # Set the last component to -1 if negative and 1 if positive
-                    #     last_component = torch.sign(action_pred[:, :, -1])
-
-                    #     # Combine the normalized first three components, the middle three components, and the modified last component
-                    #     action_pred = torch.cat((action_pred[:, :, :6], last_component.unsqueeze(2)), dim=2)
-                        
-                    #     action = action_pred[:,action_dict['start']:action_dict['end']]
-                        
-                    #     action_dict['action_pred'] = action_pred
-                    #     action_dict['action'] = action
-                        
-                    #     del action_dict['start']
-                    #     del action_dict['end']
-                    ###########################################################################
-
-                # device_transfer
-                np_action_dict = dict_apply(action_dict,
-                    lambda x: x.detach().to('cpu').numpy())
-
-                action = np_action_dict['action']
-                if not np.all(np.isfinite(action)):
-                    print(action)
-                    raise RuntimeError("Nan or Inf action")
-                
-                # step env
-                env_action = action
-                if self.abs_action:
-                    env_action = self.undo_transform_action(action)
-
-                obs, reward, done, info = env.step(env_action)
-                done = np.all(done)
-                past_action = action
-
-                # update pbar
-                pbar.update(action.shape[1])
-            pbar.close()
-
-            # collect data for this round
-            all_video_paths[this_global_slice] = env.render()[this_local_slice]
-            all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
+                #     batch_size, seq_len, feature_dim = action_pred.shape  # (28, 8, 512)
+    
+                #     # Reshape to combine batch and sequence dimensions
+                #     flattened_input = action_pred.reshape(-1, feature_dim)  # (224, 512)
+    
+                #     # Process with MLP
+                #     output = self.action_identifier.decode(flattened_input)  # (224, 4)
+    
+                #     # Reshape back to (28, 8, 4)
+                #     output = output.view(batch_size, seq_len, -1)
+                    
+                #     rotation_zeros = torch.zeros(output.shape[0], output.shape[1], 3).to(next(self.action_identifier.parameters()).device)
+    
+                #     # Concatenate the tensors along the third axis
+                #     action_pred = torch.cat((output[:, :, :3] * 40, rotation_zeros, output[:, :, 3:]), dim=2)
+                    
+                #     # norms = torch.norm(action_pred[:, :, :3], dim=2, keepdim=True)
+                #     # normalized_first_three = action_pred[:, :, :3] / norms
+    
+                #     # Set the last component to -1 if negative and 1 if positive
+                #     last_component = torch.sign(action_pred[:, :, -1])
+    
+                #     # Combine the normalized first three components, the middle three components, and the modified last component
+                #     action_pred = torch.cat((action_pred[:, :, :6], last_component.unsqueeze(2)), dim=2)
+                    
+                #     action = action_pred[:,action_dict['start']:action_dict['end']]
+                    
+                #     action_dict['action_pred'] = action_pred
+                #     action_dict['action'] = action
+                    
+                #     del action_dict['start']
+                #     del action_dict['end']
+                ###########################################################################
+
+            # device_transfer
+            np_action_dict = dict_apply(action_dict,
+                lambda x: x.detach().to('cpu').numpy())
+
+            action = np_action_dict['action']
+            if not np.all(np.isfinite(action)):
+                print(action)
+                raise RuntimeError("Nan or Inf action")
+            return action
+
+        stop_fn = None
+        if self.adaptive_eval:
+            # test seeds in waves until the mean score is known well enough
+            stopping = SequentialStopping(
+                wave_size=self.eval_wave_size,
+                ci_half_width=self.eval_ci_half_width,
+                confidence=self.eval_confidence,
+                score_threshold=score_threshold)
+            def stop_fn(rewards):
+                scores = [np.max(x) for x, prefix
+                    in zip(rewards, self.env_prefixs) if prefix.endswith('test/')]
+                return stopping(scores)
+
+        # envs start the next init condition as soon as they are done
+        env_name = self.env_meta['env_name']
+        all_video_paths, all_rewards, _ = run_rollouts(
+            env=env,
+            env_init_fn_dills=self.env_init_fn_dills,
+            predict_action=predict_action,
+            reset_policy=policy.reset,
+            continuous=not has_episode_state(policy),
+            transform_action=self.undo_transform_action if self.abs_action else None,
+            desc=f"Eval {env_name}Image",
+            stop_fn=stop_fn,
+            env_groups=self.env_robots,
+            init_groups=self.env_init_robots,
+            tqdm_interval_sec=self.tqdm_interval_sec)
         # clear out video buffer
         _ = env.reset()
         
@@ -422,6 +423,9 @@ class RobomimicImageRunner(BaseImageRunner):
         # for i in range(len(self.env_fns)):
         # and comment out this line
         for i in range(n_inits):
+            if all_rewards[i] is None:
+                # skipped by adaptive eval
+                continue
             seed = self.env_seeds[i]
             prefix = self.env_prefixs[i]
             max_reward = np.max(all_rewards[i])
@@ -437,6 +441,7 @@ class RobomimicImageRunner(BaseImageRunner):
         # log aggregate metrics
         for prefix, value in max_rewards.items():
             name = prefix+'mean_score'
+            log_data[prefix+'n_episodes'] = len(value)
             value = np.mean(value)
             log_data[name] = value
 
@@ -0,0 +1,251 @@
+"""
+Work-queue rollouts over the envs of an AsyncVectorEnv.
+
+The env runners used to split init conditions into chunks of n_envs,
+and each chunk ran until its slowest env was done. Here, an env that
+is done immediately starts the next pending init condition, and the
+policy is only called on the envs still running, so the wall-clock
+of a rollout approaches the mean episode length instead of the max.
+
+For adaptive evaluation, run_rollouts takes a stop_fn, called with the
+results of the inits finished so far in init order (a prefix, so the
+estimate isn't biased towards short episodes), see SequentialStopping.
+"""
+from typing import Callable, List, Optional, Sequence, Tuple
+import statistics
+import collections
+import numpy as np
+import tqdm
+from diffusion_policy.policy.base_image_policy import BaseImagePolicy
+from diffusion_policy.policy.base_lowdim_policy import BaseLowdimPolicy
+
+
+def has_episode_state(policy) -> bool:
+    """
+    Whether policy keeps per-episode state across predict_action calls,
+    reset together for the whole batch (e.g. RNN policies).
+    """
+    return getattr(type(policy), 'reset', None) \
+        not in (None, BaseImagePolicy.reset, BaseLowdimPolicy.reset)
+
+
+def score_confidence_interval(scores: Sequence[float], confidence: float=0.95
+        ) -> Tuple[float, float]:
+    """
+    Agresti-Coull interval of the mean of scores in [0,1].
+    Conservative for non-binary scores (e.g. coverage),
+    and doesn't collapse when all episodes succeed or fail.
+    """
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    n = len(scores) + z ** 2
+    p = (float(np.sum(scores)) + z ** 2 / 2) / n
+    half_width = z * np.sqrt(p * (1 - p) / n)
+    return max(p - half_width, 0.0), min(p + half_width, 1.0)
+
+
+class SequentialStopping:
+    """
+    stop_fn of adaptive evaluation, checked after each wave of
+    wave_size scores. Stops once the confidence interval of the mean
+    score is narrower than 2 * ci_half_width, or lies entirely below
+    score_threshold (e.g. the worst score in the top-k checkpoints).
+    Repeated checks aren't corrected for, keep waves large.
+    """
+    def __init__(self, wave_size: int=10, ci_half_width: float=0.05,
+            confidence: float=0.95, score_threshold: Optional[float]=None):
+        assert wave_size > 0
+        self.wave_size = wave_size
+        self.ci_half_width = ci_half_width
+        self.confidence = confidence
+        self.score_threshold = score_threshold
+        self.n_checked = 0
+
+    def __call__(self, scores: Sequence[float]) -> bool:
+        if len(scores) < self.n_checked + self.wave_size:
+            return False
+        self.n_checked = len(scores)
+        low, high = score_confidence_interval(scores, self.confidence)
+        if (high - low) / 2 <= self.ci_half_width:
+            return True
+        # clearly worse than the current top-k
+        return (self.score_threshold is not None) \
+            and (high < self.score_threshold)
+
+
+def _take_rows(x, idxs):
+    if isinstance(x, dict):
+        return dict((key, _take_rows(value, idxs)) for key, value in x.items())
+    return x[idxs]
+
+
+def _put_rows(x, idxs, values, n):
+    """
+    Writes values into rows idxs of x, allocates x with n rows if None.
+    """
+    if isinstance(values, dict):
+        if x is None:
+            x = dict()
+        for key, value in values.items():
+            x[key] = _put_rows(x.get(key), idxs, value, n)
+        return x
+    if x is None:
+        x = np.zeros((n,) + values.shape[1:], dtype=values.dtype)
+    x[idxs] = values
+    return x
+
+
+def run_rollouts(env, env_init_fn_dills: Sequence[bytes],
+        predict_action: Callable, reset_policy: Callable,
+        continuous: bool=True,
+        transform_action: Optional[Callable]=None,
+        stop_fn: Optional[Callable]=None,
+        env_groups: Optional[Sequence]=None,
+        init_groups: Optional[Sequence]=None,
+        desc: str='Eval', tqdm_interval_sec: float=5.0
+        ) -> Tuple[List, List, List]:
+    """
+    Runs one episode per init function on the envs of env.
+
+    predict_action(obs, past_action) -> action
+        obs and action of the running envs, past_action the previous
+        action of these envs, None if any of them just started.
+    reset_policy() is called before the first episode.
+    continuous: if False, for policies with per-episode state
+        (see has_episode_state), envs start together in chunks
+        of n_envs and reset_policy is called before each chunk.
+        All envs of a chunk are stepped until the last one is done,
+        so the policy batch keeps its size and row order.
+    transform_action(action) -> action passed to env.step
+    stop_fn(rewards) -> bool, called with the rewards of the first n
+        inits whenever all of them are done. If True, running episodes
+        are abandoned and only the first n results are kept.
+    env_groups, init_groups: group of each env and init function
+        (e.g. the robot), inits only run on envs of their group.
+
+    returns: video_paths, rewards, last_infos, one per init function,
+        None for inits skipped by stop_fn
+    """
+    n_envs = env.num_envs
+    n_inits = len(env_init_fn_dills)
+
+    all_video_paths = [None] * n_inits
+    all_rewards = [None] * n_inits
+    all_last_infos = [None] * n_inits
+
+    # env idx: init idx, of the running envs
+    env_init_idxs = dict()
+    # chunk mode: envs of the current chunk
+    chunk_env_idxs = None
+    # env idx: init idx, of done envs not rendered yet
+    video_init_idxs = dict()
+    past_actions = [None] * n_envs
+    obs_buffer = None
+    if env_groups is None:
+        env_groups = [None] * n_envs
+        init_groups = [None] * n_inits
+    assert len(env_groups) == n_envs
+    assert len(init_groups) == n_inits
+    # group: pending init idxs, in order
+    pending_init_idxs = collections.defaultdict(collections.deque)
+    for init_idx, group in enumerate(init_groups):
+        pending_init_idxs[group].append(init_idx)
+    assert set(pending_init_idxs.keys()) <= set(env_groups)
+    # inits before this are all done
+    n_done = 0
+
+    def start_episodes(env_idxs):
+        nonlocal obs_buffer
+        init_idxs = list()
+        started_env_idxs = list()
+        for env_idx in env_idxs:
+            pending = pending_init_idxs[env_groups[env_idx]]
+            if len(pending) > 0:
+                init_idxs.append(pending.popleft())
+                started_env_idxs.append(env_idx)
+        env_idxs = started_env_idxs
+        if len(env_idxs) == 0:
+            return env_idxs
+        env.call_each('run_dill_function',
+            args_list=[(env_init_fn_dills[i],) for i in init_idxs],
+            indices=env_idxs)
+        obs = env.reset(indices=env_idxs)
+        obs_buffer = _put_rows(obs_buffer, env_idxs, obs, n_envs)
+        for env_idx, init_idx in zip(env_idxs, init_idxs):
+            env_init_idxs[env_idx] = init_idx
+            past_actions[env_idx] = None
+        return env_idxs
+
+    def render_videos():
+        # rendering stops the video recorder, which restarts on the
+        # next step, so done envs of a chunk wait for the chunk end
+        env_idxs = sorted(video_init_idxs.keys())
+        if len(env_idxs) == 0:
+            return
+        video_paths = env.render(indices=env_idxs)
+        for env_idx, video_path in zip(env_idxs, video_paths):
+            all_video_paths[video_init_idxs[env_idx]] = video_path
+        video_init_idxs.clear()
+
+    pbar = tqdm.tqdm(total=n_inits, desc=desc,
+        leave=False, mininterval=tqdm_interval_sec)
+    reset_policy()
+    chunk_env_idxs = start_episodes(range(n_envs))
+    while len(env_init_idxs) > 0:
+        if continuous:
+            env_idxs = sorted(env_init_idxs.keys())
+        else:
+            # including done envs, the policy state is per batch row
+            env_idxs = chunk_env_idxs
+        obs = _take_rows(obs_buffer, env_idxs)
+        past_action = None
+        if all(past_actions[i] is not None for i in env_idxs):
+            past_action = np.stack([past_actions[i] for i in env_idxs])
+
+        action = predict_action(obs, past_action)
+        env_action = action
+        if transform_action is not None:
+            env_action = transform_action(action)
+        obs, reward, done, info = env.step(env_action, indices=env_idxs)
+        obs_buffer = _put_rows(obs_buffer, env_idxs, obs, n_envs)
+        for row, env_idx in enumerate(env_idxs):
+            past_actions[env_idx] = action[row]
+
+        # newly done envs
+        done_rows = [row for row in np.nonzero(done)[0].tolist()
+            if env_idxs[row] in env_init_idxs]
+        if len(done_rows) == 0:
+            continue
+        done_env_idxs = [env_idxs[row] for row in done_rows]
+        rewards = env.call('get_attr', 'reward', indices=done_env_idxs)
+        for row, env_idx, this_rewards in zip(
+                done_rows, done_env_idxs, rewards):
+            init_idx = env_init_idxs.pop(env_idx)
+            all_rewards[init_idx] = this_rewards
+            all_last_infos[init_idx] = info[row]
+            video_init_idxs[env_idx] = init_idx
+        if continuous:
+            render_videos()
+        pbar.update(len(done_rows))
+
+        if stop_fn is not None:
+            n_done_before = n_done
+            while (n_done < n_inits) and (all_rewards[n_done] is not None):
+                n_done += 1
+            if (n_done_before < n_done < n_inits) and stop_fn(all_rewards[:n_done]):
+                render_videos()
+                for i in range(n_done, n_inits):
+                    all_video_paths[i] = None
+                    all_rewards[i] = None
+                    all_last_infos[i] = None
+                break
+
+        if continuous:
+            start_episodes(done_env_idxs)
+        elif len(env_init_idxs) == 0:
+            render_videos()
+            if any(len(x) > 0 for x in pending_init_idxs.values()):
+                # next chunk
+                reset_policy()
+                chunk_env_idxs = start_episodes(range(n_envs))
+    pbar.close()
+    return all_video_paths, all_rewards, all_last_infos
@@ -2,17 +2,24 @@
 Back ported methods: call, set_attr from v0.26
 Disabled auto-reset after done
 Added render method.
+Added indices to reset, step and call, to operate on a subset of envs.
+Added shared memory step: actions, rewards, dones and infos in shared
+memory, workers woken by semaphores instead of pipe messages.
 """
 
 
+import os
 import numpy as np
 import multiprocessing as mp
+import pickle
 import time
 import sys
 from enum import Enum
 from copy import deepcopy
+from collections import OrderedDict
 
 from gym import logger
+from gym import spaces
 from gym.vector.vector_env import VectorEnv
 from gym.error import (
     AlreadyPendingCallError,
@@ -68,6 +75,14 @@ class AsyncVectorEnv(VectorEnv):
         will quit if the head process quits. However, `daemon=True` prevents
         subprocesses to spawn children, so for some environments you may want
         to have it set to `False`
+    shared_step : bool (default: `True`)
+        If `True` and `shared_memory`, then `step` passes actions, rewards,
+        dones and infos through shared memory and wakes the workers with
+        semaphores, instead of a pipe message each way per environment.
+        Only used for `Box` action spaces and the default worker.
+    info_buffer_size : int (default: 65536)
+        Bytes of pickled step info per environment in shared memory,
+        larger infos are sent through the pipe.
     worker : function, optional
         WARNING - advanced mode option! If set, then use that worker in a subprocess
         instead of a default one. Can be useful to override some inner vector env
@@ -88,6 +103,8 @@ class AsyncVectorEnv(VectorEnv):
         context=None,
         daemon=True,
         worker=None,
+        shared_step=True,
+        info_buffer_size=1<<16,
     ):
         ctx = mp.get_context(context)
         self.env_fns = env_fns
@@ -136,6 +153,13 @@ class AsyncVectorEnv(VectorEnv):
                 self.single_observation_space, n=self.num_envs, fn=np.zeros
             )
 
+        self._step_channel = None
+        if shared_step and self.shared_memory and (worker is None) \
+                and isinstance(self.single_action_space, spaces.Box):
+            self._step_channel = _SharedStepChannel(
+                self.single_action_space, n=self.num_envs,
+                info_buffer_size=info_buffer_size, ctx=ctx)
+
         self.parent_pipes, self.processes = [], []
         self.error_queue = ctx.Queue()
         target = _worker_shared_memory if self.shared_memory else _worker
@@ -143,17 +167,20 @@ class AsyncVectorEnv(VectorEnv):
         with clear_mpi_env_vars():
             for idx, env_fn in enumerate(self.env_fns):
                 parent_pipe, child_pipe = ctx.Pipe()
+                args = (
+                    idx,
+                    CloudpickleWrapper(env_fn),
+                    child_pipe,
+                    parent_pipe,
+                    _obs_buffer,
+                    self.error_queue,
+                )
+                if self._step_channel is not None:
+                    args += (self._step_channel,)
                 process = ctx.Process(
                     target=target,
                     name="Worker<{0}>-{1}".format(type(self).__name__, idx),
-                    args=(
-                        idx,
-                        CloudpickleWrapper(env_fn),
-                        child_pipe,
-                        parent_pipe,
-                        _obs_buffer,
-                        self.error_queue,
-                    ),
+                    args=args,
                 )
 
                 self.parent_pipes.append(parent_pipe)
@@ -164,6 +191,8 @@ class AsyncVectorEnv(VectorEnv):
                 child_pipe.close()
 
         self._state = AsyncState.DEFAULT
+        # envs of the pending call
+        self._pending_indices = list(range(self.num_envs))
         self._check_observation_spaces()
 
     def seed(self, seeds=None):
@@ -181,12 +210,47 @@ class AsyncVectorEnv(VectorEnv):
                 self._state.value,
             )
 
-        for pipe, seed in zip(self.parent_pipes, seeds):
-            pipe.send(("seed", seed))
+        for i, seed in enumerate(seeds):
+            self._send(i, ("seed", seed))
         _, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
         self._raise_if_errors(successes)
 
-    def reset_async(self):
+    def _send(self, index, message):
+        if self._step_channel is not None:
+            # wake the worker up, it then reads the pipe
+            self._step_channel.send_command(index, _PIPE)
+        self.parent_pipes[index].send(message)
+
+    def _get_indices(self, indices=None):
+        if indices is None:
+            return list(range(self.num_envs))
+        return [int(i) for i in indices]
+
+    def _get_observations(self, indices):
+        """
+        Observations of the envs in indices, copied unless copy=False
+        and all envs are selected.
+        """
+        if indices == list(range(self.num_envs)):
+            return deepcopy(self.observations) if self.copy else self.observations
+        return _take_rows(self.observations, indices)
+
+    def reset(self, indices=None):
+        """
+        indices: reset only these envs, returns their observations.
+        """
+        self.reset_async(indices=indices)
+        return self.reset_wait()
+
+    def step(self, actions, indices=None):
+        """
+        indices: step only these envs, actions and
+            results are of these envs only.
+        """
+        self.step_async(actions, indices=indices)
+        return self.step_wait()
+
+    def reset_async(self, indices=None):
         self._assert_is_running()
         if self._state != AsyncState.DEFAULT:
             raise AlreadyPendingCallError(
@@ -195,8 +259,9 @@ class AsyncVectorEnv(VectorEnv):
                 self._state.value,
             )
 
-        for pipe in self.parent_pipes:
-            pipe.send(("reset", None))
+        self._pending_indices = self._get_indices(indices)
+        for i in self._pending_indices:
+            self._send(i, ("reset", None))
         self._state = AsyncState.WAITING_RESET
 
     def reset_wait(self, timeout=None):
@@ -225,23 +290,26 @@ class AsyncVectorEnv(VectorEnv):
                 "{0} second{1}.".format(timeout, "s" if timeout > 1 else "")
             )
 
-        results, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
+        indices = self._pending_indices
+        results, successes = zip(*[self.parent_pipes[i].recv() for i in indices])
         self._raise_if_errors(successes)
         self._state = AsyncState.DEFAULT
 
         if not self.shared_memory:
-            self.observations = concatenate(
-                results, self.observations, self.single_observation_space
-            )
+            _put_rows(self.observations, indices, concatenate(results,
+                create_empty_array(self.single_observation_space, n=len(indices), fn=np.zeros),
+                self.single_observation_space))
 
-        return deepcopy(self.observations) if self.copy else self.observations
+        return self._get_observations(indices)
 
-    def step_async(self, actions):
+    def step_async(self, actions, indices=None):
         """
         Parameters
         ----------
         actions : iterable of samples from `action_space`
             List of actions.
+        indices : iterable of int, optional
+            Envs to step, one action per env.
         """
         self._assert_is_running()
         if self._state != AsyncState.DEFAULT:
@@ -251,8 +319,15 @@ class AsyncVectorEnv(VectorEnv):
                 self._state.value,
             )
 
-        for pipe, action in zip(self.parent_pipes, actions):
-            pipe.send(("step", action))
+        self._pending_indices = self._get_indices(indices)
+        assert len(actions) == len(self._pending_indices)
+        if self._step_channel is not None:
+            self._step_channel.put_actions(self._pending_indices, actions)
+            for i in self._pending_indices:
+                self._step_channel.send_command(i, _STEP)
+        else:
+            for i, action in zip(self._pending_indices, actions):
+                self.parent_pipes[i].send(("step", action))
         self._state = AsyncState.WAITING_STEP
 
     def step_wait(self, timeout=None):
@@ -280,25 +355,38 @@ class AsyncVectorEnv(VectorEnv):
                 AsyncState.WAITING_STEP.value,
             )
 
-        if not self._poll(timeout):
+        indices = self._pending_indices
+        if self._step_channel is not None:
+            ready = self._step_channel.wait_results(
+                indices, self.processes, timeout)
+        else:
+            ready = self._poll(timeout)
+        if not ready:
             self._state = AsyncState.DEFAULT
             raise mp.TimeoutError(
                 "The call to `step_wait` has timed out after "
                 "{0} second{1}.".format(timeout, "s" if timeout > 1 else "")
             )
 
-        results, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
+        if self._step_channel is not None:
+            successes, rewards, dones, infos = self._step_channel.get_results(
+                indices, self.parent_pipes)
+            self._raise_if_errors(successes)
+            self._state = AsyncState.DEFAULT
+            return self._get_observations(indices), rewards, dones, infos
+
+        results, successes = zip(*[self.parent_pipes[i].recv() for i in indices])
         self._raise_if_errors(successes)
         self._state = AsyncState.DEFAULT
         observations_list, rewards, dones, infos = zip(*results)
 
         if not self.shared_memory:
-            self.observations = concatenate(
-                observations_list, self.observations, self.single_observation_space
-            )
+            _put_rows(self.observations, indices, concatenate(observations_list,
+                create_empty_array(self.single_observation_space, n=len(indices), fn=np.zeros),
+                self.single_observation_space))
 
         return (
-            deepcopy(self.observations) if self.copy else self.observations,
+            self._get_observations(indices),
             np.array(rewards),
             np.array(dones, dtype=np.bool_),
             infos,
@@ -333,9 +421,9 @@ class AsyncVectorEnv(VectorEnv):
                 if process.is_alive():
                     process.terminate()
         else:
-            for pipe in self.parent_pipes:
+            for i, pipe in enumerate(self.parent_pipes):
                 if (pipe is not None) and (not pipe.closed):
-                    pipe.send(("close", None))
+                    self._send(i, ("close", None))
             for pipe in self.parent_pipes:
                 if (pipe is not None) and (not pipe.closed):
                     pipe.recv()
@@ -352,7 +440,8 @@ class AsyncVectorEnv(VectorEnv):
             return True
         end_time = time.perf_counter() + timeout
         delta = None
-        for pipe in self.parent_pipes:
+        for i in self._pending_indices:
+            pipe = self.parent_pipes[i]
             delta = max(end_time - time.perf_counter(), 0)
             if pipe is None:
                 return False
@@ -362,8 +451,8 @@ class AsyncVectorEnv(VectorEnv):
 
     def _check_observation_spaces(self):
         self._assert_is_running()
-        for pipe in self.parent_pipes:
-            pipe.send(("_check_observation_space", self.single_observation_space))
+        for i in range(self.num_envs):
+            self._send(i, ("_check_observation_space", self.single_observation_space))
         same_spaces, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
         self._raise_if_errors(successes)
         if not all(same_spaces):
@@ -385,7 +474,7 @@ class AsyncVectorEnv(VectorEnv):
         if all(successes):
             return
 
-        num_errors = self.num_envs - sum(successes)
+        num_errors = len(successes) - sum(successes)
         assert num_errors > 0
         for _ in range(num_errors):
             index, exctype, value = self.error_queue.get()
@@ -400,12 +489,13 @@ class AsyncVectorEnv(VectorEnv):
         logger.error("Raising the last exception back to the main process.")
         raise exctype(value)
     
-    def call_async(self, name: str, *args, **kwargs):
+    def call_async(self, name: str, *args, indices=None, **kwargs):
         """Calls the method with name asynchronously and apply args and kwargs to the method.
 
         Args:
             name: Name of the method or property to call.
             *args: Arguments to apply to the method call.
+            indices: Envs to call, defaults to all.
             **kwargs: Keyword arguments to apply to the method call.
 
         Raises:
@@ -420,8 +510,9 @@ class AsyncVectorEnv(VectorEnv):
                 self._state.value,
             )
 
-        for pipe in self.parent_pipes:
-            pipe.send(("_call", (name, args, kwargs)))
+        self._pending_indices = self._get_indices(indices)
+        for i in self._pending_indices:
+            self._send(i, ("_call", (name, args, kwargs)))
         self._state = AsyncState.WAITING_CALL
 
     def call_wait(self, timeout = None) -> list:
@@ -451,32 +542,36 @@ class AsyncVectorEnv(VectorEnv):
                 f"The call to `call_wait` has timed out after {timeout} second(s)."
             )
 
-        results, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
+        results, successes = zip(*[self.parent_pipes[i].recv()
+            for i in self._pending_indices])
         self._raise_if_errors(successes)
         self._state = AsyncState.DEFAULT
 
         return results
 
-    def call(self, name: str, *args, **kwargs):
+    def call(self, name: str, *args, indices=None, **kwargs):
         """Call a method, or get a property, from each parallel environment.
 
         Args:
             name (str): Name of the method or property to call.
             *args: Arguments to apply to the method call.
+            indices: Envs to call, defaults to all.
             **kwargs: Keyword arguments to apply to the method call.
 
         Returns:
             List of the results of the individual calls to the method or property for each environment.
         """
-        self.call_async(name, *args, **kwargs)
+        self.call_async(name, *args, indices=indices, **kwargs)
         return self.call_wait()
     
 
     def call_each(self, name: str, 
             args_list: list=None, 
             kwargs_list: list=None, 
-            timeout = None):
-        n_envs = len(self.parent_pipes)
+            timeout = None,
+            indices = None):
+        indices = self._get_indices(indices)
+        n_envs = len(indices)
         if args_list is None:
             args_list = [[]] * n_envs
         assert len(args_list) == n_envs
@@ -494,8 +589,9 @@ class AsyncVectorEnv(VectorEnv):
                 self._state.value,
             )
 
-        for i, pipe in enumerate(self.parent_pipes):
-            pipe.send(("_call", (name, args_list[i], kwargs_list[i])))
+        self._pending_indices = indices
+        for i, env_idx in enumerate(indices):
+            self._send(env_idx, ("_call", (name, args_list[i], kwargs_list[i])))
         self._state = AsyncState.WAITING_CALL
 
         # receive
@@ -512,7 +608,7 @@ class AsyncVectorEnv(VectorEnv):
                 f"The call to `call_wait` has timed out after {timeout} second(s)."
             )
 
-        results, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
+        results, successes = zip(*[self.parent_pipes[i].recv() for i in indices])
         self._raise_if_errors(successes)
         self._state = AsyncState.DEFAULT
 
@@ -549,14 +645,180 @@ class AsyncVectorEnv(VectorEnv):
                 self._state.value,
             )
 
-        for pipe, value in zip(self.parent_pipes, values):
-            pipe.send(("_setattr", (name, value)))
+        for i, value in enumerate(values):
+            self._send(i, ("_setattr", (name, value)))
         _, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
         self._raise_if_errors(successes)
 
-    def render(self, *args, **kwargs):
-        return self.call('render', *args, **kwargs)
+    def render(self, *args, indices=None, **kwargs):
+        return self.call('render', *args, indices=indices, **kwargs)
+
+
+def _take_rows(observations, indices):
+    if isinstance(observations, dict):
+        return OrderedDict([(key, _take_rows(value, indices))
+            for key, value in observations.items()])
+    elif isinstance(observations, tuple):
+        return tuple(_take_rows(value, indices) for value in observations)
+    return observations[indices]
+
+
+def _put_rows(observations, indices, values):
+    if isinstance(observations, dict):
+        for key, value in observations.items():
+            _put_rows(value, indices, values[key])
+    elif isinstance(observations, tuple):
+        for value, this_values in zip(observations, values):
+            _put_rows(value, indices, this_values)
+    else:
+        observations[indices] = values
+
 
+# commands of _SharedStepChannel
+_IDLE = 0
+_STEP = 1
+_PIPE = 2
+# seconds between checks for dead workers or parent
+_LIVENESS_INTERVAL = 1.0
+
+
+class _SharedStepChannel:
+    """
+    Shared memory actions, rewards, dones and pickled infos of step.
+    The parent wakes a worker with its semaphore after writing its
+    command, workers release a single semaphore of the parent once
+    their step results are written, i.e. one futex each way per env.
+    Views of the buffers are created lazily, after the channel is
+    passed to the workers.
+    """
+    def __init__(self, action_space, n, info_buffer_size, ctx):
+        dtype = action_space.dtype
+        if np.issubdtype(dtype, np.floating):
+            # same precision as actions sent through the pipe
+            dtype = np.dtype(np.float64)
+        self.action_shape = action_space.shape
+        self.action_dtype = dtype
+        self.n = n
+        self.info_buffer_size = info_buffer_size
+
+        self._buffers = dict(
+            actions=ctx.RawArray(dtype.char, n * int(np.prod(self.action_shape))),
+            rewards=ctx.RawArray('d', n),
+            dones=ctx.RawArray('b', n),
+            successes=ctx.RawArray('b', n),
+            commands=ctx.RawArray('b', n),
+            info_lengths=ctx.RawArray('q', n),
+            infos=ctx.RawArray('B', n * info_buffer_size)
+        )
+        self.worker_sems = [ctx.Semaphore(0) for _ in range(n)]
+        self.parent_sem = ctx.Semaphore(0)
+        self._views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_views'] = None
+        return state
+
+    @property
+    def views(self):
+        if self._views is None:
+            dtypes = dict(actions=self.action_dtype, rewards=np.float64,
+                dones=np.bool_, successes=np.bool_, commands=np.int8,
+                info_lengths=np.int64, infos=np.uint8)
+            views = dict((key, np.frombuffer(value, dtype=dtypes[key]))
+                for key, value in self._buffers.items())
+            views['actions'] = views['actions'].reshape(
+                (self.n,) + self.action_shape)
+            views['infos'] = views['infos'].reshape(
+                (self.n, self.info_buffer_size))
+            self._views = views
+        return self._views
+
+    # ========= parent process ==========
+    def send_command(self, index, command):
+        self.views['commands'][index] = command
+        self.worker_sems[index].release()
+
+    def put_actions(self, indices, actions):
+        self.views['actions'][indices] = np.asarray(actions)
+
+    def wait_results(self, indices, processes, timeout=None):
+        """
+        Waits for the step results of indices, False on timeout.
+        """
+        end_time = None
+        if timeout is not None:
+            end_time = time.perf_counter() + timeout
+        n_waiting = len(indices)
+        while n_waiting > 0:
+            delta = _LIVENESS_INTERVAL
+            if end_time is not None:
+                delta = min(max(end_time - time.perf_counter(), 0), delta)
+            if self.parent_sem.acquire(timeout=delta):
+                n_waiting -= 1
+                continue
+            if (end_time is not None) and (time.perf_counter() >= end_time):
+                return False
+            commands = self.views['commands']
+            for i in indices:
+                if (commands[i] == _STEP) and (not processes[i].is_alive()):
+                    raise EOFError("Worker-{0} exited during step.".format(i))
+        return True
+
+    def get_results(self, indices, pipes):
+        views = self.views
+        successes = views['successes'][indices].tolist()
+        infos = list()
+        for i, success in zip(indices, successes):
+            info = None
+            if success:
+                length = views['info_lengths'][i]
+                if length < 0:
+                    # too large for the buffer
+                    info, _ = pipes[i].recv()
+                else:
+                    info = pickle.loads(views['infos'][i, :length].tobytes())
+            infos.append(info)
+        rewards = views['rewards'][indices].copy()
+        dones = views['dones'][indices].copy()
+        return successes, rewards, dones, tuple(infos)
+
+    # ========= worker process ==========
+    def wait_command(self, index, parent_pid):
+        """
+        returns: command of the parent, None if the parent died.
+        """
+        while not self.worker_sems[index].acquire(timeout=_LIVENESS_INTERVAL):
+            if os.getppid() != parent_pid:
+                return None
+        return self.views['commands'][index]
+
+    def get_action(self, index):
+        return self.views['actions'][index].copy()
+
+    def put_result(self, index, pipe, reward, done, info):
+        views = self.views
+        views['rewards'][index] = reward
+        views['dones'][index] = done
+        data = pickle.dumps(info, protocol=pickle.HIGHEST_PROTOCOL)
+        overflow = len(data) > self.info_buffer_size
+        if overflow:
+            views['info_lengths'][index] = -1
+        else:
+            views['infos'][index, :len(data)] = np.frombuffer(data, dtype=np.uint8)
+            views['info_lengths'][index] = len(data)
+        views['successes'][index] = True
+        views['commands'][index] = _IDLE
+        self.parent_sem.release()
+        if overflow:
+            # after the release, the parent reads the pipe once all envs are done
+            pipe.send((info, True))
+
+    def put_error(self, index):
+        views = self.views
+        views['successes'][index] = False
+        views['commands'][index] = _IDLE
+        self.parent_sem.release()
 
 
 def _worker(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
@@ -612,13 +874,31 @@ def _worker(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
         env.close()
 
 
-def _worker_shared_memory(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
+def _worker_shared_memory(index, env_fn, pipe, parent_pipe, shared_memory, error_queue,
+        step_channel=None):
     assert shared_memory is not None
     env = env_fn()
     observation_space = env.observation_space
     parent_pipe.close()
+    parent_pid = os.getppid()
+    stepping = False
     try:
         while True:
+            if step_channel is not None:
+                command = step_channel.wait_command(index, parent_pid)
+                if command is None:
+                    # parent died
+                    break
+                if command == _STEP:
+                    stepping = True
+                    observation, reward, done, info = env.step(
+                        step_channel.get_action(index))
+                    write_to_shared_memory(
+                        index, observation, shared_memory, observation_space
+                    )
+                    step_channel.put_result(index, pipe, reward, done, info)
+                    stepping = False
+                    continue
             command, data = pipe.recv()
             if command == "reset":
                 observation = env.reset()
@@ -666,6 +946,9 @@ def _worker_shared_memory(index, env_fn, pipe, parent_pipe, shared_memory, error
                 )
     except (KeyboardInterrupt, Exception):
         error_queue.put((index,) + sys.exc_info()[:2])
-        pipe.send((None, False))
+        if stepping:
+            step_channel.put_error(index)
+        else:
+            pipe.send((None, False))
     finally:
         env.close()
\ No newline at end of file
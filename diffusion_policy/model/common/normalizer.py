@@ -6,6 +6,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.common.stats_util import get_array_stats
 from diffusion_policy.model.common.dict_of_tensor_mixin import DictOfTensorMixin
 
 
@@ -21,7 +22,9 @@ class LinearNormalizer(DictOfTensorMixin):
         output_max=1.,
         output_min=-1.,
         range_eps=1e-4,
-        fit_offset=True):
+        fit_offset=True,
+        cache_path=None,
+        cache_key=None):
         if isinstance(data, dict):
             for key, value in data.items():
                 self.params_dict[key] =  _fit(value, 
@@ -31,7 +34,9 @@ class LinearNormalizer(DictOfTensorMixin):
                     output_max=output_max,
                     output_min=output_min,
                     range_eps=range_eps,
-                    fit_offset=fit_offset)
+                    fit_offset=fit_offset,
+                    cache_path=cache_path,
+                    cache_key=None if cache_key is None else f'{cache_key}/{key}')
         else:
             self.params_dict['_default'] = _fit(data, 
                     last_n_dims=last_n_dims,
@@ -40,7 +45,9 @@ class LinearNormalizer(DictOfTensorMixin):
                     output_max=output_max,
                     output_min=output_min,
                     range_eps=range_eps,
-                    fit_offset=fit_offset)
+                    fit_offset=fit_offset,
+                    cache_path=cache_path,
+                    cache_key=cache_key)
     
     def __call__(self, x: Union[Dict, torch.Tensor, np.ndarray]) -> torch.Tensor:
         return self.normalize(x)
@@ -110,7 +117,9 @@ class SingleFieldLinearNormalizer(DictOfTensorMixin):
             output_max=1.,
             output_min=-1.,
             range_eps=1e-4,
-            fit_offset=True):
+            fit_offset=True,
+            cache_path=None,
+            cache_key=None):
         self.params_dict = _fit(data, 
             last_n_dims=last_n_dims,
             dtype=dtype,
@@ -118,7 +127,9 @@ class SingleFieldLinearNormalizer(DictOfTensorMixin):
             output_max=output_max,
             output_min=output_min,
             range_eps=range_eps,
-            fit_offset=fit_offset)
+            fit_offset=fit_offset,
+            cache_path=cache_path,
+            cache_key=cache_key)
     
     @classmethod
     def create_fit(cls, data: Union[torch.Tensor, np.ndarray, zarr.Array], **kwargs):
@@ -186,30 +197,43 @@ def _fit(data: Union[torch.Tensor, np.ndarray, zarr.Array],
         output_max=1.,
         output_min=-1.,
         range_eps=1e-4,
-        fit_offset=True):
+        fit_offset=True,
+        cache_path=None,
+        cache_key=None):
     assert mode in ['limits', 'gaussian']
     assert last_n_dims >= 0
     assert output_max > output_min
 
-    # convert data to torch and type
-    if isinstance(data, zarr.Array):
-        data = data[:]
-    if isinstance(data, np.ndarray):
-        data = torch.from_numpy(data)
-    if dtype is not None:
-        data = data.type(dtype)
-
-    # convert shape
-    dim = 1
-    if last_n_dims > 0:
-        dim = np.prod(data.shape[-last_n_dims:])
-    data = data.reshape(-1,dim)
-
-    # compute input stats min max mean std
-    input_min, _ = data.min(axis=0)
-    input_max, _ = data.max(axis=0)
-    input_mean = data.mean(axis=0)
-    input_std = data.std(axis=0)
+    if isinstance(data, (zarr.Array, np.memmap)) or (cache_path is not None):
+        # chunked, without a full float copy of data
+        if isinstance(data, torch.Tensor):
+            data = data.numpy()
+        stats = get_array_stats(data, cache_path=cache_path, cache_key=cache_key,
+            last_n_dims=last_n_dims, ddof=1)
+        stats = dict_apply(stats, lambda x: torch.from_numpy(x).type(
+            dtype if dtype is not None else torch.float32))
+        input_min = stats['min']
+        input_max = stats['max']
+        input_mean = stats['mean']
+        input_std = stats['std']
+    else:
+        # convert data to torch and type
+        if isinstance(data, np.ndarray):
+            data = torch.from_numpy(data)
+        if dtype is not None:
+            data = data.type(dtype)
+
+        # convert shape
+        dim = 1
+        if last_n_dims > 0:
+            dim = np.prod(data.shape[-last_n_dims:])
+        data = data.reshape(-1,dim)
+
+        # compute input stats min max mean std
+        input_min, _ = data.min(axis=0)
+        input_max, _ = data.max(axis=0)
+        input_mean = data.mean(axis=0)
+        input_std = data.std(axis=0)
 
     # compute scale and offset
     if mode == 'limits':
@@ -2,6 +2,7 @@ from typing import Union
 import logging
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import einops
 from einops.layers.torch import Rearrange
 
@@ -43,16 +44,19 @@ class ConditionalResidualBlock1D(nn.Module):
         self.residual_conv = nn.Conv1d(in_channels, out_channels, 1) \
             if in_channels != out_channels else nn.Identity()
 
-    def forward(self, x, cond):
+    def forward(self, x, cond, embed=None):
         '''
             x : [ batch_size x in_channels x horizon ]
             cond : [ batch_size x cond_dim]
+            embed : [ batch_size x cond_channels x 1], 
+                precomputed cond_encoder(cond), overrides cond
 
             returns:
             out : [ batch_size x out_channels x horizon ]
         '''
         out = self.blocks[0](x)
-        embed = self.cond_encoder(cond)
+        if embed is None:
+            embed = self.cond_encoder(cond)
         if self.cond_predict_scale:
             embed = embed.reshape(
                 embed.shape[0], 2, self.out_channels, 1)
@@ -160,6 +164,7 @@ class ConditionalUnet1D(nn.Module):
             nn.Conv1d(start_dim, input_dim, 1),
         )
 
+        self.diffusion_step_embed_dim = dsed
         self.diffusion_step_encoder = diffusion_step_encoder
         self.local_cond_encoder = local_cond_encoder
         self.up_modules = up_modules
@@ -170,30 +175,89 @@ class ConditionalUnet1D(nn.Module):
             "number of parameters: %e", sum(p.numel() for p in self.parameters())
         )
 
+    def encode_timestep(self, timesteps: torch.Tensor):
+        """
+        timesteps: (N,)
+        output: (N,diffusion_step_embed_dim)
+        """
+        return self.diffusion_step_encoder(timesteps)
+
+    def _get_cond_blocks(self):
+        blocks = list()
+        if self.local_cond_encoder is not None:
+            blocks.extend(self.local_cond_encoder)
+        for resnet, resnet2, _ in self.down_modules:
+            blocks.extend([resnet, resnet2])
+        blocks.extend(self.mid_modules)
+        for resnet, resnet2, _ in self.up_modules:
+            blocks.extend([resnet, resnet2])
+        return blocks
+
+    def encode_global_cond(self, global_cond: torch.Tensor):
+        """
+        Precompute the global_cond part of every FiLM cond_encoder,
+        which is constant over all denoising steps of a sample.
+        cond_encoder is Linear(Mish(cat([timestep_feature, global_cond]))),
+        Mish is elementwise, so the Linear splits into a timestep
+        and a global_cond term.
+        global_cond: (B,global_cond_dim)
+        output: list of (B,cond_channels), pass as forward(cond_cache=...)
+        """
+        dsed = self.diffusion_step_embed_dim
+        global_cond = F.mish(global_cond)
+        cond_cache = list()
+        for block in self._get_cond_blocks():
+            linear = block.cond_encoder[1]
+            cond_cache.append(F.linear(
+                global_cond, linear.weight[:,dsed:], linear.bias))
+        return cond_cache
+
     def forward(self, 
             sample: torch.Tensor, 
             timestep: Union[torch.Tensor, float, int], 
-            local_cond=None, global_cond=None, **kwargs):
+            local_cond=None, global_cond=None, 
+            timestep_emb=None, cond_cache=None, **kwargs):
         """
         x: (B,T,input_dim)
         timestep: (B,) or int, diffusion step
         local_cond: (B,T,local_cond_dim)
         global_cond: (B,global_cond_dim)
+        timestep_emb: (diffusion_step_embed_dim,) or (B,diffusion_step_embed_dim), 
+            precomputed encode_timestep(timestep), overrides timestep
+        cond_cache: encode_global_cond(global_cond), 
+            FiLM only computes the timestep term
         output: (B,T,input_dim)
         """
         sample = einops.rearrange(sample, 'b h t -> b t h')
 
         # 1. time
-        timesteps = timestep
-        if not torch.is_tensor(timesteps):
-            # TODO: this requires sync between CPU and GPU. So try to pass timesteps as tensors if you can
-            timesteps = torch.tensor([timesteps], dtype=torch.long, device=sample.device)
-        elif torch.is_tensor(timesteps) and len(timesteps.shape) == 0:
-            timesteps = timesteps[None].to(sample.device)
-        # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
-        timesteps = timesteps.expand(sample.shape[0])
+        if timestep_emb is not None:
+            global_feature = timestep_emb.expand(sample.shape[0], -1)
+        else:
+            timesteps = timestep
+            if not torch.is_tensor(timesteps):
+                # TODO: this requires sync between CPU and GPU. So try to pass timesteps as tensors if you can
+                timesteps = torch.tensor([timesteps], dtype=torch.long, device=sample.device)
+            elif torch.is_tensor(timesteps) and len(timesteps.shape) == 0:
+                timesteps = timesteps[None].to(sample.device)
+            # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
+            timesteps = timesteps.expand(sample.shape[0])
 
-        global_feature = self.diffusion_step_encoder(timesteps)
+            global_feature = self.diffusion_step_encoder(timesteps)
+
+        film_embeds = None
+        if cond_cache is not None:
+            # FiLM embeddings, global_cond term from cond_cache
+            dsed = self.diffusion_step_embed_dim
+            time_feature = F.mish(global_feature)
+            film_embeds = dict()
+            for block, cached in zip(self._get_cond_blocks(), cond_cache):
+                linear = block.cond_encoder[1]
+                embed = F.linear(time_feature, linear.weight[:,:dsed]) + cached
+                film_embeds[block] = embed.unsqueeze(-1)
+        
+        def film(block):
+            return None if film_embeds is None else film_embeds[block]
 
         if global_cond is not None:
             global_feature = torch.cat([
@@ -205,34 +269,34 @@ class ConditionalUnet1D(nn.Module):
         if local_cond is not None:
             local_cond = einops.rearrange(local_cond, 'b h t -> b t h')
             resnet, resnet2 = self.local_cond_encoder
-            x = resnet(local_cond, global_feature)
+            x = resnet(local_cond, global_feature, film(resnet))
             h_local.append(x)
-            x = resnet2(local_cond, global_feature)
+            x = resnet2(local_cond, global_feature, film(resnet2))
             h_local.append(x)
         
         x = sample
         h = []
         for idx, (resnet, resnet2, downsample) in enumerate(self.down_modules):
-            x = resnet(x, global_feature)
+            x = resnet(x, global_feature, film(resnet))
             if idx == 0 and len(h_local) > 0:
                 x = x + h_local[0]
-            x = resnet2(x, global_feature)
+            x = resnet2(x, global_feature, film(resnet2))
             h.append(x)
             x = downsample(x)
 
         for mid_module in self.mid_modules:
-            x = mid_module(x, global_feature)
+            x = mid_module(x, global_feature, film(mid_module))
 
         for idx, (resnet, resnet2, upsample) in enumerate(self.up_modules):
             x = torch.cat((x, h.pop()), dim=1)
-            x = resnet(x, global_feature)
+            x = resnet(x, global_feature, film(resnet))
             # The correct condition should be:
             # if idx == (len(self.up_modules)-1) and len(h_local) > 0:
             # However this change will break compatibility with published checkpoints.
             # Therefore it is left as a comment.
             if idx == len(self.up_modules) and len(h_local) > 0:
                 x = x + h_local[1]
-            x = resnet2(x, global_feature)
+            x = resnet2(x, global_feature, film(resnet2))
             x = upsample(x)
 
         x = self.final_conv(x)
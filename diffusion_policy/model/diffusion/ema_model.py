@@ -1,7 +1,17 @@
 import copy
+import collections
 import torch
 from torch.nn.modules.batchnorm import _BatchNorm
 
+
+def _foreach_copy_(dst, src):
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(dst, src)
+    else:
+        torch._foreach_zero_(dst)
+        torch._foreach_add_(dst, src)
+
+
 class EMAModel:
     """
     Exponential Moving Average of models weights
@@ -14,7 +24,9 @@ class EMAModel:
         inv_gamma=1.0,
         power=2 / 3,
         min_value=0.0,
-        max_value=0.9999
+        max_value=0.9999,
+        update_every=1,
+        device=None
     ):
         """
         @crowsonkb's notes on EMA Warmup:
@@ -26,6 +38,11 @@ class EMAModel:
             inv_gamma (float): Inverse multiplicative factor of EMA warmup. Default: 1.
             power (float): Exponential factor of EMA warmup. Default: 2/3.
             min_value (float): The minimum EMA decay rate. Default: 0.
+            update_every (int): Update the averaged weights every n steps, using the
+                product of the decays of these steps. Default: 1.
+            device: Keep the averaged weights on this device (e.g. 'cpu') to save
+                accelerator memory. Moved back on the next update if moved for eval.
+                Default: None, same as the model.
         """
 
         self.averaged_model = model
@@ -37,9 +54,17 @@ class EMAModel:
         self.power = power
         self.min_value = min_value
         self.max_value = max_value
+        self.update_every = update_every
+        self.device = None if device is None else torch.device(device)
 
         self.decay = 0.0
+        # product of decays since the last update
+        self.pending_decay = 1.0
         self.optimization_step = 0
+        # parameters grouped by device and dtype, see _get_groups
+        self._groups = None
+        self._signature = None
+        self._host_buffers = dict()
 
     def get_decay(self, optimization_step):
         """
@@ -53,36 +78,70 @@ class EMAModel:
 
         return max(self.min_value, min(value, self.max_value))
 
-    @torch.no_grad()
-    def step(self, new_model):
-        self.decay = self.get_decay(self.optimization_step)
-
-        # old_all_dataptrs = set()
-        # for param in new_model.parameters():
-        #     data_ptr = param.data_ptr()
-        #     if data_ptr != 0:
-        #         old_all_dataptrs.add(data_ptr)
-
-        all_dataptrs = set()
-        for module, ema_module in zip(new_model.modules(), self.averaged_model.modules()):            
+    def _build_groups(self, new_model):
+        # (is_copy, ema device, ema dtype, model device, model dtype): (ema params, model params)
+        groups = collections.defaultdict(lambda: (list(), list()))
+        for module, ema_module in zip(new_model.modules(), self.averaged_model.modules()):
             for param, ema_param in zip(module.parameters(recurse=False), ema_module.parameters(recurse=False)):
                 # iterative over immediate parameters only.
                 if isinstance(param, dict):
                     raise RuntimeError('Dict parameter not supported')
-                
-                # data_ptr = param.data_ptr()
-                # if data_ptr != 0:
-                #     all_dataptrs.add(data_ptr)
-
-                if isinstance(module, _BatchNorm):
-                    # skip batchnorms
-                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
-                elif not param.requires_grad:
-                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
-                else:
-                    ema_param.mul_(self.decay)
-                    ema_param.add_(param.data.to(dtype=ema_param.dtype), alpha=1 - self.decay)
-
-        # verify that iterating over module and then parameters is identical to parameters recursively.
-        # assert old_all_dataptrs == all_dataptrs
+                if (self.device is not None) and (ema_param.device != self.device):
+                    ema_param.data = ema_param.data.to(self.device)
+                # skip batchnorms and frozen parameters
+                is_copy = isinstance(module, _BatchNorm) or (not param.requires_grad)
+                key = (is_copy, ema_param.device, ema_param.dtype, param.device, param.dtype)
+                ema_params, params = groups[key]
+                # parameter objects stay valid when .data is replaced
+                ema_params.append(ema_param)
+                params.append(param)
+        self._groups = dict(groups)
+        self._host_buffers = dict()
+        self._signature = self._get_signature()
+
+    def _get_signature(self):
+        # changes when either model is moved or cast
+        return [(e[0].device, e[0].dtype, p[0].device, p[0].dtype)
+            for e, p in self._groups.values()]
+
+    def _get_groups(self, new_model):
+        if (self._groups is None) or (self._get_signature() != self._signature):
+            self._build_groups(new_model)
+        return self._groups
+
+    def _gather(self, key, ema_params, params):
+        """
+        Model params as tensors on the device and dtype of ema_params,
+        through a single flat copy.
+        """
+        _, ema_device, ema_dtype, _, _ = key
+        flat = torch.cat([p.reshape(-1) for p in params]).to(dtype=ema_dtype)
+        if key not in self._host_buffers:
+            buffer = torch.empty(flat.shape, dtype=ema_dtype, device=ema_device,
+                pin_memory=(ema_device.type == 'cpu') and (flat.device.type == 'cuda'))
+            views = [v.view(e.shape) for v, e in zip(
+                buffer.split([e.numel() for e in ema_params]), ema_params)]
+            self._host_buffers[key] = (buffer, views)
+        buffer, views = self._host_buffers[key]
+        buffer.copy_(flat)
+        return views
+
+    @torch.no_grad()
+    def step(self, new_model):
+        self.decay = self.get_decay(self.optimization_step)
+        self.pending_decay *= self.decay
         self.optimization_step += 1
+        if (self.optimization_step % self.update_every) != 0:
+            return
+        decay = self.pending_decay
+        self.pending_decay = 1.0
+
+        for key, (ema_params, params) in self._get_groups(new_model).items():
+            is_copy, ema_device, ema_dtype, device, dtype = key
+            if (ema_device != device) or (ema_dtype != dtype):
+                params = self._gather(key, ema_params, params)
+            if is_copy:
+                _foreach_copy_(ema_params, params)
+            else:
+                torch._foreach_mul_(ema_params, decay)
+                torch._foreach_add_(ema_params, params, alpha=1 - decay)
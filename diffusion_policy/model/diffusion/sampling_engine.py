@@ -0,0 +1,254 @@
+from typing import Optional
+import time
+import math
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class DiffusionSamplingEngine:
+    """
+    Shared reverse diffusion loop for the diffusion policies.
+
+    solver:
+        'scheduler': step with the given diffusers noise_scheduler,
+            identical to calling scheduler.step in a loop.
+        'ddim': deterministic (eta=0) or stochastic DDIM.
+        'dpmsolver++': 2nd order multistep DPM-Solver++,
+            good samples in 10-20 steps.
+    'ddim' and 'dpmsolver++' only use alphas_cumprod and the
+    prediction_type/clip_sample config of the noise_scheduler,
+    so they work with models trained with any diffusers scheduler.
+
+    Timesteps, solver coefficients and, for models with
+    encode_timestep, the timestep embeddings are computed once per
+    num_inference_steps and reused until the model weights change.
+    The timestep embeddings are also reused with solver='scheduler'.
+    """
+    def __init__(self,
+            noise_scheduler,
+            solver: str='scheduler',
+            eta: float=0.0,
+            record_latency: bool=False):
+        """
+        record_latency: synchronize and record per-step wall time
+            of the last sample() call in self.step_latencies.
+        """
+        assert solver in ('scheduler', 'ddim', 'dpmsolver++')
+        self.noise_scheduler = noise_scheduler
+        self.solver = solver
+        self.eta = eta
+        self.record_latency = record_latency
+        self.step_latencies = list()
+        # num_inference_steps: (timesteps, coefficients)
+        self._schedule_cache = dict()
+        # (num_inference_steps, device, dtype): (param versions, embeddings)
+        self._emb_cache = dict()
+
+    # ========= schedule ============
+    def get_schedule(self, num_inference_steps: int):
+        """
+        Returns (timesteps, coefs), timesteps is a 1D np.ndarray
+        and coefs a list of per-step dicts of python floats.
+        """
+        if num_inference_steps in self._schedule_cache:
+            return self._schedule_cache[num_inference_steps]
+
+        scheduler = self.noise_scheduler
+        if self.solver == 'scheduler':
+            scheduler.set_timesteps(num_inference_steps)
+            timesteps = scheduler.timesteps.cpu().numpy().astype(np.int64)
+            result = (timesteps, None)
+            self._schedule_cache[num_inference_steps] = result
+            return result
+
+        num_train_timesteps = scheduler.config.num_train_timesteps
+        assert num_inference_steps <= num_train_timesteps
+        if num_inference_steps < num_train_timesteps:
+            # num_inference_steps + 1 evenly spaced points from T-1 to 0,
+            # dropping 0 since the last step goes to the clean sample.
+            timesteps = np.linspace(0, num_train_timesteps - 1,
+                num_inference_steps + 1).round()[::-1][:-1].astype(np.int64)
+        else:
+            timesteps = np.arange(num_train_timesteps)[::-1].astype(np.int64)
+        alphas_cumprod = scheduler.alphas_cumprod.cpu().numpy().astype(np.float64)
+
+        # last step goes to the clean sample, alpha=1 sigma=0
+        acp = list(alphas_cumprod[timesteps]) + [1.0]
+        alpha = [math.sqrt(a) for a in acp]
+        sigma = [math.sqrt(1 - a) for a in acp]
+        lmbda = [math.log(a / s) if s > 0 else math.inf
+            for a, s in zip(alpha, sigma)]
+
+        coefs = list()
+        for i in range(num_inference_steps):
+            c = {
+                'alpha_s': alpha[i],
+                'sigma_s': sigma[i],
+                'alpha_t': alpha[i+1],
+                'sigma_t': sigma[i+1]
+            }
+            if self.solver == 'ddim':
+                # sigma of the added noise, zero for eta=0
+                eta_sigma = 0.0
+                if self.eta > 0 and (i + 1) < num_inference_steps:
+                    eta_sigma = self.eta * math.sqrt(
+                        (1 - acp[i+1]) / (1 - acp[i]) * (1 - acp[i] / acp[i+1]))
+                c['eta_sigma'] = eta_sigma
+                c['dir_coef'] = math.sqrt(max(1 - acp[i+1] - eta_sigma**2, 0.0))
+            else:
+                h = lmbda[i+1] - lmbda[i]
+                # x_t = sigma_t/sigma_s * x_s - alpha_t * (exp(-h) - 1) * D
+                c['x_coef'] = sigma[i+1] / sigma[i]
+                c['d_coef'] = -alpha[i+1] * (math.exp(-h) - 1)
+                # second order correction, first order on first and last step
+                c['r_inv'] = None
+                if (0 < i) and (i + 1 < num_inference_steps):
+                    h_prev = lmbda[i] - lmbda[i-1]
+                    c['r_inv'] = h / h_prev
+            coefs.append(c)
+        result = (timesteps, coefs)
+        self._schedule_cache[num_inference_steps] = result
+        return result
+
+    def get_timestep_embeddings(self, model: nn.Module,
+            num_inference_steps: int, device, dtype):
+        """
+        (num_inference_steps, D) embeddings of the schedule's timesteps,
+        or None if the model doesn't support encode_timestep.
+        """
+        if not hasattr(model, 'encode_timestep'):
+            return None
+        key = (num_inference_steps, str(device), dtype)
+        # in-place updates (optimizer, EMA, load_state_dict) bump _version
+        versions = tuple(p._version for p in model.parameters())
+        cached = self._emb_cache.get(key)
+        if (cached is not None) and (cached[0] == versions) and (not model.training):
+            return cached[1]
+
+        timesteps, _ = self.get_schedule(num_inference_steps)
+        with torch.no_grad():
+            emb = model.encode_timestep(
+                torch.from_numpy(timesteps).to(device=device))
+        emb = emb.to(dtype=dtype)
+        self._emb_cache[key] = (versions, emb)
+        return emb
+
+    # ========= sampling ============
+    def _predict_x0(self, model_output, sample, c):
+        config = self.noise_scheduler.config
+        pred_type = config.prediction_type
+        if pred_type == 'epsilon':
+            x0 = (sample - c['sigma_s'] * model_output) / c['alpha_s']
+        elif pred_type == 'sample':
+            x0 = model_output
+        elif pred_type == 'v_prediction':
+            x0 = c['alpha_s'] * sample - c['sigma_s'] * model_output
+        else:
+            raise ValueError(f"Unsupported prediction_type {pred_type}")
+        if config.get('clip_sample', False):
+            clip_range = config.get('clip_sample_range', 1.0)
+            x0 = x0.clamp(-clip_range, clip_range)
+        return x0
+
+    def sample(self,
+            model: nn.Module,
+            condition_data: torch.Tensor,
+            condition_mask: torch.Tensor,
+            num_inference_steps: int,
+            model_kwargs: Optional[dict]=None,
+            generator: Optional[torch.Generator]=None,
+            # keyword arguments to scheduler.step
+            **kwargs
+            ) -> torch.Tensor:
+        """
+        model is called as model(trajectory, t, **model_kwargs)
+        """
+        if model_kwargs is None:
+            model_kwargs = dict()
+        scheduler = self.noise_scheduler
+        device = condition_data.device
+        timesteps, coefs = self.get_schedule(num_inference_steps)
+        embs = self.get_timestep_embeddings(model, num_inference_steps,
+            device=device, dtype=condition_data.dtype)
+        # on cpu, like scheduler.timesteps
+        t_tensors = torch.from_numpy(timesteps)
+        if self.solver == 'scheduler':
+            # schedulers can keep per-sample state (e.g. multistep)
+            scheduler.set_timesteps(num_inference_steps)
+
+        trajectory = torch.randn(
+            size=condition_data.shape,
+            dtype=condition_data.dtype,
+            device=device,
+            generator=generator)
+
+        step_latencies = list()
+        prev_x0 = None
+        for i in range(len(timesteps)):
+            if self.record_latency:
+                self._synchronize(device)
+                start_time = time.monotonic()
+            t = t_tensors[i]
+
+            # 1. apply conditioning
+            trajectory[condition_mask] = condition_data[condition_mask]
+
+            # 2. predict model output
+            if embs is not None:
+                model_output = model(trajectory, t,
+                    timestep_emb=embs[i], **model_kwargs)
+            else:
+                model_output = model(trajectory, t, **model_kwargs)
+
+            # 3. compute previous image: x_t -> x_t-1
+            if self.solver == 'scheduler':
+                trajectory = scheduler.step(
+                    model_output, t, trajectory,
+                    generator=generator,
+                    **kwargs
+                    ).prev_sample
+            else:
+                c = coefs[i]
+                x0 = self._predict_x0(model_output, trajectory, c)
+                if self.solver == 'ddim':
+                    eps = (trajectory - c['alpha_s'] * x0) / c['sigma_s']
+                    trajectory = c['alpha_t'] * x0 + c['dir_coef'] * eps
+                    if c['eta_sigma'] > 0:
+                        noise = torch.randn(
+                            size=trajectory.shape,
+                            dtype=trajectory.dtype,
+                            device=device,
+                            generator=generator)
+                        trajectory = trajectory + c['eta_sigma'] * noise
+                else:
+                    d = x0
+                    if c['r_inv'] is not None:
+                        d = x0 + 0.5 * c['r_inv'] * (x0 - prev_x0)
+                    trajectory = c['x_coef'] * trajectory + c['d_coef'] * d
+                    prev_x0 = x0
+
+            if self.record_latency:
+                self._synchronize(device)
+                step_latencies.append(time.monotonic() - start_time)
+
+        # finally make sure conditioning is enforced
+        trajectory[condition_mask] = condition_data[condition_mask]
+        self.step_latencies = step_latencies
+        return trajectory
+
+    def get_latency_stats(self) -> dict:
+        latencies = np.array(self.step_latencies)
+        if len(latencies) == 0:
+            return dict()
+        return {
+            'n_steps': len(latencies),
+            'total': float(latencies.sum()),
+            'mean_step': float(latencies.mean()),
+            'max_step': float(latencies.max())
+        }
+
+    @staticmethod
+    def _synchronize(device):
+        if torch.device(device).type == 'cuda':
+            torch.cuda.synchronize(device)
@@ -267,26 +267,39 @@ class TransformerForDiffusion(ModuleAttrMixin):
         )
         return optimizer
 
+    def encode_timestep(self, timesteps: torch.Tensor):
+        """
+        timesteps: (N,)
+        output: (N,n_emb)
+        """
+        return self.time_emb(timesteps)
+
     def forward(self, 
         sample: torch.Tensor, 
         timestep: Union[torch.Tensor, float, int], 
-        cond: Optional[torch.Tensor]=None, **kwargs):
+        cond: Optional[torch.Tensor]=None, 
+        timestep_emb: Optional[torch.Tensor]=None, **kwargs):
         """
         x: (B,T,input_dim)
         timestep: (B,) or int, diffusion step
         cond: (B,T',cond_dim)
+        timestep_emb: (n_emb,) or (B,n_emb), 
+            precomputed encode_timestep(timestep), overrides timestep
         output: (B,T,input_dim)
         """
         # 1. time
-        timesteps = timestep
-        if not torch.is_tensor(timesteps):
-            # TODO: this requires sync between CPU and GPU. So try to pass timesteps as tensors if you can
-            timesteps = torch.tensor([timesteps], dtype=torch.long, device=sample.device)
-        elif torch.is_tensor(timesteps) and len(timesteps.shape) == 0:
-            timesteps = timesteps[None].to(sample.device)
-        # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
-        timesteps = timesteps.expand(sample.shape[0])
-        time_emb = self.time_emb(timesteps).unsqueeze(1)
+        if timestep_emb is not None:
+            time_emb = timestep_emb.expand(sample.shape[0], -1).unsqueeze(1)
+        else:
+            timesteps = timestep
+            if not torch.is_tensor(timesteps):
+                # TODO: this requires sync between CPU and GPU. So try to pass timesteps as tensors if you can
+                timesteps = torch.tensor([timesteps], dtype=torch.long, device=sample.device)
+            elif torch.is_tensor(timesteps) and len(timesteps.shape) == 0:
+                timesteps = timesteps[None].to(sample.device)
+            # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
+            timesteps = timesteps.expand(sample.shape[0])
+            time_emb = self.time_emb(timesteps).unsqueeze(1)
         # (B,1,n_emb)
 
         # process input
@@ -1,6 +1,5 @@
 import torch
 import torch.nn as nn
-import torchvision.transforms.functional as ttf
 import diffusion_policy.model.common.tensor_util as tu
 
 class CropRandomizer(nn.Module):
@@ -96,8 +95,11 @@ class CropRandomizer(nn.Module):
             return tu.join_dimensions(out, 0, 1)
         else:
             # take center crop during eval
-            out = ttf.center_crop(img=inputs, output_size=(
-                self.crop_height, self.crop_width))
+            # slice with python ints, torchvision center_crop fails under jit.trace
+            h, w = int(inputs.shape[-2]), int(inputs.shape[-1])
+            top = int(round((h - self.crop_height) / 2.0))
+            left = int(round((w - self.crop_width) / 2.0))
+            out = inputs[...,top:top+self.crop_height,left:left+self.crop_width]
             if self.num_crops > 1:
                 B,C,H,W = out.shape
                 out = out.unsqueeze(1).expand(B,self.num_crops,C,H,W).reshape(-1,C,H,W)
@@ -0,0 +1,104 @@
+"""
+Precomputed features of a frozen vision backbone.
+
+With training.freeze_encoder, the backbone features of each frame never
+change. They are computed once in eval mode (deterministic crop) over the
+ReplayBuffer image keys and stored as low-dim arrays <key>_feature,
+which the dataset returns instead of images and MultiImageObsEncoder
+uses instead of running the backbone.
+Cached in <cache_dir>/<encoder hash>.zarr.zip, keyed by the encoder
+weights and the image normalizer.
+"""
+from typing import Dict, Optional, Sequence
+import os
+import copy
+import pathlib
+import hashlib
+import numpy as np
+import torch
+import torch.nn as nn
+import zarr
+from filelock import FileLock
+from diffusion_policy.common.memmap_util import _iter_row_slices
+
+
+def get_feature_key(key: str) -> str:
+    return key + '_feature'
+
+
+def hash_encoder(obs_encoder: nn.Module, normalizer, keys: Sequence[str]) -> str:
+    h = hashlib.sha1()
+    for module in [obs_encoder] + [normalizer[key] for key in keys]:
+        for name, value in module.state_dict().items():
+            h.update(name.encode())
+            h.update(value.detach().to('cpu').contiguous().numpy().tobytes())
+    h.update(repr(sorted(keys)).encode())
+    h.update(repr(obs_encoder.key_transform_map).encode())
+    return h.hexdigest()
+
+
+@torch.no_grad()
+def compute_rgb_features(arrays: Dict[str, 'zarr.Array'], obs_encoder: nn.Module,
+        normalizer, batch_size: int=256, device=None,
+        max_block_bytes: int=2**27) -> Dict[str, np.ndarray]:
+    """
+    arrays: key: T,H,W,C uint8 images
+    device: obs_encoder and normalizer are moved there
+        while computing, the encoder is moved back after.
+    returns: key: T,D float32 features
+    """
+    encoder_device = obs_encoder.device
+    if device is None:
+        device = encoder_device
+    was_training = obs_encoder.training
+    obs_encoder.eval()
+    obs_encoder.to(device)
+    result = dict()
+    try:
+        for key, arr in arrays.items():
+            # copy, keeps the caller's normalizer where it was
+            key_normalizer = copy.deepcopy(normalizer[key]).to(device)
+            feature_blocks = list()
+            for row_slice in _iter_row_slices(arr, max_bytes=max_block_bytes):
+                block = arr[row_slice]
+                for start in range(0, len(block), batch_size):
+                    img = torch.from_numpy(block[start:start+batch_size]).to(device)
+                    img = torch.moveaxis(img,-1,-3).to(torch.float32) / 255.
+                    img = key_normalizer.normalize(img)
+                    feature = obs_encoder.encode_rgb(key, img)
+                    feature_blocks.append(feature.to('cpu').numpy().astype(np.float32))
+            result[key] = np.concatenate(feature_blocks, axis=0)
+    finally:
+        obs_encoder.train(was_training)
+        obs_encoder.to(encoder_device)
+    return result
+
+
+def get_rgb_features(arrays: Dict[str, 'zarr.Array'], obs_encoder: nn.Module,
+        normalizer, cache_dir: Optional[str]=None, **kwargs) -> Dict[str, np.ndarray]:
+    """
+    compute_rgb_features, persisted in cache_dir if given.
+    """
+    if cache_dir is None:
+        return compute_rgb_features(arrays, obs_encoder, normalizer, **kwargs)
+
+    cache_dir = pathlib.Path(os.path.expanduser(cache_dir))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    digest = hash_encoder(obs_encoder, normalizer, list(arrays.keys()))
+    cache_path = cache_dir.joinpath(digest + '.zarr.zip')
+    with FileLock(str(cache_path) + '.lock'):
+        if cache_path.is_file():
+            print('Loading cached features from Disk.')
+            with zarr.ZipStore(str(cache_path), mode='r') as zip_store:
+                group = zarr.group(zip_store)
+                return {key: group[key][:] for key in arrays.keys()}
+
+        print('Computing features of frozen encoder.')
+        features = compute_rgb_features(arrays, obs_encoder, normalizer, **kwargs)
+        tmp_path = str(cache_path) + '.tmp'
+        with zarr.ZipStore(tmp_path, mode='w') as zip_store:
+            group = zarr.group(zip_store)
+            for key, value in features.items():
+                group.array(key, value, chunks=(max(min(len(value), 4096), 1), value.shape[-1]))
+        os.replace(tmp_path, cache_path)
+    return features
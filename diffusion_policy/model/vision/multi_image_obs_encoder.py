@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 import torchvision
 from diffusion_policy.model.vision.crop_randomizer import CropRandomizer
+from diffusion_policy.model.vision.feature_cache import get_feature_key
 from diffusion_policy.model.common.module_attr_mixin import ModuleAttrMixin
 from diffusion_policy.common.pytorch_util import dict_apply, replace_submodules
 
@@ -185,14 +186,34 @@ class MultiImageObsEncoder(ModuleAttrMixin):
         self.rgbd_keys = rgbd_keys
         self.key_shape_map = key_shape_map
 
+    def encode_rgb(self, key, img):
+        """
+        img: B,C,H,W normalized image of rgb key
+        returns: B,D backbone features
+        """
+        assert img.shape[1:] == self.key_shape_map[key]
+        img = self.key_transform_map[key](img)
+        model_key = 'rgb' if self.share_rgb_model else key
+        feature = self.key_model_map[model_key](img)
+        return feature.reshape(img.shape[0],-1)
+
     def forward(self, obs_dict):
         batch_size = None
         features = list()
+        # precomputed backbone features (see feature_cache) replace images
+        rgb_features = dict()
+        for key in self.rgb_keys:
+            feature_key = get_feature_key(key)
+            if feature_key in obs_dict:
+                rgb_features[key] = obs_dict[feature_key]
+                batch_size = obs_dict[feature_key].shape[0]
+        image_keys = [key for key in self.rgb_keys if key not in rgb_features]
+
         # process rgb input
-        if self.share_rgb_model:
+        if self.share_rgb_model and (len(image_keys) > 0):
             # pass all rgb obs to rgb model
             imgs = list()
-            for key in self.rgb_keys:
+            for key in image_keys:
                 img = obs_dict[key]
                 if batch_size is None:
                     batch_size = img.shape[0]
@@ -207,23 +228,21 @@ class MultiImageObsEncoder(ModuleAttrMixin):
             feature = self.key_model_map['rgb'](imgs)
             # (N,B,D)
             feature = feature.reshape(-1,batch_size,*feature.shape[1:])
-            # (B,N,D)
-            feature = torch.moveaxis(feature,0,1)
-            # (B,N*D)
-            feature = feature.reshape(batch_size,-1)
-            features.append(feature)
+            for i, key in enumerate(image_keys):
+                rgb_features[key] = feature[i].reshape(batch_size,-1)
         else:
             # run each rgb obs to independent models
-            for key in self.rgb_keys:
+            for key in image_keys:
                 img = obs_dict[key]
                 if batch_size is None:
                     batch_size = img.shape[0]
                 else:
                     assert batch_size == img.shape[0]
-                assert img.shape[1:] == self.key_shape_map[key]
-                img = self.key_transform_map[key](img)
-                feature = self.key_model_map[key](img)
-                features.append(feature)
+                rgb_features[key] = self.encode_rgb(key, img)
+        for key in self.rgb_keys:
+            feature = rgb_features[key]
+            assert batch_size == feature.shape[0]
+            features.append(feature)
         
         # process lowdim input
         for key in self.low_dim_keys:
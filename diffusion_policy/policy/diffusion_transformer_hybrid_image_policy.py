@@ -10,6 +10,7 @@ from diffusion_policy.model.common.normalizer import LinearNormalizer
 from diffusion_policy.policy.base_image_policy import BaseImagePolicy
 from diffusion_policy.model.diffusion.transformer_for_diffusion import TransformerForDiffusion
 from diffusion_policy.model.diffusion.mask_generator import LowdimMaskGenerator
+from diffusion_policy.model.diffusion.sampling_engine import DiffusionSamplingEngine
 from diffusion_policy.common.robomimic_config_util import get_robomimic_config
 from robomimic.algo import algo_factory
 from robomimic.algo.algo import PolicyAlgo
@@ -43,6 +44,9 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
             time_as_cond=True,
             obs_as_cond=True,
             pred_action_steps_only=False,
+            inference_solver='scheduler',
+            inference_record_latency=False,
+            n_noise_samples=1,
             # parameters passed to step
             **kwargs):
         super().__init__()
@@ -174,11 +178,16 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
         self.n_obs_steps = n_obs_steps
         self.obs_as_cond = obs_as_cond
         self.pred_action_steps_only = pred_action_steps_only
+        # denoiser passes per encoded obs in compute_loss
+        self.n_noise_samples = n_noise_samples
         self.kwargs = kwargs
 
         if num_inference_steps is None:
             num_inference_steps = noise_scheduler.config.num_train_timesteps
         self.num_inference_steps = num_inference_steps
+        self.sampling_engine = DiffusionSamplingEngine(
+            noise_scheduler, solver=inference_solver,
+            record_latency=inference_record_latency)
     
     # ========= inference  ============
     def conditional_sample(self, 
@@ -187,36 +196,12 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
             # keyword arguments to scheduler.step
             **kwargs
             ):
-        model = self.model
-        scheduler = self.noise_scheduler
-
-        trajectory = torch.randn(
-            size=condition_data.shape, 
-            dtype=condition_data.dtype,
-            device=condition_data.device,
-            generator=generator)
-    
-        # set step values
-        scheduler.set_timesteps(self.num_inference_steps)
-
-        for t in scheduler.timesteps:
-            # 1. apply conditioning
-            trajectory[condition_mask] = condition_data[condition_mask]
-
-            # 2. predict model output
-            model_output = model(trajectory, t, cond)
-
-            # 3. compute previous image: x_t -> x_t-1
-            trajectory = scheduler.step(
-                model_output, t, trajectory, 
-                generator=generator,
-                **kwargs
-                ).prev_sample
-        
-        # finally make sure conditioning is enforced
-        trajectory[condition_mask] = condition_data[condition_mask]        
-
-        return trajectory
+        return self.sampling_engine.sample(
+            self.model, condition_data, condition_mask,
+            num_inference_steps=self.num_inference_steps,
+            model_kwargs=dict(cond=cond),
+            generator=generator,
+            **kwargs)
 
 
     def predict_action(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
@@ -342,6 +327,13 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
             nobs_features = nobs_features.reshape(batch_size, horizon, -1)
             trajectory = torch.cat([nactions, nobs_features], dim=-1).detach()
 
+        if self.n_noise_samples > 1:
+            # reuse the obs features for multiple noise and timestep draws
+            K = self.n_noise_samples
+            trajectory = trajectory.repeat_interleave(K, dim=0)
+            if cond is not None:
+                cond = cond.repeat_interleave(K, dim=0)
+
         # generate impainting mask
         if self.pred_action_steps_only:
             condition_mask = torch.zeros_like(trajectory, dtype=torch.bool)
@@ -9,6 +9,7 @@ from diffusion_policy.model.common.normalizer import LinearNormalizer
 from diffusion_policy.policy.base_lowdim_policy import BaseLowdimPolicy
 from diffusion_policy.model.diffusion.transformer_for_diffusion import TransformerForDiffusion
 from diffusion_policy.model.diffusion.mask_generator import LowdimMaskGenerator
+from diffusion_policy.model.diffusion.sampling_engine import DiffusionSamplingEngine
 
 class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
     def __init__(self, 
@@ -22,6 +23,8 @@ class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
             num_inference_steps=None,
             obs_as_cond=False,
             pred_action_steps_only=False,
+            inference_solver='scheduler',
+            inference_record_latency=False,
             # parameters passed to step
             **kwargs):
         super().__init__()
@@ -50,6 +53,9 @@ class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
         if num_inference_steps is None:
             num_inference_steps = noise_scheduler.config.num_train_timesteps
         self.num_inference_steps = num_inference_steps
+        self.sampling_engine = DiffusionSamplingEngine(
+            noise_scheduler, solver=inference_solver,
+            record_latency=inference_record_latency)
     
     # ========= inference  ============
     def conditional_sample(self, 
@@ -58,36 +64,12 @@ class DiffusionTransformerLowdimPolicy(BaseLowdimPolicy):
             # keyword arguments to scheduler.step
             **kwargs
             ):
-        model = self.model
-        scheduler = self.noise_scheduler
-
-        trajectory = torch.randn(
-            size=condition_data.shape, 
-            dtype=condition_data.dtype,
-            device=condition_data.device,
-            generator=generator)
-    
-        # set step values
-        scheduler.set_timesteps(self.num_inference_steps)
-
-        for t in scheduler.timesteps:
-            # 1. apply conditioning
-            trajectory[condition_mask] = condition_data[condition_mask]
-
-            # 2. predict model output
-            model_output = model(trajectory, t, cond)
-
-            # 3. compute previous image: x_t -> x_t-1
-            trajectory = scheduler.step(
-                model_output, t, trajectory, 
-                generator=generator,
-                **kwargs
-                ).prev_sample
-        
-        # finally make sure conditioning is enforced
-        trajectory[condition_mask] = condition_data[condition_mask]        
-
-        return trajectory
+        return self.sampling_engine.sample(
+            self.model, condition_data, condition_mask,
+            num_inference_steps=self.num_inference_steps,
+            model_kwargs=dict(cond=cond),
+            generator=generator,
+            **kwargs)
 
 
     def predict_action(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
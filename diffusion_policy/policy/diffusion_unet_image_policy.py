@@ -9,6 +9,7 @@ from diffusion_policy.model.common.normalizer import LinearNormalizer
 from diffusion_policy.policy.base_image_policy import BaseImagePolicy
 from diffusion_policy.model.diffusion.conditional_unet1d import ConditionalUnet1D
 from diffusion_policy.model.diffusion.mask_generator import LowdimMaskGenerator
+from diffusion_policy.model.diffusion.sampling_engine import DiffusionSamplingEngine
 from diffusion_policy.model.vision.multi_image_obs_encoder import MultiImageObsEncoder
 from diffusion_policy.common.pytorch_util import dict_apply
 
@@ -38,6 +39,10 @@ class DiffusionUnetImagePolicy(BaseImagePolicy):
             #decoder_model_path=None,
             #decoder_model_path='/home/yilong/Documents/action_extractor/results/iiwa16168,lift1000-cropped_rgbd+color_mask-delta_position+gripper-frontside-bs1632_mlp-53-353.pth',
             ###########################################################################
+            inference_solver='scheduler',
+            inference_record_latency=False,
+            cache_global_cond=True,
+            n_noise_samples=1,
             # parameters passed to step
             **kwargs):
         super().__init__()
@@ -89,6 +94,12 @@ class DiffusionUnetImagePolicy(BaseImagePolicy):
         if num_inference_steps is None:
             num_inference_steps = noise_scheduler.config.num_train_timesteps
         self.num_inference_steps = num_inference_steps
+        self.sampling_engine = DiffusionSamplingEngine(
+            noise_scheduler, solver=inference_solver,
+            record_latency=inference_record_latency)
+        self.cache_global_cond = cache_global_cond
+        # denoiser passes per encoded obs in compute_loss
+        self.n_noise_samples = n_noise_samples
         
         # Yilong
         ###########################################################################
@@ -103,37 +114,16 @@ class DiffusionUnetImagePolicy(BaseImagePolicy):
             # keyword arguments to scheduler.step
             **kwargs
             ):
-        model = self.model
-        scheduler = self.noise_scheduler
-
-        trajectory = torch.randn(
-            size=condition_data.shape, 
-            dtype=condition_data.dtype,
-            device=condition_data.device,
-            generator=generator)
-    
-        # set step values
-        scheduler.set_timesteps(self.num_inference_steps)
-
-        for t in scheduler.timesteps:
-            # 1. apply conditioning
-            trajectory[condition_mask] = condition_data[condition_mask]
-
-            # 2. predict model output
-            model_output = model(trajectory, t, 
-                local_cond=local_cond, global_cond=global_cond)
-
-            # 3. compute previous image: x_t -> x_t-1
-            trajectory = scheduler.step(
-                model_output, t, trajectory, 
-                generator=generator,
-                **kwargs
-                ).prev_sample
-        
-        # finally make sure conditioning is enforced
-        trajectory[condition_mask] = condition_data[condition_mask]        
-
-        return trajectory
+        model_kwargs = dict(local_cond=local_cond, global_cond=global_cond)
+        if self.cache_global_cond and (global_cond is not None):
+            # FiLM global_cond terms are the same for all steps
+            model_kwargs['cond_cache'] = self.model.encode_global_cond(global_cond)
+        return self.sampling_engine.sample(
+            self.model, condition_data, condition_mask,
+            num_inference_steps=self.num_inference_steps,
+            model_kwargs=model_kwargs,
+            generator=generator,
+            **kwargs)
 
 
     def predict_action(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
@@ -242,6 +232,14 @@ class DiffusionUnetImagePolicy(BaseImagePolicy):
             cond_data = torch.cat([nactions, nobs_features], dim=-1)
             trajectory = cond_data.detach()
 
+        if self.n_noise_samples > 1:
+            # reuse the obs features for multiple noise and timestep draws
+            K = self.n_noise_samples
+            trajectory = trajectory.repeat_interleave(K, dim=0)
+            cond_data = cond_data.repeat_interleave(K, dim=0)
+            if global_cond is not None:
+                global_cond = global_cond.repeat_interleave(K, dim=0)
+
         # generate impainting mask
         condition_mask = self.mask_generator(trajectory.shape)
 
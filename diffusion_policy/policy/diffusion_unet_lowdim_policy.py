@@ -9,6 +9,7 @@ from diffusion_policy.model.common.normalizer import LinearNormalizer
 from diffusion_policy.policy.base_lowdim_policy import BaseLowdimPolicy
 from diffusion_policy.model.diffusion.conditional_unet1d import ConditionalUnet1D
 from diffusion_policy.model.diffusion.mask_generator import LowdimMaskGenerator
+from diffusion_policy.model.diffusion.sampling_engine import DiffusionSamplingEngine
 
 class DiffusionUnetLowdimPolicy(BaseLowdimPolicy):
     def __init__(self, 
@@ -24,6 +25,9 @@ class DiffusionUnetLowdimPolicy(BaseLowdimPolicy):
             obs_as_global_cond=False,
             pred_action_steps_only=False,
             oa_step_convention=False,
+            inference_solver='scheduler',
+            inference_record_latency=False,
+            cache_global_cond=True,
             # parameters passed to step
             **kwargs):
         super().__init__()
@@ -54,6 +58,10 @@ class DiffusionUnetLowdimPolicy(BaseLowdimPolicy):
         if num_inference_steps is None:
             num_inference_steps = noise_scheduler.config.num_train_timesteps
         self.num_inference_steps = num_inference_steps
+        self.sampling_engine = DiffusionSamplingEngine(
+            noise_scheduler, solver=inference_solver,
+            record_latency=inference_record_latency)
+        self.cache_global_cond = cache_global_cond
     
     # ========= inference  ============
     def conditional_sample(self, 
@@ -63,37 +71,16 @@ class DiffusionUnetLowdimPolicy(BaseLowdimPolicy):
             # keyword arguments to scheduler.step
             **kwargs
             ):
-        model = self.model
-        scheduler = self.noise_scheduler
-
-        trajectory = torch.randn(
-            size=condition_data.shape, 
-            dtype=condition_data.dtype,
-            device=condition_data.device,
-            generator=generator)
-    
-        # set step values
-        scheduler.set_timesteps(self.num_inference_steps)
-
-        for t in scheduler.timesteps:
-            # 1. apply conditioning
-            trajectory[condition_mask] = condition_data[condition_mask]
-
-            # 2. predict model output
-            model_output = model(trajectory, t, 
-                local_cond=local_cond, global_cond=global_cond)
-
-            # 3. compute previous image: x_t -> x_t-1
-            trajectory = scheduler.step(
-                model_output, t, trajectory, 
-                generator=generator,
-                **kwargs
-                ).prev_sample
-        
-        # finally make sure conditioning is enforced
-        trajectory[condition_mask] = condition_data[condition_mask]        
-
-        return trajectory
+        model_kwargs = dict(local_cond=local_cond, global_cond=global_cond)
+        if self.cache_global_cond and (global_cond is not None):
+            # FiLM global_cond terms are the same for all steps
+            model_kwargs['cond_cache'] = self.model.encode_global_cond(global_cond)
+        return self.sampling_engine.sample(
+            self.model, condition_data, condition_mask,
+            num_inference_steps=self.num_inference_steps,
+            model_kwargs=model_kwargs,
+            generator=generator,
+            **kwargs)
 
 
     def predict_action(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
@@ -0,0 +1,363 @@
+"""
+Crash-safe recording of real robot episodes.
+
+While an episode is recorded, rows of each key are appended to an
+on-disk journal in blocks of block_size rows by a background thread:
+
+<journal_dir>/<episode_id>/
+    meta.json   {"episode_id": int, "start_time": float, "dt": float,
+                 "keys": {key: {"dtype": str, "shape": list}}}
+    <key>.bin   records: 24 byte header (start_idx, n_rows, crc32), raw rows
+
+Records are replayed in order, later rows overwrite earlier ones
+(scheduled actions can be replaced). end_episode hands the episode to
+the thread, which adds it to the ReplayBuffer (episode_ends is written
+last, which commits it) and removes the journal.
+On restart, journals of uncommitted episodes are replayed and committed,
+a torn record at the end of a file is ignored.
+"""
+from typing import Dict, Optional
+import os
+import json
+import queue
+import struct
+import shutil
+import zlib
+import pathlib
+import threading
+import numpy as np
+import zarr
+from diffusion_policy.common.replay_buffer import ReplayBuffer
+
+RECORD_HEADER = struct.Struct('<qqII')
+META_NAME = 'meta.json'
+
+
+def truncate_uncommitted(group: zarr.Group):
+    """
+    Remove rows after episode_ends[-1] left by an interrupted add_episode,
+    so that the group can be opened as a ReplayBuffer.
+    Trailing episode_ends that are not strictly increasing or past
+    the end of the data (e.g. fill value 0 of a torn resize) are dropped.
+    """
+    if ('data' not in group) or ('meta' not in group) \
+            or ('episode_ends' not in group['meta']):
+        return
+    episode_ends = group['meta']['episode_ends']
+    ends = episode_ends[:]
+    max_steps = min((value.shape[0] for value in group['data'].values()),
+        default=np.inf)
+    n_episodes = len(ends)
+    while n_episodes > 0:
+        end = ends[n_episodes-1]
+        prev_end = ends[n_episodes-2] if n_episodes > 1 else 0
+        if prev_end < end <= max_steps:
+            break
+        n_episodes -= 1
+    if n_episodes != len(ends):
+        episode_ends.resize(n_episodes)
+    n_steps = int(ends[n_episodes-1]) if n_episodes > 0 else 0
+    for key, value in group['data'].items():
+        if value.shape[0] != n_steps:
+            value.resize((n_steps,) + value.shape[1:])
+
+
+def build_episode(data: Dict[str, np.ndarray],
+        start_time: float, dt: float) -> Optional[Dict[str, np.ndarray]]:
+    """
+    Truncate all keys to the shortest one, same as RealEnv.end_episode.
+    timestamp defaults to the accumulator time grid.
+    Returns None for empty episodes.
+    """
+    if len(data) == 0:
+        return None
+    n_steps = min(len(value) for value in data.values())
+    if n_steps == 0:
+        return None
+    episode = dict()
+    episode['timestamp'] = start_time + np.arange(n_steps) * dt
+    for key, value in data.items():
+        episode[key] = value[:n_steps]
+    return episode
+
+
+class EpisodeJournal:
+    """
+    On-disk append-only log of a single episode.
+    Not thread safe, used by one thread at a time.
+    """
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.meta = None
+        meta_path = self.path.joinpath(META_NAME)
+        if meta_path.is_file():
+            with meta_path.open('r') as f:
+                self.meta = json.load(f)
+
+    @classmethod
+    def create(cls, path, episode_id: int, start_time: float, dt: float):
+        path = pathlib.Path(path)
+        if path.exists():
+            shutil.rmtree(path)
+        path.mkdir(parents=True)
+        obj = cls(path)
+        obj.meta = {
+            'episode_id': episode_id,
+            'start_time': start_time,
+            'dt': dt,
+            'keys': dict()
+        }
+        obj._write_meta()
+        return obj
+
+    @property
+    def episode_id(self) -> int:
+        return self.meta['episode_id']
+
+    def _write_meta(self):
+        tmp_path = self.path.joinpath(META_NAME + '.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(self.meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path.joinpath(META_NAME))
+
+    def append(self, key: str, records):
+        """
+        records: list of (start_idx, rows), written with a single fsync.
+        """
+        if key not in self.meta['keys']:
+            rows = records[0][1]
+            self.meta['keys'][key] = {
+                'dtype': np.dtype(rows.dtype).str,
+                'shape': list(rows.shape[1:])
+            }
+            self._write_meta()
+        buf = bytearray()
+        for start_idx, rows in records:
+            payload = np.ascontiguousarray(rows).tobytes()
+            buf += RECORD_HEADER.pack(start_idx, len(rows),
+                zlib.crc32(payload), 0)
+            buf += payload
+        with self.path.joinpath(key + '.bin').open('ab') as f:
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self) -> Dict[str, np.ndarray]:
+        """
+        Replay all complete records.
+        """
+        result = dict()
+        for key, attr in self.meta['keys'].items():
+            dtype = np.dtype(attr['dtype'])
+            shape = tuple(attr['shape'])
+            row_bytes = dtype.itemsize * int(np.prod(shape))
+            file_path = self.path.joinpath(key + '.bin')
+            data = file_path.read_bytes() if file_path.is_file() else b''
+
+            records = list()
+            pos = 0
+            while pos + RECORD_HEADER.size <= len(data):
+                start_idx, n_rows, crc, _ = RECORD_HEADER.unpack_from(data, pos)
+                begin = pos + RECORD_HEADER.size
+                end = begin + n_rows * row_bytes
+                payload = data[begin:end]
+                if (end > len(data)) or (zlib.crc32(payload) != crc):
+                    # torn write
+                    break
+                rows = np.frombuffer(payload, dtype=dtype).reshape((n_rows,) + shape)
+                records.append((start_idx, rows))
+                pos = end
+
+            length = max([s + len(r) for s, r in records], default=0)
+            arr = np.zeros((length,) + shape, dtype=dtype)
+            for start_idx, rows in records:
+                arr[start_idx:start_idx+len(rows)] = rows
+            result[key] = arr
+        return result
+
+    def to_episode(self) -> Optional[Dict[str, np.ndarray]]:
+        return build_episode(self.read(),
+            start_time=self.meta['start_time'], dt=self.meta['dt'])
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class EpisodeWriter:
+    def __init__(self,
+            replay_buffer: ReplayBuffer,
+            journal_dir,
+            block_size: int=32,
+            compressors='disk'):
+        """
+        Journals and saves episodes on a background thread.
+        The replay_buffer should not be modified elsewhere while running.
+        Uncommitted episodes in journal_dir are recovered first.
+        """
+        self.replay_buffer = replay_buffer
+        self.journal_dir = pathlib.Path(journal_dir)
+        self.journal_dir.mkdir(parents=True, exist_ok=True)
+        self.block_size = block_size
+        self.compressors = compressors
+
+        self.recover()
+        # includes episodes still being saved
+        self.n_episodes = replay_buffer.n_episodes
+
+        self.queue = queue.Queue()
+        self.thread = None
+        self.error = None
+        # current episode
+        self.journal = None
+        self.pending = dict()
+        self.n_pending_rows = dict()
+
+    # ========= recovery ===========
+    def recover(self):
+        paths = [p for p in self.journal_dir.iterdir() if p.is_dir()]
+        journals = [EpisodeJournal(p) for p in paths]
+        journals = [j for j in journals if j.meta is not None]
+        for path in paths:
+            if not path.joinpath(META_NAME).is_file():
+                shutil.rmtree(path)
+        for journal in sorted(journals, key=lambda j: j.episode_id):
+            if journal.episode_id < self.replay_buffer.n_episodes:
+                # committed before the journal was removed
+                journal.remove()
+                continue
+            episode = journal.to_episode()
+            if episode is not None:
+                self.replay_buffer.add_episode(episode,
+                    compressors=self.compressors)
+                episode_id = self.replay_buffer.n_episodes - 1
+                print(f'Episode {episode_id} recovered!')
+            journal.remove()
+
+    # ========= start-stop API =============
+    @property
+    def is_alive(self):
+        return (self.thread is not None) and self.thread.is_alive()
+
+    def start(self, wait=True):
+        if self.is_alive:
+            return
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self, wait=True):
+        if not self.is_alive:
+            return
+        self.queue.put(None)
+        if wait:
+            self.stop_wait()
+
+    def start_wait(self):
+        pass
+
+    def stop_wait(self):
+        self.thread.join()
+        self._check_error()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    break
+                if self.error is None:
+                    func, args = task
+                    func(*args)
+            except Exception as e:
+                # keep the journal, reraised on the control thread
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _submit(self, func, *args):
+        self._check_error()
+        assert self.is_alive
+        self.queue.put((func, args))
+
+    def _check_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def wait(self):
+        "Block until all submitted writes are done."
+        if self.is_alive:
+            self.queue.join()
+        self._check_error()
+
+    # ========= recording API ===========
+    def start_episode(self, start_time: float, dt: float) -> int:
+        assert self.journal is None
+        episode_id = self.n_episodes
+        self.journal = EpisodeJournal(self.journal_dir.joinpath(str(episode_id)))
+        self.pending = dict()
+        self.n_pending_rows = dict()
+        self._submit(self._create_journal, self.journal,
+            episode_id, start_time, dt)
+        return episode_id
+
+    @staticmethod
+    def _create_journal(journal, episode_id, start_time, dt):
+        created = EpisodeJournal.create(journal.path,
+            episode_id=episode_id, start_time=start_time, dt=dt)
+        journal.meta = created.meta
+
+    def put(self, data: Dict[str, np.ndarray], idxs: np.ndarray):
+        """
+        data: key: T,* rows for the consecutive step indices idxs.
+        """
+        if (self.journal is None) or (len(idxs) == 0):
+            return
+        idxs = np.asarray(idxs)
+        assert np.all(np.diff(idxs) == 1)
+        start_idx = int(idxs[0])
+        for key, rows in data.items():
+            self.pending.setdefault(key, list()).append(
+                (start_idx, np.array(rows)))
+            self.n_pending_rows[key] = self.n_pending_rows.get(key, 0) + len(rows)
+            if self.n_pending_rows[key] >= self.block_size:
+                self._flush_key(key)
+
+    def _flush_key(self, key):
+        records = self.pending.pop(key, None)
+        self.n_pending_rows.pop(key, None)
+        if records:
+            self._submit(self.journal.append, key, records)
+
+    def end_episode(self, episode: Optional[Dict[str, np.ndarray]]=None) -> Optional[int]:
+        """
+        Commit episode (see build_episode) in the background,
+        discard the journal if None. Returns the episode id if saved.
+        """
+        if self.journal is None:
+            return None
+        for key in list(self.pending.keys()):
+            self._flush_key(key)
+        journal = self.journal
+        self.journal = None
+        episode_id = None
+        if episode is not None:
+            episode_id = self.n_episodes
+            self.n_episodes += 1
+        self._submit(self._commit, journal, episode)
+        return episode_id
+
+    def _commit(self, journal: EpisodeJournal, episode):
+        if episode is not None:
+            self.replay_buffer.add_episode(episode,
+                compressors=self.compressors)
+            print(f'Episode {self.replay_buffer.n_episodes - 1} saved!')
+        journal.remove()
+
+    def drop_episode(self):
+        "Drop the last saved episode."
+        self.wait()
+        self.replay_buffer.drop_episode()
+        self.n_episodes = self.replay_buffer.n_episodes
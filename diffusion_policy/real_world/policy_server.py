@@ -0,0 +1,365 @@
+"""
+Serve a policy to multiple robots / eval processes over a local socket.
+Concurrent predict_action requests are batched into one forward pass.
+
+Server:
+    policy = load_policy_from_checkpoint(ckpt_path, device='cuda:0')
+    server = PolicyServer(policy, address='/tmp/policy.sock',
+        max_batch_size=32, max_wait=0.005)
+    server.serve_forever()
+
+Client (drop-in for policy in the env runners):
+    policy = PolicyClient('/tmp/policy.sock')
+    action_dict = policy.predict_action(obs_dict)
+
+Messages are pickled, so connections are always authenticated.
+TCP addresses need an explicit authkey. For unix sockets without one,
+the server writes a random authkey to <address>.authkey, readable only
+by its user, and PolicyClient reads it from there.
+Policies with per-episode state (e.g. RNN) are rejected, batching
+would mix the state of different clients.
+"""
+from typing import Dict, Optional, Union, Tuple
+import os
+import time
+import queue
+import threading
+import collections
+import concurrent.futures
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+import numpy as np
+import torch
+from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.workspace.base_workspace import BaseWorkspace
+from diffusion_policy.env_runner.rollout_scheduler import has_episode_state
+
+Address = Union[str, Tuple[str, int]]
+
+
+def load_policy_from_checkpoint(ckpt_path: str, device='cuda:0', use_ema=None):
+    workspace = BaseWorkspace.create_from_checkpoint(ckpt_path)
+    cfg = workspace.cfg
+    policy = workspace.model
+    if use_ema is None:
+        use_ema = cfg.training.get('use_ema', False)
+    if use_ema:
+        policy = workspace.ema_model
+    policy.eval().to(torch.device(device))
+    return policy
+
+
+def get_authkey_path(address: str) -> str:
+    """
+    Generated authkey of a unix socket address.
+    """
+    return address + '.authkey'
+
+
+class _Request:
+    def __init__(self, obs: Dict[str, np.ndarray]):
+        self.obs = obs
+        self.batch_size = len(next(iter(obs.values())))
+        # requests with the same signature can be batched
+        self.signature = tuple(sorted(
+            (key, value.shape[1:], value.dtype.str)
+            for key, value in obs.items()))
+        self.receive_time = time.monotonic()
+        self.future = concurrent.futures.Future()
+
+
+class PolicyServer:
+    def __init__(self,
+            policy,
+            address: Address='/tmp/diffusion_policy.sock',
+            authkey: Optional[bytes]=None,
+            max_batch_size: int=32,
+            max_wait: float=0.005,
+            n_metrics_window: int=1000):
+        """
+        address: path of a unix socket, or (host, port) for tcp
+        authkey: required for tcp, any local user could connect to
+            a loopback port. Generated for unix sockets if None.
+        max_batch_size: max number of samples per forward pass
+        max_wait: time in seconds to wait for more requests
+            after the first request of a batch arrived
+        """
+        if (authkey is None) and (not isinstance(address, str)):
+            raise ValueError(
+                f'PolicyServer on {address} requires an authkey.')
+        if has_episode_state(policy):
+            raise ValueError(f'{type(policy).__name__} has per-episode state, '
+                'which would be shared by all clients.')
+        self.policy = policy
+        self.address = address
+        self.authkey = authkey
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.request_queue = queue.Queue()
+        self.stop_event = threading.Event()
+        self.listener = None
+        self.authkey_path = None
+        self.metrics_lock = threading.Lock()
+        self.queue_latencies = collections.deque(maxlen=n_metrics_window)
+        self.inference_latencies = collections.deque(maxlen=n_metrics_window)
+        self.batch_sizes = collections.deque(maxlen=n_metrics_window)
+        self.n_requests = 0
+        self.n_batches = 0
+
+    # ========= batching ===========
+    def predict(self, obs: Dict[str, np.ndarray]) -> concurrent.futures.Future:
+        """
+        Thread-safe, returns a Future of the action dict.
+        """
+        request = _Request(obs)
+        self.request_queue.put(request)
+        return request.future
+
+    def _collect_batch(self, deferred: collections.deque):
+        if len(deferred) > 0:
+            first = deferred.popleft()
+        else:
+            try:
+                first = self.request_queue.get(timeout=0.1)
+            except queue.Empty:
+                return None
+        batch = [first]
+        n = first.batch_size
+
+        # requests with a different signature wait for the next batch
+        for _ in range(len(deferred)):
+            request = deferred.popleft()
+            if (request.signature == first.signature) \
+                    and (n + request.batch_size <= self.max_batch_size):
+                batch.append(request)
+                n += request.batch_size
+            else:
+                deferred.append(request)
+
+        deadline = first.receive_time + self.max_wait
+        while n < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    request = self.request_queue.get(timeout=timeout)
+                else:
+                    request = self.request_queue.get_nowait()
+            except queue.Empty:
+                break
+            if (request.signature == first.signature) \
+                    and (n + request.batch_size <= self.max_batch_size):
+                batch.append(request)
+                n += request.batch_size
+            else:
+                deferred.append(request)
+        return batch
+
+    def _run_batch(self, batch):
+        start_time = time.monotonic()
+        try:
+            obs = dict()
+            for key in batch[0].obs.keys():
+                obs[key] = np.concatenate([r.obs[key] for r in batch], axis=0)
+            device = self.policy.device
+            obs = dict_apply(obs, lambda x: torch.from_numpy(x).to(device=device))
+            with torch.no_grad():
+                result = self.policy.predict_action(obs)
+            result = dict_apply(result, lambda x: x.detach().to('cpu').numpy())
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        end_time = time.monotonic()
+
+        start = 0
+        for request in batch:
+            end = start + request.batch_size
+            request.future.set_result(
+                dict_apply(result, lambda x: x[start:end]))
+            start = end
+
+        with self.metrics_lock:
+            self.n_requests += len(batch)
+            self.n_batches += 1
+            self.batch_sizes.append(start)
+            self.inference_latencies.append(end_time - start_time)
+            for request in batch:
+                self.queue_latencies.append(start_time - request.receive_time)
+
+    def run_batching_loop(self):
+        deferred = collections.deque()
+        while not self.stop_event.is_set():
+            batch = self._collect_batch(deferred)
+            if batch is not None:
+                self._run_batch(batch)
+
+    # ========= metrics ===========
+    def get_metrics(self) -> dict:
+        with self.metrics_lock:
+            queue_latencies = np.array(self.queue_latencies)
+            inference_latencies = np.array(self.inference_latencies)
+            batch_sizes = np.array(self.batch_sizes)
+            metrics = {
+                'n_requests': self.n_requests,
+                'n_batches': self.n_batches
+            }
+        if len(batch_sizes) > 0:
+            metrics.update({
+                'batch_size_mean': float(batch_sizes.mean()),
+                'batch_size_max': int(batch_sizes.max()),
+                'queue_latency_mean': float(queue_latencies.mean()),
+                'queue_latency_p50': float(np.percentile(queue_latencies, 50)),
+                'queue_latency_p99': float(np.percentile(queue_latencies, 99)),
+                'inference_latency_mean': float(inference_latencies.mean()),
+                'inference_latency_p99': float(np.percentile(inference_latencies, 99))
+            })
+        return metrics
+
+    # ========= transport ===========
+    def _handle_connection(self, conn):
+        with conn:
+            while not self.stop_event.is_set():
+                try:
+                    msg = conn.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    if msg['type'] == 'predict':
+                        response = {'result': self.predict(msg['obs']).result()}
+                    elif msg['type'] == 'metrics':
+                        response = {'result': self.get_metrics()}
+                    else:
+                        raise ValueError(f"Unknown request type {msg['type']}")
+                except Exception as e:
+                    response = {'error': repr(e)}
+                try:
+                    conn.send(response)
+                except (EOFError, OSError):
+                    break
+
+    def _accept_loop(self, listener):
+        while not self.stop_event.is_set():
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # listener closed or failed handshake
+                continue
+            threading.Thread(target=self._handle_connection,
+                args=(conn,), daemon=True).start()
+
+    def start(self):
+        authkey = self.authkey
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                # stale socket from a previous run
+                os.remove(self.address)
+            if authkey is None:
+                authkey = os.urandom(32)
+                self.authkey_path = get_authkey_path(self.address)
+                if os.path.lexists(self.authkey_path):
+                    os.remove(self.authkey_path)
+                # only readable by this user
+                fd = os.open(self.authkey_path,
+                    os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(authkey)
+        self.listener = Listener(self.address, authkey=authkey)
+        self.stop_event.clear()
+        self.accept_thread = threading.Thread(
+            target=self._accept_loop, args=(self.listener,), daemon=True)
+        self.accept_thread.start()
+        self.batching_thread = threading.Thread(
+            target=self.run_batching_loop, daemon=True)
+        self.batching_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        if self.authkey_path is not None:
+            if os.path.exists(self.authkey_path):
+                os.remove(self.authkey_path)
+            self.authkey_path = None
+        self.batching_thread.join()
+
+    def serve_forever(self, metrics_interval: Optional[float]=None):
+        self.start()
+        try:
+            while True:
+                time.sleep(metrics_interval or 1.0)
+                if metrics_interval is not None:
+                    print(self.get_metrics())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class PolicyClient:
+    """
+    Remote policy with the predict_action interface of BasePolicy.
+    Accepts and returns torch tensors (cpu) or np.ndarray.
+    """
+    def __init__(self,
+            address: Address='/tmp/diffusion_policy.sock',
+            authkey: Optional[bytes]=None):
+        """
+        authkey: if None, read from the generated key file of
+            a unix socket server, see get_authkey_path.
+        """
+        if (authkey is None) and isinstance(address, str):
+            with open(get_authkey_path(address), 'rb') as f:
+                authkey = f.read()
+        self.address = address
+        self.conn = Client(address, authkey=authkey)
+        self.lock = threading.Lock()
+
+    @property
+    def device(self):
+        return torch.device('cpu')
+
+    @property
+    def dtype(self):
+        return torch.float32
+
+    def reset(self):
+        # the server only serves policies without per-episode state
+        pass
+
+    def _request(self, msg):
+        with self.lock:
+            self.conn.send(msg)
+            response = self.conn.recv()
+        if 'error' in response:
+            raise RuntimeError(f"Policy server error: {response['error']}")
+        return response['result']
+
+    def predict_action(self, obs_dict: Dict[str, Union[torch.Tensor, np.ndarray]]):
+        is_torch = torch.is_tensor(next(iter(obs_dict.values())))
+        obs = dict_apply(obs_dict,
+            lambda x: x.detach().to('cpu').numpy() if torch.is_tensor(x) else x)
+        result = self._request({'type': 'predict', 'obs': obs})
+        if is_torch:
+            result = dict_apply(result, torch.from_numpy)
+        return result
+
+    def get_metrics(self) -> dict:
+        return self._request({'type': 'metrics'})
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -6,10 +6,10 @@ import av
 import zarr
 import numcodecs
 import multiprocessing
-import concurrent.futures
 from tqdm import tqdm
 from diffusion_policy.common.replay_buffer import ReplayBuffer, get_optimal_chunks
 from diffusion_policy.common.cv2_util import get_image_transform
+from diffusion_policy.common.chunk_encoder import ChunkEncoder
 from diffusion_policy.real_world.video_recorder import read_video
 from diffusion_policy.codecs.imagecodecs_numcodecs import (
     register_codecs,
@@ -29,7 +29,8 @@ def real_data_to_replay_buffer(
         n_decoding_threads: int=multiprocessing.cpu_count(),
         n_encoding_threads: int=multiprocessing.cpu_count(),
         max_inflight_tasks: int=multiprocessing.cpu_count()*5,
-        verify_read: bool=True
+        verify_read: bool=True,
+        encode_mode: str='thread'
         ) -> ReplayBuffer:
     """
     It is recommended to use before calling this function
@@ -44,6 +45,7 @@ def real_data_to_replay_buffer(
         if dict:
             camera_0: (1280, 720)
     image_keys: ['camera_0', 'camera_1']
+    encode_mode: 'thread' or 'process', see ChunkEncoder.
     """
     if out_store is None:
         out_store = zarr.MemoryStore()
@@ -79,18 +81,6 @@ def real_data_to_replay_buffer(
         compressors=compressor_map
         )
     
-    # worker function
-    def put_img(zarr_arr, zarr_idx, img):
-        try:
-            zarr_arr[zarr_idx] = img
-            # make sure we can successfully decode
-            if verify_read:
-                _ = zarr_arr[zarr_idx]
-            return True
-        except Exception as e:
-            return False
-
-    
     n_cameras = 0
     camera_idxs = set() 
     if image_keys is not None:
@@ -110,9 +100,10 @@ def real_data_to_replay_buffer(
     dt = timestamps[1] - timestamps[0]
 
     with tqdm(total=n_steps*n_cameras, desc="Loading image data", mininterval=1.0) as pbar:
-        # one chunk per thread, therefore no synchronization needed
-        with concurrent.futures.ThreadPoolExecutor(max_workers=n_encoding_threads) as executor:
-            futures = set()
+        # one chunk per task, therefore no synchronization needed
+        with ChunkEncoder(mode=encode_mode, n_workers=n_encoding_threads, 
+                max_inflight_tasks=max_inflight_tasks, verify_read=verify_read,
+                callback=lambda start, n: pbar.update(n)) as encoder:
             for episode_idx, episode_length in enumerate(episode_lengths):
                 episode_video_dir = in_video_dir.joinpath(str(episode_idx))
                 episode_start = episode_starts[episode_idx]
@@ -171,24 +162,10 @@ def real_data_to_replay_buffer(
                             thread_type='FRAME',
                             thread_count=n_decoding_threads
                         )):
-                        if len(futures) >= max_inflight_tasks:
-                            # limit number of inflight tasks
-                            completed, futures = concurrent.futures.wait(futures, 
-                                return_when=concurrent.futures.FIRST_COMPLETED)
-                            for f in completed:
-                                if not f.result():
-                                    raise RuntimeError('Failed to encode image!')
-                            pbar.update(len(completed))
-                        
                         global_idx = episode_start + step_idx
-                        futures.add(executor.submit(put_img, arr, global_idx, frame))
+                        encoder.put(arr, global_idx, frame)
 
                         if step_idx == (episode_length - 1):
                             break
-            completed, futures = concurrent.futures.wait(futures)
-            for f in completed:
-                if not f.result():
-                    raise RuntimeError('Failed to encode image!')
-            pbar.update(len(completed))
     return out_replay_buffer
 
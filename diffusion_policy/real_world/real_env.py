@@ -4,6 +4,7 @@ import numpy as np
 import time
 import shutil
 import math
+import zarr
 from multiprocessing.managers import SharedMemoryManager
 from diffusion_policy.real_world.rtde_interpolation_controller import RTDEInterpolationController
 from diffusion_policy.real_world.multi_realsense import MultiRealsense, SingleRealsense
@@ -15,6 +16,8 @@ from diffusion_policy.common.timestamp_accumulator import (
 )
 from diffusion_policy.real_world.multi_camera_visualizer import MultiCameraVisualizer
 from diffusion_policy.common.replay_buffer import ReplayBuffer
+from diffusion_policy.real_world.episode_journal import (
+    EpisodeWriter, truncate_uncommitted, build_episode)
 from diffusion_policy.common.cv2_util import (
     get_image_transform, optimal_row_cols)
 
@@ -56,6 +59,7 @@ class RealEnv:
             record_raw_video=True,
             thread_per_video=2,
             video_crf=21,
+            journal_block_size=32,
             # vis params
             enable_multi_cam_vis=True,
             multi_cam_vis_resolution=(1280,720),
@@ -68,8 +72,16 @@ class RealEnv:
         video_dir = output_dir.joinpath('videos')
         video_dir.mkdir(parents=True, exist_ok=True)
         zarr_path = str(output_dir.joinpath('replay_buffer.zarr').absolute())
-        replay_buffer = ReplayBuffer.create_from_path(
-            zarr_path=zarr_path, mode='a')
+        group = zarr.open(zarr_path, mode='a')
+        # recover from a crash during saving
+        truncate_uncommitted(group)
+        replay_buffer = ReplayBuffer.create_from_group(group)
+        # episodes are journaled while recording and saved in the background
+        episode_writer = EpisodeWriter(
+            replay_buffer=replay_buffer,
+            journal_dir=output_dir.joinpath('journal'),
+            block_size=journal_block_size,
+            compressors='disk')
 
         if shm_manager is None:
             shm_manager = SharedMemoryManager()
@@ -188,6 +200,7 @@ class RealEnv:
         self.output_dir = output_dir
         self.video_dir = video_dir
         self.replay_buffer = replay_buffer
+        self.episode_writer = episode_writer
         # temp memory buffers
         self.last_realsense_data = None
         # recording buffers
@@ -205,6 +218,7 @@ class RealEnv:
     def start(self, wait=True):
         self.realsense.start(wait=False)
         self.robot.start(wait=False)
+        self.episode_writer.start(wait=False)
         if self.multi_cam_vis is not None:
             self.multi_cam_vis.start(wait=False)
         if wait:
@@ -216,6 +230,7 @@ class RealEnv:
             self.multi_cam_vis.stop(wait=False)
         self.robot.stop(wait=False)
         self.realsense.stop(wait=False)
+        self.episode_writer.stop(wait=False)
         if wait:
             self.stop_wait()
 
@@ -228,6 +243,7 @@ class RealEnv:
     def stop_wait(self):
         self.robot.stop_wait()
         self.realsense.stop_wait()
+        self.episode_writer.stop_wait()
         if self.multi_cam_vis is not None:
             self.multi_cam_vis.stop_wait()
 
@@ -359,7 +375,9 @@ class RealEnv:
         assert self.is_ready
 
         # prepare recording stuff
-        episode_id = self.replay_buffer.n_episodes
+        dt = 1/self.frequency
+        episode_id = self.episode_writer.start_episode(
+            start_time=start_time, dt=dt)
         this_video_dir = self.video_dir.joinpath(str(episode_id))
         this_video_dir.mkdir(parents=True, exist_ok=True)
         n_cameras = self.realsense.n_cameras
@@ -372,18 +390,22 @@ class RealEnv:
         self.realsense.restart_put(start_time=start_time)
         self.realsense.start_recording(video_path=video_paths, start_time=start_time)
 
-        # create accumulators
+        # create accumulators, new rows are streamed to the journal
+        writer = self.episode_writer
         self.obs_accumulator = TimestampObsAccumulator(
             start_time=start_time,
-            dt=1/self.frequency
+            dt=dt,
+            callback=lambda idxs, data: writer.put(data, idxs)
         )
         self.action_accumulator = TimestampActionAccumulator(
             start_time=start_time,
-            dt=1/self.frequency
+            dt=dt,
+            callback=lambda idxs, x: writer.put({'action': x}, idxs)
         )
         self.stage_accumulator = TimestampActionAccumulator(
             start_time=start_time,
-            dt=1/self.frequency
+            dt=dt,
+            callback=lambda idxs, x: writer.put({'stage': x}, idxs)
         )
         print(f'Episode {episode_id} started!')
     
@@ -402,23 +424,16 @@ class RealEnv:
             # Since the only way to accumulate obs and action is by calling
             # get_obs and exec_actions, which will be in the same thread.
             # We don't need to worry new data come in here.
-            obs_data = self.obs_accumulator.data
-            obs_timestamps = self.obs_accumulator.timestamps
-
-            actions = self.action_accumulator.actions
-            action_timestamps = self.action_accumulator.timestamps
-            stages = self.stage_accumulator.actions
-            n_steps = min(len(obs_timestamps), len(action_timestamps))
-            if n_steps > 0:
-                episode = dict()
-                episode['timestamp'] = obs_timestamps[:n_steps]
-                episode['action'] = actions[:n_steps]
-                episode['stage'] = stages[:n_steps]
-                for key, value in obs_data.items():
-                    episode[key] = value[:n_steps]
-                self.replay_buffer.add_episode(episode, compressors='disk')
-                episode_id = self.replay_buffer.n_episodes - 1
-                print(f'Episode {episode_id} saved!')
+            data = dict(self.obs_accumulator.data)
+            data['action'] = self.action_accumulator.actions
+            data['stage'] = self.stage_accumulator.actions
+            episode = None
+            if len(self.obs_accumulator) > 0 and len(self.action_accumulator) > 0:
+                episode = build_episode(data,
+                    start_time=self.obs_accumulator.start_time,
+                    dt=self.obs_accumulator.dt)
+            # saved in the background, the journal is removed after
+            self.episode_writer.end_episode(episode)
             
             self.obs_accumulator = None
             self.action_accumulator = None
@@ -426,8 +441,8 @@ class RealEnv:
 
     def drop_episode(self):
         self.end_episode()
-        self.replay_buffer.drop_episode()
-        episode_id = self.replay_buffer.n_episodes
+        self.episode_writer.drop_episode()
+        episode_id = self.episode_writer.n_episodes
         this_video_dir = self.video_dir.joinpath(str(episode_id))
         if this_video_dir.exists():
             shutil.rmtree(str(this_video_dir))
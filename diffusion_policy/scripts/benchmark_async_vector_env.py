@@ -0,0 +1,79 @@
+if __name__ == "__main__":
+    import sys
+    import os
+    import pathlib
+
+    ROOT_DIR = str(pathlib.Path(__file__).parent.parent.parent)
+    sys.path.append(ROOT_DIR)
+
+import time
+import click
+import numpy as np
+import gym
+from gym import spaces
+from diffusion_policy.gym_util.async_vector_env import AsyncVectorEnv
+
+
+class BenchmarkEnv(gym.Env):
+    """
+    Near zero compute per step, so that the IPC overhead dominates.
+    """
+    def __init__(self, obs_shape=(3,96,96), action_shape=(8,2), info_size=8):
+        self.observation_space = spaces.Box(
+            low=0, high=1, shape=obs_shape, dtype=np.float32)
+        self.action_space = spaces.Box(
+            low=-1, high=1, shape=action_shape, dtype=np.float32)
+        self.obs = np.zeros(obs_shape, dtype=np.float32)
+        self.info_size = info_size
+
+    def reset(self):
+        self.t = 0
+        return self.obs
+
+    def step(self, action):
+        self.t += 1
+        info = {'pos_agent': np.zeros((len(action), self.info_size))}
+        return self.obs, float(action[0,0]), False, info
+
+
+@click.command()
+@click.option('--n_envs', '-n', default=28, type=int)
+@click.option('--n_steps', '-s', default=2000, type=int)
+@click.option('--obs_shape', '-o', default='3x96x96')
+@click.option('--n_action_steps', '-a', default=8, type=int)
+def main(n_envs, n_steps, obs_shape, n_action_steps):
+    """
+    Compare steps/s of AsyncVectorEnv with step through pipes or shared memory.
+    """
+    obs_shape = tuple(int(x) for x in obs_shape.split('x'))
+    action_shape = (n_action_steps, 2)
+    def env_fn():
+        return BenchmarkEnv(obs_shape=obs_shape, action_shape=action_shape)
+
+    actions = np.random.uniform(-1, 1, size=(n_envs,) + action_shape)
+    for shared_step in [False, True]:
+        env = AsyncVectorEnv([env_fn] * n_envs, shared_step=shared_step)
+        env.reset()
+        for _ in range(10):
+            env.step(actions)
+
+        start = time.monotonic()
+        for _ in range(n_steps):
+            env.step(actions)
+        duration = time.monotonic() - start
+        # a third of the envs, as at the tail of a work queue rollout
+        indices = list(range(0, n_envs, 3))
+        start = time.monotonic()
+        for _ in range(n_steps):
+            env.step(actions[indices], indices=indices)
+        subset_duration = time.monotonic() - start
+        env.close()
+
+        name = 'shared memory' if shared_step else 'pipes'
+        print(f'{name}: {n_steps / duration:.1f} steps/s '
+            f'({n_steps * n_envs / duration:.1f} env steps/s), '
+            f'{len(indices)} of {n_envs} envs: '
+            f'{n_steps / subset_duration:.1f} steps/s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+if __name__ == "__main__":
+    import sys
+    import os
+    import pathlib
+
+    ROOT_DIR = str(pathlib.Path(__file__).parent.parent.parent)
+    sys.path.append(ROOT_DIR)
+
+import os
+import time
+import click
+import shutil
+import tempfile
+import numpy as np
+import zarr
+import threadpoolctl
+from diffusion_policy.common.chunk_encoder import ChunkEncoder
+from diffusion_policy.codecs.imagecodecs_numcodecs import register_codecs, Jpeg2k
+register_codecs()
+
+@click.command()
+@click.option('--n_frames', '-n', default=200, type=int)
+@click.option('--resolution', '-r', default='320x240')
+@click.option('--n_workers', '-w', default=-1, type=int)
+@click.option('--store', '-s', default='memory', type=click.Choice(['memory', 'directory']))
+def main(n_frames, resolution, n_workers, store):
+    """
+    Compare image encoding throughput of thread and process ChunkEncoder.
+    """
+    w, h = tuple(int(x) for x in resolution.split('x'))
+    # smooth images, similar compression work to camera frames
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 255, size=(n_frames, h // 8, w // 8, 3), dtype=np.uint8)
+    frames = np.repeat(np.repeat(base, 8, axis=1), 8, axis=2)
+    noise = rng.integers(0, 16, size=frames.shape, dtype=np.uint8)
+    frames = frames + noise
+
+    with threadpoolctl.threadpool_limits(1):
+        for mode in ['thread', 'process']:
+            tmp_dir = None
+            if store == 'directory':
+                tmp_dir = tempfile.mkdtemp()
+                out_store = zarr.DirectoryStore(tmp_dir)
+            else:
+                out_store = zarr.MemoryStore()
+            arr = zarr.group(out_store).require_dataset(
+                name='camera_0',
+                shape=frames.shape,
+                chunks=(1,) + frames.shape[1:],
+                compressor=Jpeg2k(level=50),
+                dtype=np.uint8
+            )
+
+            start = time.monotonic()
+            with ChunkEncoder(mode=mode, n_workers=n_workers) as encoder:
+                for i, frame in enumerate(frames):
+                    encoder.put(arr, i, frame)
+            duration = time.monotonic() - start
+
+            assert arr.nchunks_initialized == n_frames
+            print(f'{mode}: {n_frames / duration:.1f} frames/s ({duration:.2f}s)')
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
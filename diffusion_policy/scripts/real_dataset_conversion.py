@@ -20,7 +20,8 @@ from diffusion_policy.real_world.real_data_conversion import real_data_to_replay
 @click.option('--resolution', '-r', default='640x480')
 @click.option('--n_decoding_threads', '-nd', default=-1, type=int)
 @click.option('--n_encoding_threads', '-ne', default=-1, type=int)
-def main(input, output, resolution, n_decoding_threads, n_encoding_threads):
+@click.option('--encode_mode', '-em', default='thread', type=click.Choice(['thread', 'process']))
+def main(input, output, resolution, n_decoding_threads, n_encoding_threads, encode_mode):
     out_resolution = tuple(int(x) for x in resolution.split('x'))
     input = pathlib.Path(os.path.expanduser(input))
     in_zarr_path = input.joinpath('replay_buffer.zarr')
@@ -41,7 +42,8 @@ def main(input, output, resolution, n_decoding_threads, n_encoding_threads):
             dataset_path=str(input),
             out_resolutions=out_resolution,
             n_decoding_threads=n_decoding_threads,
-            n_encoding_threads=n_encoding_threads
+            n_encoding_threads=n_encoding_threads,
+            encode_mode=encode_mode
         )
     
     print('Saving to disk')
@@ -8,6 +8,9 @@ from omegaconf import OmegaConf
 import dill
 import torch
 import threading
+from diffusion_policy.common.sharded_checkpoint import (
+    is_sharded_checkpoint, save_sharded_checkpoint, load_sharded_checkpoint)
+from diffusion_policy.common.checkpoint_util import remove_checkpoint
 
 
 class BaseWorkspace:
@@ -35,7 +38,17 @@ class BaseWorkspace:
     def save_checkpoint(self, path=None, tag='latest', 
             exclude_keys=None,
             include_keys=None,
-            use_thread=True):
+            use_thread=True,
+            format=None):
+        """
+        format: 'torch' for a single torch.save file, 'sharded' for
+        a directory of lazily loaded state dict shards
+        (see diffusion_policy/common/sharded_checkpoint.py).
+        Defaults to cfg.checkpoint.format or 'torch'.
+        """
+        if format is None:
+            format = OmegaConf.select(self.cfg, 'checkpoint.format', default='torch')
+        assert format in ('torch', 'sharded')
         if path is None:
             path = pathlib.Path(self.output_dir).joinpath('checkpoints', f'{tag}.ckpt')
         else:
@@ -62,26 +75,46 @@ class BaseWorkspace:
                         payload['state_dicts'][key] = value.state_dict()
             elif key in include_keys:
                 payload['pickles'][key] = dill.dumps(value)
+        if format == 'sharded':
+            # identical shards across checkpoints in this dir are hard-linked
+            save_fn = lambda : save_sharded_checkpoint(path, payload,
+                shard_store=path.parent.joinpath('.shards'))
+        else:
+            def save_fn():
+                if is_sharded_checkpoint(path):
+                    # checkpoint.format switched from sharded
+                    remove_checkpoint(path)
+                torch.save(payload, path.open('wb'), pickle_module=dill)
         if use_thread:
-            self._saving_thread = threading.Thread(
-                target=lambda : torch.save(payload, path.open('wb'), pickle_module=dill))
+            self._saving_thread = threading.Thread(target=save_fn)
             self._saving_thread.start()
         else:
-            torch.save(payload, path.open('wb'), pickle_module=dill)
+            save_fn()
         return str(path.absolute())
     
     def get_checkpoint_path(self, tag='latest'):
         return pathlib.Path(self.output_dir).joinpath('checkpoints', f'{tag}.ckpt')
 
+    @staticmethod
+    def is_checkpoint(path) -> bool:
+        """
+        Whether path is a checkpoint of either format,
+        sharded checkpoints are directories.
+        """
+        path = pathlib.Path(path)
+        return path.is_file() or is_sharded_checkpoint(path)
+
     def load_payload(self, payload, exclude_keys=None, include_keys=None, **kwargs):
         if exclude_keys is None:
             exclude_keys = tuple()
         if include_keys is None:
             include_keys = payload['pickles'].keys()
 
-        for key, value in payload['state_dicts'].items():
+        # only access loaded state dicts, sharded checkpoints load lazily
+        for key in payload['state_dicts'].keys():
             if key not in exclude_keys:
-                self.__dict__[key].load_state_dict(value, **kwargs)
+                self.__dict__[key].load_state_dict(
+                    payload['state_dicts'][key], **kwargs)
         for key in include_keys:
             if key in payload['pickles']:
                 self.__dict__[key] = dill.loads(payload['pickles'][key])
@@ -94,7 +127,7 @@ class BaseWorkspace:
             path = self.get_checkpoint_path(tag=tag)
         else:
             path = pathlib.Path(path)
-        payload = torch.load(path.open('rb'), pickle_module=dill, **kwargs)
+        payload = self.load_checkpoint_payload(path, **kwargs)
         self.load_payload(payload, 
             exclude_keys=exclude_keys, 
             include_keys=include_keys)
@@ -105,7 +138,10 @@ class BaseWorkspace:
             exclude_keys=None, 
             include_keys=None,
             **kwargs):
-        payload = torch.load(open(path, 'rb'), pickle_module=dill)
+        payload = cls.load_checkpoint_payload(path)
+        if cls is BaseWorkspace:
+            # resolve the concrete workspace class from the checkpoint
+            cls = hydra.utils.get_class(payload['cfg']._target_)
         instance = cls(payload['cfg'])
         instance.load_payload(
             payload=payload, 
@@ -114,6 +150,16 @@ class BaseWorkspace:
             **kwargs)
         return instance
 
+    @staticmethod
+    def load_checkpoint_payload(path, **kwargs):
+        """
+        Reads a checkpoint of either format.
+        For sharded checkpoints state dicts are loaded on access.
+        """
+        if is_sharded_checkpoint(path):
+            return load_sharded_checkpoint(path)
+        return torch.load(open(path, 'rb'), pickle_module=dill, **kwargs)
+
     def save_snapshot(self, tag='latest'):
         """
         Quick loading and saving for reserach, saves full state of the workspace.
@@ -12,7 +12,7 @@ import hydra
 import torch
 from omegaconf import OmegaConf
 import pathlib
-from torch.utils.data import DataLoader
+from diffusion_policy.common.dataloader_util import create_dataloader
 import copy
 import random
 import wandb
@@ -66,7 +66,7 @@ class TrainBETLowdimWorkspace(BaseWorkspace):
         # resume training
         if cfg.training.resume:
             lastest_ckpt_path = self.get_checkpoint_path()
-            if lastest_ckpt_path.is_file():
+            if self.is_checkpoint(lastest_ckpt_path):
                 print(f"Resuming from checkpoint {lastest_ckpt_path}")
                 self.load_checkpoint(path=lastest_ckpt_path)
 
@@ -74,11 +74,11 @@ class TrainBETLowdimWorkspace(BaseWorkspace):
         dataset: BaseLowdimDataset
         dataset = hydra.utils.instantiate(cfg.task.dataset)
         assert isinstance(dataset, BaseLowdimDataset)
-        train_dataloader = DataLoader(dataset, **cfg.dataloader)
+        train_dataloader = create_dataloader(dataset, **cfg.dataloader)
 
         # configure validation dataset
         val_dataset = dataset.get_validation_dataset()
-        val_dataloader = DataLoader(val_dataset, **cfg.val_dataloader)
+        val_dataloader = create_dataloader(val_dataset, **cfg.val_dataloader)
 
         # set normalizer
         normalizer = None
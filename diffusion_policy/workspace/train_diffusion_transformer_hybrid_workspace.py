@@ -8,12 +8,14 @@ if __name__ == "__main__":
     os.chdir(ROOT_DIR)
 
 import os
+import time
 import hydra
 import torch
 from omegaconf import OmegaConf
 import pathlib
-from torch.utils.data import DataLoader
+from diffusion_policy.common.dataloader_util import create_dataloader
 import copy
+import contextlib
 import random
 import wandb
 import tqdm
@@ -23,9 +25,11 @@ from diffusion_policy.workspace.base_workspace import BaseWorkspace
 from diffusion_policy.policy.diffusion_transformer_hybrid_image_policy import DiffusionTransformerHybridImagePolicy
 from diffusion_policy.dataset.base_dataset import BaseImageDataset
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
-from diffusion_policy.common.checkpoint_util import TopKCheckpointManager
+from diffusion_policy.env_runner.async_env_runner import AsyncEnvRunner
+from diffusion_policy.common.checkpoint_util import TopKCheckpointManager, remove_checkpoint
 from diffusion_policy.common.json_logger import JsonLogger
-from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to
+from diffusion_policy.common import dist_util
+from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to, uint8_images_to_float
 from diffusion_policy.model.diffusion.ema_model import EMAModel
 from diffusion_policy.model.common.lr_scheduler import get_scheduler
 
@@ -60,10 +64,20 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
     def run(self):
         cfg = copy.deepcopy(self.cfg)
 
+        # distributed data parallel, if launched with torchrun
+        device = dist_util.init_distributed(
+            device=cfg.training.device,
+            backend=OmegaConf.select(cfg, 'training.ddp_backend'),
+            timeout_sec=OmegaConf.select(cfg, 'training.ddp_timeout_sec', default=7200))
+        is_main = dist_util.is_main_process()
+        if dist_util.is_distributed():
+            # all ranks resume from the output dir of rank 0
+            self._output_dir = dist_util.broadcast_object(self.output_dir)
+
         # resume training
         if cfg.training.resume:
             lastest_ckpt_path = self.get_checkpoint_path()
-            if lastest_ckpt_path.is_file():
+            if self.is_checkpoint(lastest_ckpt_path):
                 print(f"Resuming from checkpoint {lastest_ckpt_path}")
                 self.load_checkpoint(path=lastest_ckpt_path)
 
@@ -71,12 +85,13 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
         dataset: BaseImageDataset
         dataset = hydra.utils.instantiate(cfg.task.dataset, val_dataset_path=cfg.task.val_dataset_path)
         assert isinstance(dataset, BaseImageDataset)
-        train_dataloader = DataLoader(dataset, **cfg.dataloader)
+        train_dataloader = create_dataloader(dataset,
+            shard=True, seed=cfg.training.seed, **cfg.dataloader)
         normalizer = dataset.get_normalizer()
 
         # configure validation dataset
         val_dataset = dataset.get_validation_dataset()
-        val_dataloader = DataLoader(val_dataset, **cfg.val_dataloader)
+        val_dataloader = create_dataloader(val_dataset, **cfg.val_dataloader)
 
         self.model.set_normalizer(normalizer)
         if cfg.training.use_ema:
@@ -97,42 +112,104 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
 
         # configure ema
         ema: EMAModel = None
-        if cfg.training.use_ema:
+        if cfg.training.use_ema and is_main:
             ema = hydra.utils.instantiate(
                 cfg.ema,
                 model=self.ema_model)
 
         # configure env
-        env_runner: BaseImageRunner
-        env_runner = hydra.utils.instantiate(
-            cfg.task.env_runner,
-            output_dir=self.output_dir)
-        assert isinstance(env_runner, BaseImageRunner)
+        env_runner: BaseImageRunner = None
+        if is_main and cfg.training.async_rollout:
+            # rollouts run on policy snapshots in a subprocess,
+            # training continues meanwhile
+            env_runner = AsyncEnvRunner(
+                cfg.task.env_runner,
+                output_dir=self.output_dir,
+                policy=self.ema_model if cfg.training.use_ema else self.model,
+                device=device)
+            env_runner.start()
+        elif is_main:
+            env_runner = hydra.utils.instantiate(
+                cfg.task.env_runner,
+                output_dir=self.output_dir)
+            assert isinstance(env_runner, BaseImageRunner)
 
         # configure logging
-        wandb_run = wandb.init(
-            dir=str(self.output_dir),
-            config=OmegaConf.to_container(cfg, resolve=True),
-            **cfg.logging
-        )
-        wandb.config.update(
-            {
-                "output_dir": self.output_dir,
-            }
-        )
+        wandb_run = None
+        if is_main:
+            wandb_run = wandb.init(
+                dir=str(self.output_dir),
+                config=OmegaConf.to_container(cfg, resolve=True),
+                **cfg.logging
+            )
+            wandb.config.update(
+                {
+                    "output_dir": self.output_dir,
+                }
+            )
+            if cfg.training.async_rollout:
+                # plot async rollout results over the step of their snapshot
+                wandb_run.define_metric('rollout_global_step')
 
         # configure checkpoint
         topk_manager = TopKCheckpointManager(
             save_dir=os.path.join(self.output_dir, 'checkpoints'),
             **cfg.checkpoint.topk
         )
+        # adaptive eval stops early on checkpoints that can't make the top-k
+        adaptive_eval = cfg.task.env_runner.get('adaptive_eval', False) \
+            and topk_manager.monitor_key.endswith('test_mean_score') \
+            and (topk_manager.mode == 'max')
+
+        # async rollouts in flight
+        # epoch: (step_log, pending checkpoint path, saving thread)
+        async_rollouts = dict()
+        # runner keys bound to rollout_global_step, e.g. Panda/test/mean_score
+        rollout_metric_keys = set()
+        def log_async_rollouts(json_logger, block=False):
+            for epoch, runner_log in env_runner.poll(block=block):
+                step_log, pending_ckpt_path, saving_thread = async_rollouts.pop(epoch)
+                for key in runner_log.keys():
+                    if key not in rollout_metric_keys:
+                        wandb_run.define_metric(key, step_metric='rollout_global_step')
+                        rollout_metric_keys.add(key)
+                # logged at the step of the policy snapshot
+                rollout_log = {
+                    'global_step': step_log['global_step'],
+                    'epoch': epoch
+                }
+                rollout_log.update(runner_log)
+                wandb_run.log(dict(runner_log,
+                    rollout_global_step=step_log['global_step']),
+                    step=self.global_step)
+                json_logger.log(rollout_log)
+                if pending_ckpt_path is None:
+                    continue
+
+                # rank the checkpoint saved at the snapshot
+                metric_dict = dict()
+                for key, value in dict(step_log, **runner_log).items():
+                    new_key = key.replace('/', '_')
+                    metric_dict[new_key] = value
+                topk_ckpt_path = topk_manager.get_ckpt_path(metric_dict)
+                if saving_thread is not None:
+                    saving_thread.join()
+                if topk_ckpt_path is not None:
+                    os.replace(pending_ckpt_path, topk_ckpt_path)
+                else:
+                    remove_checkpoint(pending_ckpt_path)
 
         # device transfer
-        device = torch.device(cfg.training.device)
         self.model.to(device)
         if self.ema_model is not None:
             self.ema_model.to(device)
         optimizer_to(self.optimizer, device)
+
+        # all-reduces gradients if distributed
+        compute_loss = dist_util.wrap_compute_loss(self.model, device)
+        if dist_util.is_distributed():
+            # model init is identical, noise and augmentation differ per rank
+            torch.manual_seed(cfg.training.seed + dist_util.get_rank())
         
         # save batch for sampling
         train_sampling_batch = None
@@ -148,21 +225,26 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
 
         # training loop
         log_path = os.path.join(self.output_dir, 'logs.json.txt')
-        with JsonLogger(log_path) as json_logger:
+        json_logger_context = contextlib.nullcontext()
+        if is_main:
+            json_logger_context = JsonLogger(log_path)
+        with json_logger_context as json_logger:
             for local_epoch_idx in range(cfg.training.num_epochs):
                 step_log = dict()
                 # ========= train for this epoch ==========
                 train_losses = list()
                 with tqdm.tqdm(train_dataloader, desc=f"Training epoch {self.epoch}", 
-                        leave=False, mininterval=cfg.training.tqdm_interval_sec) as tepoch:
+                        leave=False, mininterval=cfg.training.tqdm_interval_sec,
+                        disable=not is_main) as tepoch:
+                    step_start_time = time.monotonic()
                     for batch_idx, batch in enumerate(tepoch):
                         # device transfer
-                        batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+                        batch = dict_apply(batch, lambda x: uint8_images_to_float(x.to(device, non_blocking=True)))
                         if train_sampling_batch is None:
                             train_sampling_batch = batch
 
                         # compute loss
-                        raw_loss = self.model.compute_loss(batch)
+                        raw_loss = compute_loss(batch)
                         loss = raw_loss / cfg.training.gradient_accumulate_every
                         loss.backward()
 
@@ -173,25 +255,35 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
                             lr_scheduler.step()
                         
                         # update ema
-                        if cfg.training.use_ema:
+                        if ema is not None:
                             ema.step(self.model)
 
                         # logging
-                        raw_loss_cpu = raw_loss.item()
+                        raw_loss_cpu = dist_util.all_reduce_mean(raw_loss).item()
+                        # throughput, including data loading
+                        step_end_time = time.monotonic()
+                        step_time = max(step_end_time - step_start_time, 1e-9)
+                        step_start_time = step_end_time
+                        # of all ranks
+                        n_samples = len(batch['action']) * dist_util.get_world_size()
                         tepoch.set_postfix(loss=raw_loss_cpu, refresh=False)
                         train_losses.append(raw_loss_cpu)
                         step_log = {
                             'train_loss': raw_loss_cpu,
                             'global_step': self.global_step,
                             'epoch': self.epoch,
-                            'lr': lr_scheduler.get_last_lr()[0]
+                            'lr': lr_scheduler.get_last_lr()[0],
+                            'samples_per_sec': n_samples / step_time,
+                            'denoiser_updates_per_sec': n_samples \
+                                * self.model.n_noise_samples / step_time
                         }
 
                         is_last_batch = (batch_idx == (len(train_dataloader)-1))
                         if not is_last_batch:
                             # log of last step is combined with validation and rollout
-                            wandb_run.log(step_log, step=self.global_step)
-                            json_logger.log(step_log)
+                            if is_main:
+                                wandb_run.log(step_log, step=self.global_step)
+                                json_logger.log(step_log)
                             self.global_step += 1
 
                         if (cfg.training.max_train_steps is not None) \
@@ -203,86 +295,116 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
                 train_loss = np.mean(train_losses)
                 step_log['train_loss'] = train_loss
 
-                # ========= eval for this epoch ==========
-                policy = self.model
-                if cfg.training.use_ema:
-                    policy = self.ema_model
-                policy.eval()
-
-                # run rollout
-                if (self.epoch % cfg.training.rollout_every) == 0:
-                    runner_log = env_runner.run(policy)
-                    # log all
-                    step_log.update(runner_log)
-
-                # run validation
-                if (self.epoch % cfg.training.val_every) == 0:
-                    with torch.no_grad():
-                        val_losses = list()
-                        with tqdm.tqdm(val_dataloader, desc=f"Validation epoch {self.epoch}", 
-                                leave=False, mininterval=cfg.training.tqdm_interval_sec) as tepoch:
-                            for batch_idx, batch in enumerate(tepoch):
-                                batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
-                                loss = self.model.compute_loss(batch)
-                                val_losses.append(loss)
-                                if (cfg.training.max_val_steps is not None) \
-                                    and batch_idx >= (cfg.training.max_val_steps-1):
-                                    break
-                        if len(val_losses) > 0:
-                            val_loss = torch.mean(torch.tensor(val_losses)).item()
-                            # log epoch average validation loss
-                            step_log['val_loss'] = val_loss
-
-                # run diffusion sampling on a training batch
-                if (self.epoch % cfg.training.sample_every) == 0:
-                    with torch.no_grad():
-                        # sample trajectory from training set, and evaluate difference
-                        batch = dict_apply(train_sampling_batch, lambda x: x.to(device, non_blocking=True))
-                        obs_dict = batch['obs']
-                        gt_action = batch['action']
+                # validation, rollout, checkpoint and logging on rank 0,
+                # the other ranks wait for it
+                if is_main:
+                    # ========= eval for this epoch ==========
+                    policy = self.model
+                    if cfg.training.use_ema:
+                        policy = self.ema_model
+                        # averaged weights can be kept off device, see EMAModel
+                        policy.to(device)
+                    policy.eval()
+
+                    # run rollout
+                    if (self.epoch % cfg.training.rollout_every) == 0:
+                        runner_kwargs = dict()
+                        if adaptive_eval:
+                            runner_kwargs['score_threshold'] = topk_manager.get_threshold()
+                        if cfg.training.async_rollout:
+                            # logged when done, see log_async_rollouts
+                            env_runner.submit(policy, tag=self.epoch, **runner_kwargs)
+                            async_rollouts[self.epoch] = (step_log, None, None)
+                        else:
+                            runner_log = env_runner.run(policy, **runner_kwargs)
+                            # log all
+                            step_log.update(runner_log)
+
+                    # run validation
+                    if (self.epoch % cfg.training.val_every) == 0:
+                        with torch.no_grad():
+                            val_losses = list()
+                            with tqdm.tqdm(val_dataloader, desc=f"Validation epoch {self.epoch}", 
+                                    leave=False, mininterval=cfg.training.tqdm_interval_sec) as tepoch:
+                                for batch_idx, batch in enumerate(tepoch):
+                                    batch = dict_apply(batch, lambda x: uint8_images_to_float(x.to(device, non_blocking=True)))
+                                    loss = self.model.compute_loss(batch)
+                                    val_losses.append(loss)
+                                    if (cfg.training.max_val_steps is not None) \
+                                        and batch_idx >= (cfg.training.max_val_steps-1):
+                                        break
+                            if len(val_losses) > 0:
+                                val_loss = torch.mean(torch.tensor(val_losses)).item()
+                                # log epoch average validation loss
+                                step_log['val_loss'] = val_loss
+
+                    # run diffusion sampling on a training batch
+                    if (self.epoch % cfg.training.sample_every) == 0:
+                        with torch.no_grad():
+                            # sample trajectory from training set, and evaluate difference
+                            batch = dict_apply(train_sampling_batch, lambda x: uint8_images_to_float(x.to(device, non_blocking=True)))
+                            obs_dict = batch['obs']
+                            gt_action = batch['action']
                         
-                        result = policy.predict_action(obs_dict)
-                        pred_action = result['action_pred']
-                        mse = torch.nn.functional.mse_loss(pred_action, gt_action)
-                        step_log['train_action_mse_error'] = mse.item()
-                        del batch
-                        del obs_dict
-                        del gt_action
-                        del result
-                        del pred_action
-                        del mse
+                            result = policy.predict_action(obs_dict)
+                            pred_action = result['action_pred']
+                            mse = torch.nn.functional.mse_loss(pred_action, gt_action)
+                            step_log['train_action_mse_error'] = mse.item()
+                            del batch
+                            del obs_dict
+                            del gt_action
+                            del result
+                            del pred_action
+                            del mse
                 
-                # checkpoint
-                if (self.epoch % cfg.training.checkpoint_every) == 0:
-                    # checkpointing
-                    if cfg.checkpoint.save_last_ckpt:
-                        self.save_checkpoint()
-                    if cfg.checkpoint.save_last_snapshot:
-                        self.save_snapshot()
-
-                    # sanitize metric names
-                    metric_dict = dict()
-                    for key, value in step_log.items():
-                        new_key = key.replace('/', '_')
-                        metric_dict[new_key] = value
+                    # checkpoint
+                    if (self.epoch % cfg.training.checkpoint_every) == 0:
+                        # checkpointing
+                        if cfg.checkpoint.save_last_ckpt:
+                            self.save_checkpoint()
+                        if cfg.checkpoint.save_last_snapshot:
+                            self.save_snapshot()
+
+                        # sanitize metric names
+                        metric_dict = dict()
+                        for key, value in step_log.items():
+                            new_key = key.replace('/', '_')
+                            metric_dict[new_key] = value
                     
-                    # We can't copy the last checkpoint here
-                    # since save_checkpoint uses threads.
-                    # therefore at this point the file might have been empty!
-                    topk_ckpt_path = topk_manager.get_ckpt_path(metric_dict)
-
-                    if topk_ckpt_path is not None:
-                        self.save_checkpoint(path=topk_ckpt_path)
-                # ========= eval end for this epoch ==========
-                policy.train()
-
-                # end of epoch
-                # log of last step is combined with validation and rollout
-                wandb_run.log(step_log, step=self.global_step)
-                json_logger.log(step_log)
+                        if self.epoch in async_rollouts:
+                            # ranked when the rollout results arrive
+                            pending_ckpt_path = os.path.join(self.output_dir,
+                                'checkpoints', f'pending_epoch={self.epoch:04d}.ckpt')
+                            self.save_checkpoint(path=pending_ckpt_path)
+                            async_rollouts[self.epoch] = (
+                                step_log, pending_ckpt_path, self._saving_thread)
+                        elif not cfg.training.async_rollout:
+                            # We can't copy the last checkpoint here
+                            # since save_checkpoint uses threads.
+                            # therefore at this point the file might have been empty!
+                            topk_ckpt_path = topk_manager.get_ckpt_path(metric_dict)
+
+                            if topk_ckpt_path is not None:
+                                self.save_checkpoint(path=topk_ckpt_path)
+                    # ========= eval end for this epoch ==========
+                    policy.train()
+
+                    if cfg.training.async_rollout:
+                        log_async_rollouts(json_logger)
+
+                    # end of epoch
+                    # log of last step is combined with validation and rollout
+                    wandb_run.log(step_log, step=self.global_step)
+                    json_logger.log(step_log)
+                dist_util.barrier()
                 self.global_step += 1
                 self.epoch += 1
 
+            if is_main and cfg.training.async_rollout:
+                # wait for the last rollouts
+                log_async_rollouts(json_logger, block=True)
+                env_runner.close()
+
 @hydra.main(
     version_base=None,
     config_path=str(pathlib.Path(__file__).parent.parent.joinpath("config")), 
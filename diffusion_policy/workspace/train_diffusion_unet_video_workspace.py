@@ -12,7 +12,7 @@ import hydra
 import torch
 from omegaconf import OmegaConf
 import pathlib
-from torch.utils.data import DataLoader
+from diffusion_policy.common.dataloader_util import create_dataloader
 import copy
 import random
 import wandb
@@ -63,7 +63,7 @@ class TrainDiffusionUnetVideoWorkspace(BaseWorkspace):
         # resume training
         if cfg.training.resume:
             lastest_ckpt_path = self.get_checkpoint_path()
-            if lastest_ckpt_path.is_file():
+            if self.is_checkpoint(lastest_ckpt_path):
                 print(f"Resuming from checkpoint {lastest_ckpt_path}")
                 self.load_checkpoint(path=lastest_ckpt_path)
 
@@ -71,7 +71,7 @@ class TrainDiffusionUnetVideoWorkspace(BaseWorkspace):
         dataset: BaseImageDataset
         dataset = hydra.utils.instantiate(cfg.task.dataset)
         assert isinstance(dataset, BaseImageDataset)
-        train_dataloader = DataLoader(dataset, **cfg.dataloader)
+        train_dataloader = create_dataloader(dataset, **cfg.dataloader)
         normalizer = dataset.get_normalizer()
 
         self.model.set_normalizer(normalizer)
@@ -174,6 +174,8 @@ class TrainDiffusionUnetVideoWorkspace(BaseWorkspace):
                         policy = self.model
                         if cfg.training.use_ema:
                             policy = self.ema_model
+                            # averaged weights can be kept off device, see EMAModel
+                            policy.to(device)
                         policy.eval()
                         runner_log = env_runner.run(policy)
                         policy.train()
@@ -198,6 +200,8 @@ class TrainDiffusionUnetVideoWorkspace(BaseWorkspace):
                         policy = self.model
                         if cfg.training.use_ema:
                             policy = self.ema_model
+                            # averaged weights can be kept off device, see EMAModel
+                            policy.to(device)
                         policy.eval()
                         with torch.no_grad():
                             # sample trajectory from training set, and evaluate difference
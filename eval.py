@@ -28,12 +28,17 @@ def main(checkpoint, output_dir, device):
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
     
     # load checkpoint
-    payload = torch.load(open(checkpoint, 'rb'), pickle_module=dill)
+    payload = BaseWorkspace.load_checkpoint_payload(checkpoint)
     cfg = payload['cfg']
     cls = hydra.utils.get_class(cfg._target_)
     workspace = cls(cfg, output_dir=output_dir)
     workspace: BaseWorkspace
-    workspace.load_payload(payload, exclude_keys=None, include_keys=None)
+    # skip state not needed for evaluation,
+    # sharded checkpoints don't read it from disk
+    exclude_keys = ['optimizer']
+    if cfg.training.use_ema:
+        exclude_keys.append('model')
+    workspace.load_payload(payload, exclude_keys=exclude_keys, include_keys=None)
     
     # get policy from workspace
     policy = workspace.model
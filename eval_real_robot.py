@@ -59,10 +59,11 @@ OmegaConf.register_new_resolver("eval", eval, replace=True)
 @click.option('--max_duration', '-md', default=60, help='Max duration for each epoch in seconds.')
 @click.option('--frequency', '-f', default=10, type=float, help="Control frequency in Hz.")
 @click.option('--command_latency', '-cl', default=0.01, type=float, help="Latency between receiving SapceMouse command to executing on Robot in Sec.")
+@click.option('--record_latency', '-rl', is_flag=True, default=False, help="Print per denoising step latency of diffusion policies.")
 def main(input, output, robot_ip, match_dataset, match_episode,
     vis_camera_idx, init_joints, 
     steps_per_inference, max_duration,
-    frequency, command_latency):
+    frequency, command_latency, record_latency):
     # load match_dataset
     match_camera_idx = 0
     episode_first_frame_map = dict()
@@ -80,12 +81,12 @@ def main(input, output, robot_ip, match_dataset, match_episode,
     
     # load checkpoint
     ckpt_path = input
-    payload = torch.load(open(ckpt_path, 'rb'), pickle_module=dill)
+    payload = BaseWorkspace.load_checkpoint_payload(ckpt_path)
     cfg = payload['cfg']
     cls = hydra.utils.get_class(cfg._target_)
     workspace = cls(cfg)
     workspace: BaseWorkspace
-    workspace.load_payload(payload, exclude_keys=None, include_keys=None)
+    workspace.load_payload(payload, exclude_keys=['optimizer'], include_keys=None)
 
     # hacks for method-specific setup.
     action_offset = 0
@@ -103,6 +104,8 @@ def main(input, output, robot_ip, match_dataset, match_episode,
         # set inference params
         policy.num_inference_steps = 16 # DDIM inference iterations
         policy.n_action_steps = policy.horizon - policy.n_obs_steps + 1
+        if record_latency:
+            policy.sampling_engine.record_latency = True
 
     elif 'robomimic' in cfg.name:
         # BCRNN model
@@ -198,7 +201,7 @@ def main(input, output, robot_ip, match_dataset, match_episode,
                     obs = env.get_obs()
 
                     # visualize
-                    episode_id = env.replay_buffer.n_episodes
+                    episode_id = env.episode_writer.n_episodes
                     vis_img = obs[f'camera_{vis_camera_idx}'][-1]
                     match_episode_id = episode_id
                     if match_episode is not None:
@@ -302,6 +305,9 @@ def main(input, output, robot_ip, match_dataset, match_episode,
                             # this action starts from the first obs step
                             action = result['action'][0].detach().to('cpu').numpy()
                             print('Inference latency:', time.time() - s)
+                            sampling_engine = getattr(policy, 'sampling_engine', None)
+                            if (sampling_engine is not None) and sampling_engine.record_latency:
+                                print('Sampling latency:', sampling_engine.get_latency_stats())
                         
                         # convert policy action to env actions
                         if delta_action:
@@ -348,7 +354,7 @@ def main(input, output, robot_ip, match_dataset, match_episode,
                         print(f"Submitted {len(this_target_poses)} steps of actions.")
 
                         # visualize
-                        episode_id = env.replay_buffer.n_episodes
+                        episode_id = env.episode_writer.n_episodes
                         vis_img = obs[f'camera_{vis_camera_idx}'][-1]
                         text = 'Episode: {}, Time: {:.1f}'.format(
                             episode_id, time.monotonic() - t_start
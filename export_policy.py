@@ -0,0 +1,53 @@
+"""
+Usage:
+python export_policy.py --checkpoint data/outputs/blah/checkpoints/latest.ckpt --output data/policy.pt
+
+Exports the policy to a TorchScript (.pt) or ONNX (.onnx) artifact,
+run it with diffusion_policy.common.export_util.ExportedPolicy.
+"""
+
+import sys
+# use line-buffering for both stdout and stderr
+sys.stdout = open(sys.stdout.fileno(), mode='w', buffering=1)
+sys.stderr = open(sys.stderr.fileno(), mode='w', buffering=1)
+
+import click
+import torch
+from diffusion_policy.workspace.base_workspace import BaseWorkspace
+from diffusion_policy.model.diffusion.sampling_engine import DiffusionSamplingEngine
+from diffusion_policy.common.export_util import export_policy, get_example_obs
+
+@click.command()
+@click.option('-c', '--checkpoint', required=True)
+@click.option('-o', '--output', required=True, help=".pt for TorchScript, .onnx for ONNX")
+@click.option('-d', '--device', default='cpu')
+@click.option('-b', '--batch_size', default=1, type=int)
+@click.option('-n', '--num_inference_steps', default=None, type=int)
+@click.option('-s', '--solver', default=None, type=click.Choice(['scheduler', 'ddim', 'dpmsolver++']))
+@click.option('--no_optimize', is_flag=True, default=False)
+def main(checkpoint, output, device, batch_size, num_inference_steps, solver, no_optimize):
+    workspace = BaseWorkspace.create_from_checkpoint(checkpoint)
+    cfg = workspace.cfg
+    policy = workspace.model
+    if cfg.training.use_ema:
+        policy = workspace.ema_model
+    policy.eval().to(torch.device(device))
+
+    if num_inference_steps is not None:
+        policy.num_inference_steps = num_inference_steps
+    if solver is not None:
+        policy.sampling_engine = DiffusionSamplingEngine(
+            policy.noise_scheduler, solver=solver)
+
+    example_obs = get_example_obs(policy,
+        shape_meta=cfg.get('shape_meta', None),
+        batch_size=batch_size)
+    meta = export_policy(policy, output,
+        example_obs=example_obs,
+        format='onnx' if output.endswith('.onnx') else 'torchscript',
+        optimize=not no_optimize)
+    print(f'Exported to {output}')
+    print(meta)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Usage:
+python serve_policy.py --checkpoint data/outputs/blah/checkpoints/latest.ckpt --address /tmp/diffusion_policy.sock
+
+Serves predict_action to multiple robots or eval processes,
+batching concurrent requests, see diffusion_policy/real_world/policy_server.py
+"""
+
+import sys
+# use line-buffering for both stdout and stderr
+sys.stdout = open(sys.stdout.fileno(), mode='w', buffering=1)
+sys.stderr = open(sys.stderr.fileno(), mode='w', buffering=1)
+
+import click
+from diffusion_policy.real_world.policy_server import (
+    PolicyServer, load_policy_from_checkpoint)
+
+@click.command()
+@click.option('-c', '--checkpoint', required=True)
+@click.option('-a', '--address', default='/tmp/diffusion_policy.sock', help="Unix socket path, or host:port for TCP.")
+@click.option('-d', '--device', default='cuda:0')
+@click.option('-b', '--max_batch_size', default=32, type=int)
+@click.option('-w', '--max_wait_ms', default=5.0, type=float, help="Time to wait for more requests to batch.")
+@click.option('-n', '--num_inference_steps', default=None, type=int)
+@click.option('--authkey', default=None, type=str, help="Required for TCP, generated next to the socket for unix sockets.")
+@click.option('--metrics_interval', default=10.0, type=float, help="Print metrics every N sec.")
+def main(checkpoint, address, device, max_batch_size, max_wait_ms,
+        num_inference_steps, authkey, metrics_interval):
+    policy = load_policy_from_checkpoint(checkpoint, device=device)
+    if num_inference_steps is not None:
+        policy.num_inference_steps = num_inference_steps
+
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        address = (host, int(port))
+    server = PolicyServer(policy,
+        address=address,
+        authkey=None if authkey is None else authkey.encode(),
+        max_batch_size=max_batch_size,
+        max_wait=max_wait_ms / 1000)
+    print(f'Serving policy on {address}')
+    server.serve_forever(metrics_interval=metrics_interval)
+
+if __name__ == '__main__':
+    main()
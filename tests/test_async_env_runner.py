@@ -0,0 +1,61 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import time
+import torch
+import torch.nn as nn
+import pytest
+from diffusion_policy.env_runner.async_env_runner import AsyncEnvRunner
+
+
+class SumRunner:
+    def __init__(self, output_dir, delay=0.0):
+        self.output_dir = output_dir
+        self.delay = delay
+
+    def run(self, policy):
+        time.sleep(self.delay)
+        value = policy.weight.sum().item()
+        if value < 0:
+            raise ValueError('negative weights')
+        return {'test/mean_score': value}
+
+
+def test_async_env_runner(tmp_path):
+    policy = nn.Linear(2, 2, bias=False)
+    runner_cfg = {
+        '_target_': 'test_async_env_runner.SumRunner',
+        'delay': 0.5
+    }
+    env_runner = AsyncEnvRunner(runner_cfg, output_dir=str(tmp_path), policy=policy)
+    env_runner.start()
+    try:
+        for epoch in range(3):
+            with torch.no_grad():
+                policy.weight.fill_(epoch)
+            env_runner.submit(policy, tag=epoch)
+        # submit doesn't wait for rollouts to finish
+        results = env_runner.poll()
+        assert len(results) < 3
+        results += env_runner.poll(block=True)
+        # each rollout used the weights at its submission
+        assert results == [(epoch, {'test/mean_score': epoch * 4.0})
+            for epoch in range(3)]
+
+        with torch.no_grad():
+            policy.weight.fill_(-1)
+        env_runner.submit(policy, tag=3)
+        with pytest.raises(RuntimeError, match='negative weights'):
+            env_runner.poll(block=True)
+    finally:
+        env_runner.close()
+    assert not env_runner.is_alive()
+
+
+if __name__ == "__main__":
+    import pathlib, tempfile
+    test_async_env_runner(pathlib.Path(tempfile.mkdtemp()))
@@ -0,0 +1,65 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import numpy as np
+import gym
+import pytest
+from gym import spaces
+from diffusion_policy.gym_util.async_vector_env import AsyncVectorEnv
+
+
+class SumEnv(gym.Env):
+    def __init__(self, info_size=1):
+        self.observation_space = spaces.Box(
+            low=-np.inf, high=np.inf, shape=(4,), dtype=np.float32)
+        self.action_space = spaces.Box(
+            low=-1, high=1, shape=(8,2), dtype=np.float32)
+        self.info_size = info_size
+
+    def reset(self):
+        self.t = 0
+        return np.zeros(4, dtype=np.float32)
+
+    def step(self, action):
+        if np.any(np.abs(action) > 1):
+            raise ValueError('action out of bounds')
+        self.t += 1
+        info = {'action': action, 'pad': np.zeros(self.info_size)}
+        return np.full(4, action.sum(), dtype=np.float32), \
+            float(action.sum()), self.t >= 2, info
+
+
+def test_shared_step():
+    # info of env 1 doesn't fit the shared info buffer
+    env_fns = [lambda info_size=info_size: SumEnv(info_size)
+        for info_size in [1, 10000, 1, 1]]
+    actions = np.random.uniform(-1, 1, size=(4,8,2))
+    for shared_step in [True, False]:
+        env = AsyncVectorEnv(env_fns, shared_step=shared_step,
+            info_buffer_size=1024)
+        assert (env._step_channel is not None) == shared_step
+        env.reset()
+        obs, reward, done, info = env.step(actions)
+        assert np.allclose(reward, actions.sum(axis=(1,2)))
+        assert np.allclose(obs[:,0], reward)
+        assert not np.any(done)
+        assert np.array_equal(info[2]['action'], actions[2])
+        assert info[1]['pad'].shape == (10000,)
+
+        indices = [1, 3]
+        obs, reward, done, info = env.step(actions[indices], indices=indices)
+        assert np.allclose(reward, actions[indices].sum(axis=(1,2)))
+        assert np.all(done)
+        assert env.call('t') == (1, 2, 1, 2)
+
+        with pytest.raises(ValueError, match='out of bounds'):
+            env.step(np.full((1,8,2), 2.0), indices=[0])
+        env.close(terminate=True)
+
+
+if __name__ == "__main__":
+    test_shared_step()
@@ -0,0 +1,40 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import tempfile
+import numpy as np
+import zarr
+import numcodecs
+from diffusion_policy.common.chunk_encoder import ChunkEncoder
+
+
+def test_chunk_encoder():
+    frames = np.random.default_rng(0).integers(
+        0, 255, size=(10,4,4,3)).astype(np.uint8)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode in ['thread', 'process']:
+            for store in [zarr.MemoryStore(),
+                    zarr.DirectoryStore(os.path.join(tmp_dir, mode))]:
+                arr = zarr.group(store).require_dataset(
+                    name='img',
+                    shape=frames.shape,
+                    # last chunk is partial
+                    chunks=(3,4,4,3),
+                    compressor=numcodecs.Blosc(),
+                    dtype=np.uint8
+                )
+                n_stored = list()
+                with ChunkEncoder(mode=mode, n_workers=2,
+                        callback=lambda start, n: n_stored.append(n)) as encoder:
+                    for i in reversed(range(len(frames))):
+                        encoder.put(arr, i, frames[i])
+                assert sum(n_stored) == len(frames)
+                np.testing.assert_array_equal(arr[:], frames)
+
+
+if __name__ == "__main__":
+    test_chunk_encoder()
@@ -0,0 +1,99 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import tempfile
+import numpy as np
+import torch
+from diffusion_policy.common.replay_buffer import ReplayBuffer
+from diffusion_policy.common.sampler import SequenceSampler
+from diffusion_policy.common.dataloader_util import create_dataloader
+from diffusion_policy.common.chunk_prefetcher import ChunkPrefetchLoader
+
+
+class DummyDataset(torch.utils.data.Dataset):
+    def __init__(self, replay_buffer):
+        self.replay_buffer = replay_buffer
+        self.sampler = SequenceSampler(replay_buffer=replay_buffer,
+            sequence_length=6, pad_before=1, pad_after=3,
+            key_first_k={'img': 2})
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def get_batch(self, idxs):
+        return self.sampler.sample_batch(idxs)
+
+
+def test_chunk_prefetcher():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        zarr_path = os.path.join(tmp_dir, 'data.zarr')
+        buff = ReplayBuffer.create_from_path(zarr_path, mode='a')
+        for n in [20, 13, 31]:
+            buff.add_episode({
+                'obs': rng.normal(size=(n,3)).astype(np.float32),
+                'img': rng.integers(0, 255, size=(n,4,4,3)).astype(np.uint8)
+            }, chunks={'obs': (7,3), 'img': (5,4,4,3)})
+
+        dataset = DummyDataset(ReplayBuffer.create_from_path(zarr_path, mode='r'))
+        expected = DummyDataset(ReplayBuffer.create_from_path(zarr_path, mode='r'))
+        order = rng.permutation(len(dataset)).tolist()
+        dataloader = create_dataloader(dataset, batch_size=8, sampler=order,
+            num_workers=4, persistent_workers=True,
+            chunk_prefetch={'max_bytes': 2**12, 'n_threads': 2, 'lookahead': 3})
+        idxs = [order[i:i+8] for i in range(0, len(order), 8)]
+        assert len(dataloader) == len(idxs)
+        for batch, batch_idxs in zip(dataloader, idxs):
+            expected_batch = expected.get_batch(batch_idxs)
+            for key in ['obs', 'img']:
+                value = batch[key]
+                if key == 'img':
+                    value = value[:,:2]
+                    expected_batch[key] = expected_batch[key][:,:2]
+                np.testing.assert_array_equal(value, expected_batch[key])
+
+        stats = dataset.replay_buffer.chunk_prefetcher.get_stats()
+        assert stats['n_hits'] + stats['n_stalls'] > 0
+        assert stats['n_bytes'] <= 2**12
+
+
+def test_chunk_prefetcher_pinning():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        zarr_path = os.path.join(tmp_dir, 'data.zarr')
+        buff = ReplayBuffer.create_from_path(zarr_path, mode='a')
+        buff.add_episode({
+            'obs': np.arange(25*3, dtype=np.float32).reshape(25,3)
+        }, chunks={'obs': (5,3)})
+        replay_buffer = ReplayBuffer.create_from_path(zarr_path, mode='r')
+        expected = replay_buffer.data['obs'][:]
+        # room for 3 chunks, fewer than the lookahead
+        prefetcher = replay_buffer.set_chunk_prefetcher(
+            max_bytes=3*5*3*4, n_threads=2)
+        dataset = DummyDataset(replay_buffer)
+        dataset.sampler = SequenceSampler(replay_buffer=replay_buffer,
+            sequence_length=1)
+        # each batch reads one chunk, some are reused
+        chunk_order = [0, 1, 2, 0, 3, 1, 4, 2, 0]
+        batches = [list(range(i*5, i*5+5)) for i in chunk_order]
+        loader = ChunkPrefetchLoader(dataset, batches, prefetcher, lookahead=4)
+        for batch, idxs in zip(loader, batches):
+            np.testing.assert_array_equal(batch['obs'][:,0], expected[idxs])
+        stats = prefetcher.get_stats()
+        assert stats['n_misses'] == 0
+        assert stats['n_hits'] + stats['n_stalls'] == len(batches)
+        assert stats['n_bytes'] <= 3*5*3*4
+        assert len(prefetcher.pins) == 0
+
+        # pins are released when iteration stops early
+        for batch in loader:
+            break
+        assert len(prefetcher.pins) == 0
+
+
+if __name__ == "__main__":
+    test_chunk_prefetcher()
+    test_chunk_prefetcher_pinning()
@@ -0,0 +1,33 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+from diffusion_policy.model.diffusion.conditional_unet1d import ConditionalUnet1D
+
+
+def test_cond_cache():
+    torch.manual_seed(0)
+    for cond_predict_scale in [True, False]:
+        model = ConditionalUnet1D(input_dim=4, local_cond_dim=3, global_cond_dim=8,
+            diffusion_step_embed_dim=16, down_dims=[32,64],
+            cond_predict_scale=cond_predict_scale).eval()
+        sample = torch.randn(5,16,4)
+        local_cond = torch.randn(5,16,3)
+        global_cond = torch.randn(5,8)
+        with torch.no_grad():
+            cond_cache = model.encode_global_cond(global_cond)
+            for t in [0, 42, 99]:
+                expected = model(sample, t,
+                    local_cond=local_cond, global_cond=global_cond)
+                result = model(sample, t,
+                    local_cond=local_cond, global_cond=global_cond,
+                    cond_cache=cond_cache)
+                assert torch.allclose(result, expected, atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_cond_cache()
@@ -0,0 +1,121 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import socket
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+from diffusion_policy.common import dist_util
+from diffusion_policy.common.dataloader_util import (
+    create_dataloader, DistributedShardSampler)
+
+
+class LinearPolicy(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.net = nn.Linear(3, 2)
+
+    def compute_loss(self, batch):
+        return nn.functional.mse_loss(self.net(batch['obs']), batch['action'])
+
+
+class ToyDataset(torch.utils.data.Dataset):
+    def __init__(self, n):
+        self.obs = torch.randn(n, 3, generator=torch.Generator().manual_seed(1))
+        self.action = torch.randn(n, 2, generator=torch.Generator().manual_seed(2))
+
+    def __len__(self):
+        return len(self.obs)
+
+    def __getitem__(self, idx):
+        return {'obs': self.obs[idx], 'action': self.action[idx]}
+
+
+def _worker(rank, world_size, port, queue):
+    os.environ.update({
+        'RANK': str(rank),
+        'LOCAL_RANK': str(rank),
+        'WORLD_SIZE': str(world_size),
+        'MASTER_ADDR': '127.0.0.1',
+        'MASTER_PORT': str(port)
+    })
+    device = dist_util.init_distributed(device='cpu', timeout_sec=60)
+    assert dist_util.get_world_size() == world_size
+    # also on hosts with gpus
+    assert torch.distributed.get_backend() == 'gloo'
+
+    dataset = ToyDataset(8)
+    dataloader = create_dataloader(dataset,
+        batch_size=2, shuffle=True, shard=True, seed=0)
+    epochs = [sum([batch['obs'].tolist() for batch in dataloader], [])
+        for _ in range(2)]
+
+    torch.manual_seed(0)
+    model = LinearPolicy()
+    compute_loss = dist_util.wrap_compute_loss(model, device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    batch = dataset[rank*4:(rank+1)*4]
+    loss = compute_loss(batch)
+    loss.backward()
+    optimizer.step()
+    mean_loss = dist_util.all_reduce_mean(loss).item()
+    output_dir = dist_util.broadcast_object(f'rank{rank}')
+    queue.put((rank, epochs, model.net.weight.tolist(), mean_loss, output_dir))
+    dist_util.barrier()
+
+
+def test_shard_sampler():
+    idxs = list()
+    for rank in range(3):
+        sampler = DistributedShardSampler(range(10), num_replicas=3, rank=rank)
+        assert len(sampler) == 4
+        idxs.extend(sampler)
+    # padded with the first indices
+    assert sorted(idxs) == [0,0,1] + list(range(1,10))
+
+
+def test_dist_util():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    world_size = 2
+    procs = [ctx.Process(target=_worker, args=(rank, world_size, port, queue))
+        for rank in range(world_size)]
+    for p in procs:
+        p.start()
+    results = sorted([queue.get(timeout=120) for _ in procs], key=lambda x: x[0])
+    for p in procs:
+        p.join(timeout=60)
+        assert p.exitcode == 0
+
+    dataset = ToyDataset(8)
+    all_obs = sorted(dataset.obs.tolist())
+    for epoch in range(2):
+        # disjoint shards covering the dataset
+        shards = [r[1][epoch] for r in results]
+        assert sorted(shards[0] + shards[1]) == all_obs
+    # reshuffled every epoch
+    assert results[0][1][0] != results[0][1][1]
+
+    # all-reduced gradients match the full batch on a single process
+    torch.manual_seed(0)
+    model = LinearPolicy()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    loss = model.compute_loss(dataset[:8])
+    loss.backward()
+    optimizer.step()
+    for _, _, weight, mean_loss, output_dir in results:
+        assert torch.allclose(torch.tensor(weight), model.net.weight, atol=1e-6)
+        assert abs(mean_loss - loss.item()) < 1e-6
+        assert output_dir == 'rank0'
+
+
+if __name__ == "__main__":
+    test_shard_sampler()
+    test_dist_util()
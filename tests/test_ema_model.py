@@ -0,0 +1,63 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import copy
+import torch
+import torch.nn as nn
+from diffusion_policy.model.diffusion.ema_model import EMAModel
+
+
+def reference_step(ema_model, model, decay):
+    # per-parameter update, as before fusing
+    with torch.no_grad():
+        for module, ema_module in zip(model.modules(), ema_model.modules()):
+            for param, ema_param in zip(module.parameters(recurse=False),
+                    ema_module.parameters(recurse=False)):
+                if isinstance(module, nn.BatchNorm1d) or not param.requires_grad:
+                    ema_param.copy_(param.to(ema_param.dtype))
+                else:
+                    ema_param.mul_(decay)
+                    ema_param.add_(param.to(ema_param.dtype), alpha=1 - decay)
+
+
+def test_ema_model():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(4,8), nn.BatchNorm1d(8), nn.Linear(8,2))
+    model[2].bias.requires_grad_(False)
+
+    for kwargs in [dict(), dict(update_every=3), dict(device='cpu')]:
+        for dtype in [torch.float32, torch.float64]:
+            ema_model = copy.deepcopy(model).to(dtype)
+            expected_model = copy.deepcopy(ema_model)
+            ema = EMAModel(ema_model, power=0.75, **kwargs)
+            update_every = kwargs.get('update_every', 1)
+            pending_decay = 1.0
+            for i in range(10):
+                with torch.no_grad():
+                    for p in model.parameters():
+                        p.add_(torch.randn_like(p))
+                ema.step(model)
+                pending_decay *= ema.get_decay(i)
+                if (i + 1) % update_every == 0:
+                    reference_step(expected_model, model, pending_decay)
+                    pending_decay = 1.0
+            for p, e in zip(ema_model.parameters(), expected_model.parameters()):
+                assert p.dtype == dtype
+                assert torch.allclose(p, e, atol=1e-6)
+
+    # moving the models regroups the parameters
+    ema_model = copy.deepcopy(model)
+    ema = EMAModel(ema_model)
+    ema.step(model)
+    ema_model.double()
+    ema.step(model)
+    ema.step(model)
+    assert torch.allclose(ema_model[0].weight, model[0].weight.double())
+
+
+if __name__ == "__main__":
+    test_ema_model()
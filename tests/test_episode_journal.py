@@ -0,0 +1,129 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import numpy as np
+import zarr
+import pytest
+from diffusion_policy.common.replay_buffer import ReplayBuffer
+from diffusion_policy.common.timestamp_accumulator import (
+    TimestampObsAccumulator,
+    TimestampActionAccumulator
+)
+from diffusion_policy.real_world.episode_journal import (
+    EpisodeWriter, truncate_uncommitted, build_episode)
+
+
+def record(writer, n_steps, start_time=0., dt=0.1):
+    writer.start_episode(start_time=start_time, dt=dt)
+    obs_acc = TimestampObsAccumulator(start_time=start_time, dt=dt,
+        callback=lambda idxs, data: writer.put(data, idxs))
+    action_acc = TimestampActionAccumulator(start_time=start_time, dt=dt,
+        callback=lambda idxs, x: writer.put({'action': x}, idxs))
+    for i in range(n_steps):
+        t = start_time + i * dt
+        obs_acc.put({'robot_eef_pose': np.full((1,6), i, dtype=np.float64)},
+            np.array([t]))
+        # actions are rescheduled with overlap
+        action_acc.put(np.arange(i, i+4, dtype=np.float32)[:,None] * np.ones(2),
+            t + np.arange(4) * dt)
+    data = dict(obs_acc.data)
+    data['action'] = action_acc.actions
+    return data
+
+
+def test_episode_journal(tmp_path):
+    zarr_path = str(tmp_path.joinpath('replay_buffer.zarr'))
+    journal_dir = tmp_path.joinpath('journal')
+    replay_buffer = ReplayBuffer.create_from_path(zarr_path, mode='a')
+    writer = EpisodeWriter(replay_buffer, journal_dir, block_size=4)
+    writer.start()
+
+    # committed episode
+    data = record(writer, 10)
+    assert writer.end_episode(build_episode(data, 0., 0.1)) == 0
+    writer.wait()
+    assert replay_buffer.n_episodes == 1
+    assert len(list(journal_dir.iterdir())) == 0
+    episode = replay_buffer.get_episode(0)
+    assert np.allclose(episode['robot_eef_pose'][:,0], np.arange(10))
+    assert np.allclose(episode['action'][:,0], np.arange(10))
+
+    # crash during the second episode
+    data = record(writer, 13)
+    writer.wait()
+    # blocks of 4 rows are on disk, append a torn record
+    with journal_dir.joinpath('1', 'action.bin').open('ab') as f:
+        f.write(b'\x01' * 10)
+    writer.stop()
+    # interrupted add_episode
+    replay_buffer.data['action'].resize((15, 2))
+    del writer, replay_buffer
+
+    group = zarr.open(zarr_path, mode='a')
+    truncate_uncommitted(group)
+    replay_buffer = ReplayBuffer.create_from_group(group)
+    assert replay_buffer.n_steps == 10
+    writer = EpisodeWriter(replay_buffer, journal_dir, block_size=4)
+    assert replay_buffer.n_episodes == 2
+    assert writer.n_episodes == 2
+    assert len(list(journal_dir.iterdir())) == 0
+    episode = replay_buffer.get_episode(1)
+    n_steps = len(episode['action'])
+    assert 0 < n_steps <= 13
+    assert np.allclose(episode['robot_eef_pose'][:,0], np.arange(n_steps))
+    assert np.allclose(episode['action'][:,0], np.arange(n_steps))
+    assert np.allclose(episode['timestamp'], np.arange(n_steps) * 0.1)
+
+    # drop
+    writer.start()
+    record(writer, 3)
+    writer.end_episode(None)
+    writer.drop_episode()
+    assert replay_buffer.n_episodes == 1
+    writer.stop()
+
+
+def test_torn_episode_ends(tmp_path, monkeypatch):
+    zarr_path = str(tmp_path.joinpath('replay_buffer.zarr'))
+    journal_dir = tmp_path.joinpath('journal')
+    replay_buffer = ReplayBuffer.create_from_path(zarr_path, mode='a')
+    writer = EpisodeWriter(replay_buffer, journal_dir, block_size=4)
+    writer.start()
+    writer.end_episode(build_episode(record(writer, 10), 0., 0.1))
+    writer.wait()
+
+    # crash in the resize of episode_ends during add_episode
+    data = record(writer, 6)
+    writer.end_episode(build_episode(data, 0., 0.1))
+    def resize(self, *args):
+        if self.path.endswith('episode_ends'):
+            raise RuntimeError('crash')
+        return zarr.Array.resize.__wrapped__(self, *args)
+    resize.__wrapped__ = zarr.Array.resize
+    monkeypatch.setattr(zarr.Array, 'resize', resize)
+    with pytest.raises(RuntimeError, match='crash'):
+        writer.wait()
+    monkeypatch.undo()
+    writer.stop()
+    del writer, replay_buffer
+    # ends are staged past the shape, never a committed 0
+    group = zarr.open(zarr_path, mode='a')
+    assert np.array_equal(group['meta']['episode_ends'][:], [10])
+
+    # resized before the value was written (fill value 0)
+    group['meta']['episode_ends'].resize(2)
+    group['meta']['episode_ends'][-1] = 0
+    truncate_uncommitted(group)
+    assert np.array_equal(group['meta']['episode_ends'][:], [10])
+    assert group['data']['action'].shape == (10, 2)
+
+    replay_buffer = ReplayBuffer.create_from_group(group)
+    writer = EpisodeWriter(replay_buffer, journal_dir, block_size=4)
+    assert replay_buffer.n_episodes == 2
+    assert len(list(journal_dir.iterdir())) == 0
+    assert np.allclose(replay_buffer.get_episode(0)['action'][:,0], np.arange(10))
+    assert np.allclose(replay_buffer.get_episode(1)['action'][:,0], np.arange(6))
@@ -0,0 +1,132 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import json
+import tempfile
+import pytest
+import torch
+from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
+from diffusion_policy.model.common.normalizer import (
+    LinearNormalizer, SingleFieldLinearNormalizer)
+from diffusion_policy.model.diffusion.conditional_unet1d import ConditionalUnet1D
+from diffusion_policy.policy.diffusion_unet_lowdim_policy import DiffusionUnetLowdimPolicy
+from diffusion_policy.common.export_util import (
+    export_policy, get_example_obs, ExportedPolicy, META_NAME)
+
+
+def create_lowdim_policy(inference_solver='ddim'):
+    torch.manual_seed(0)
+    model = ConditionalUnet1D(input_dim=2, global_cond_dim=10,
+        diffusion_step_embed_dim=16, down_dims=[32,64])
+    policy = DiffusionUnetLowdimPolicy(model=model,
+        noise_scheduler=DDPMScheduler(num_train_timesteps=100),
+        horizon=16, obs_dim=5, action_dim=2, n_action_steps=8, n_obs_steps=2,
+        num_inference_steps=10, obs_as_global_cond=True,
+        inference_solver=inference_solver)
+    normalizer = LinearNormalizer()
+    normalizer.fit({'obs': torch.randn(100,5), 'action': torch.randn(100,2)})
+    policy.set_normalizer(normalizer)
+    policy.eval()
+    return policy
+
+
+def assert_exported_matches(policy, path, obs_dict, format='torchscript'):
+    """
+    Exports at batch size 2 and runs a batch of 3, seeded identically
+    so that stochastic solvers draw the same noise.
+    """
+    example_obs = dict((key, value[:2]) for key, value in obs_dict.items())
+    export_policy(policy, path, example_obs, format=format)
+    exported = ExportedPolicy(path)
+
+    torch.manual_seed(1)
+    result = exported.predict_action(obs_dict)
+    with torch.no_grad():
+        torch.manual_seed(1)
+        expected = policy.predict_action(example_obs)
+    assert result['action'].shape == (3,) + tuple(expected['action'].shape[1:])
+    assert torch.allclose(result['action'][:2], expected['action'], atol=1e-4)
+    return exported
+
+
+def test_export_torchscript():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for inference_solver in ['ddim', 'scheduler']:
+            policy = create_lowdim_policy(inference_solver)
+            path = os.path.join(tmp_dir, f'policy_{inference_solver}.pt')
+            exported = assert_exported_matches(
+                policy, path, {'obs': torch.randn(3,2,5)})
+            assert exported.meta['batch_size'] == 2
+            assert get_example_obs(policy, batch_size=2)['obs'].shape == (2,2,5)
+
+
+def test_export_onnx(monkeypatch):
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+    policy = create_lowdim_policy('ddim')
+    obs_dict = {'obs': torch.randn(3,2,5)}
+    # onnxruntime has its own RNG, start ddim from zero noise for parity
+    def zeros_randn(size, dtype=None, device=None, generator=None):
+        return torch.zeros(size, dtype=dtype, device=device)
+    monkeypatch.setattr(torch, 'randn', zeros_randn)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'policy.onnx')
+        exported = assert_exported_matches(
+            policy, path, obs_dict, format='onnx')
+        assert exported.session is not None
+        # settings travel in the sidecar next to the graph
+        with open(path + '.' + META_NAME, 'r') as f:
+            meta = json.load(f)
+        assert meta['format'] == 'onnx'
+        assert meta['obs_keys'] == ['obs']
+        assert meta['obs_shapes'] == {'obs': [2,5]}
+        assert meta['output_shapes']['action'] == [8,2]
+        assert meta['n_obs_steps'] == 2
+
+
+def test_export_hybrid_image():
+    pytest.importorskip('robomimic')
+    from diffusion_policy.policy.diffusion_unet_hybrid_image_policy import (
+        DiffusionUnetHybridImagePolicy)
+    torch.manual_seed(0)
+    shape_meta = {
+        'obs': {
+            'agentview_image': {'shape': [3,32,32], 'type': 'rgb'},
+            'robot0_eef_pos': {'shape': [3], 'type': 'low_dim'}
+        },
+        'action': {'shape': [2]}
+    }
+    policy = DiffusionUnetHybridImagePolicy(
+        shape_meta=shape_meta,
+        noise_scheduler=DDPMScheduler(num_train_timesteps=100),
+        horizon=16, n_action_steps=8, n_obs_steps=2,
+        num_inference_steps=10, crop_shape=(28,28),
+        diffusion_step_embed_dim=16, down_dims=[32,64],
+        obs_encoder_group_norm=True, eval_fixed_crop=True)
+    normalizer = LinearNormalizer()
+    normalizer.fit({
+        'action': torch.randn(100,2),
+        'robot0_eef_pos': torch.randn(100,3)})
+    normalizer['agentview_image'] = SingleFieldLinearNormalizer.create_identity()
+    policy.set_normalizer(normalizer)
+    policy.eval()
+
+    obs_dict = {
+        'agentview_image': torch.rand(3,2,3,32,32),
+        'robot0_eef_pos': torch.randn(3,2,3)
+    }
+    example_obs = get_example_obs(policy, shape_meta=shape_meta, batch_size=2)
+    assert example_obs['agentview_image'].shape == (2,2,3,32,32)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'policy.pt')
+        assert_exported_matches(policy, path, obs_dict)
+
+
+if __name__ == "__main__":
+    test_export_torchscript()
+    test_export_onnx(pytest.MonkeyPatch())
+    test_export_hybrid_image()
@@ -0,0 +1,75 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import numpy as np
+import torch
+import torch.nn as nn
+import zarr
+from diffusion_policy.common.normalize_util import get_image_range_normalizer
+from diffusion_policy.model.common.normalizer import LinearNormalizer
+from diffusion_policy.model.vision.multi_image_obs_encoder import MultiImageObsEncoder
+from diffusion_policy.model.vision.feature_cache import (
+    get_rgb_features, get_feature_key)
+
+
+def test_feature_cache(tmp_path):
+    torch.manual_seed(0)
+    shape_meta = {
+        'obs': {
+            'image0': {'shape': [3,12,12], 'type': 'rgb'},
+            'image1': {'shape': [3,12,12], 'type': 'rgb'},
+            'agent_pos': {'shape': [2], 'type': 'low_dim'}
+        }
+    }
+    rgb_model = nn.Sequential(nn.Conv2d(3,4,3), nn.BatchNorm2d(4),
+        nn.Flatten(), nn.LazyLinear(8))
+    obs_encoder = MultiImageObsEncoder(shape_meta=shape_meta, rgb_model=rgb_model,
+        crop_shape=(10,10), random_crop=True, share_rgb_model=True)
+    obs_encoder.output_shape()
+    normalizer = LinearNormalizer()
+    for key in ['image0', 'image1']:
+        normalizer[key] = get_image_range_normalizer()
+
+    root = zarr.group()
+    arrays = dict()
+    for key in ['image0', 'image1']:
+        arrays[key] = root.array(key, np.random.randint(0, 256,
+            size=(37,12,12,3), dtype=np.uint8), chunks=(5,12,12,3))
+
+    obs_encoder.train()
+    features = get_rgb_features(arrays, obs_encoder, normalizer,
+        cache_dir=str(tmp_path), batch_size=8)
+    # training mode restored
+    assert obs_encoder.training
+    assert features['image0'].shape == (37,8)
+    assert len(list(tmp_path.glob('*.zarr.zip'))) == 1
+    cached = get_rgb_features(arrays, obs_encoder, normalizer,
+        cache_dir=str(tmp_path))
+    assert np.array_equal(cached['image1'], features['image1'])
+
+    # same as running the encoder on images in eval mode (center crop)
+    obs_encoder.eval()
+    obs = {
+        'agent_pos': torch.randn(37,2)
+    }
+    for key in ['image0', 'image1']:
+        obs[key] = normalizer[key].normalize(
+            torch.from_numpy(arrays[key][:]).moveaxis(-1,-3) / 255.)
+    feature_obs = {
+        'agent_pos': obs['agent_pos']
+    }
+    for key in ['image0', 'image1']:
+        feature_obs[get_feature_key(key)] = torch.from_numpy(features[key])
+    with torch.no_grad():
+        expected = obs_encoder(obs)
+        result = obs_encoder(feature_obs)
+    assert torch.allclose(result, expected, atol=1e-5)
+
+
+if __name__ == "__main__":
+    import pathlib, tempfile
+    test_feature_cache(pathlib.Path(tempfile.mkdtemp()))
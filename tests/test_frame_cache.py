@@ -0,0 +1,48 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import numpy as np
+from diffusion_policy.common.frame_cache import (
+    FrameCache, SharedFrameCache, CachedFrameArray)
+
+
+def test_lru():
+    frame = np.zeros((4,4,3), dtype=np.uint8)
+    cache = FrameCache(max_bytes=frame.nbytes * 2)
+    cache.put(0, frame)
+    cache.put(1, frame)
+    assert cache.get(0) is not None
+    # evicts 1, the least recently used
+    cache.put(2, frame)
+    assert cache.get(1) is None
+    assert cache.get(2) is not None
+    stats = cache.get_stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+    assert stats['evictions'] == 1
+
+
+def test_cached_array():
+    arr = np.random.default_rng(0).integers(
+        0, 255, size=(20,4,4,3)).astype(np.uint8)
+    for cache in [
+            FrameCache(max_bytes=arr[0].nbytes * 5),
+            SharedFrameCache(max_bytes=arr[0].nbytes * 8,
+                frame_shape=arr.shape[1:], dtype=arr.dtype, n_ways=2)]:
+        cached = CachedFrameArray(arr, cache)
+        for _ in range(2):
+            assert np.array_equal(cached[3:9], arr[3:9])
+            assert np.array_equal(cached[-1], arr[-1])
+            idxs = np.array([7, 2, 2, 15])
+            assert np.array_equal(
+                cached.get_orthogonal_selection(idxs), arr[idxs])
+        assert cache.get_stats()['hits'] > 0
+
+
+if __name__ == "__main__":
+    test_lru()
+    test_cached_array()
@@ -0,0 +1,64 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+import torch.nn as nn
+from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
+from diffusion_policy.model.common.normalizer import (
+    LinearNormalizer, SingleFieldLinearNormalizer)
+from diffusion_policy.model.vision.multi_image_obs_encoder import MultiImageObsEncoder
+from diffusion_policy.policy.diffusion_unet_image_policy import DiffusionUnetImagePolicy
+
+
+def test_n_noise_samples():
+    torch.manual_seed(0)
+    shape_meta = {
+        'obs': {
+            'image': {'shape': [3,8,8], 'type': 'rgb'},
+            'agent_pos': {'shape': [2], 'type': 'low_dim'}
+        },
+        'action': {'shape': [2]}
+    }
+    rgb_model = nn.Sequential(nn.Conv2d(3,4,3), nn.Flatten(), nn.LazyLinear(8))
+    obs_encoder = MultiImageObsEncoder(shape_meta=shape_meta, rgb_model=rgb_model)
+    n_calls = list()
+    obs_encoder.register_forward_hook(
+        lambda module, inputs, output: n_calls.append(len(output)))
+    policy = DiffusionUnetImagePolicy(
+        shape_meta=shape_meta,
+        noise_scheduler=DDPMScheduler(num_train_timesteps=10),
+        obs_encoder=obs_encoder,
+        horizon=8, n_action_steps=4, n_obs_steps=2,
+        diffusion_step_embed_dim=16, down_dims=[16,32],
+        n_noise_samples=3)
+
+    batch = {
+        'obs': {
+            'image': torch.rand(5,8,3,8,8),
+            'agent_pos': torch.randn(5,8,2)
+        },
+        'action': torch.randn(5,8,2)
+    }
+    normalizer = LinearNormalizer()
+    normalizer.fit({'action': batch['action'], 'agent_pos': batch['obs']['agent_pos']})
+    normalizer['image'] = SingleFieldLinearNormalizer.create_identity()
+    policy.set_normalizer(normalizer)
+
+    unet_batch_sizes = list()
+    policy.model.register_forward_hook(
+        lambda module, inputs, output: unet_batch_sizes.append(len(output)))
+    loss = policy.compute_loss(batch)
+    loss.backward()
+    # encoder runs once on B*To, the denoiser on B*K
+    assert n_calls == [5*2]
+    assert unet_batch_sizes == [5*3]
+    conv = next(m for m in obs_encoder.modules() if isinstance(m, nn.Conv2d))
+    assert conv.weight.grad is not None
+
+
+if __name__ == "__main__":
+    test_n_noise_samples()
@@ -0,0 +1,102 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import time
+import tempfile
+import threading
+import multiprocessing
+import pytest
+import torch
+from diffusion_policy.model.common.module_attr_mixin import ModuleAttrMixin
+from diffusion_policy.real_world.policy_server import (
+    PolicyServer, PolicyClient, get_authkey_path)
+
+
+class DummyPolicy(ModuleAttrMixin):
+    def __init__(self):
+        super().__init__()
+        self.dummy = torch.nn.Linear(1,1)
+
+    def predict_action(self, obs_dict):
+        # requests queue up while a batch runs
+        time.sleep(0.005)
+        return {'action': obs_dict['obs'][...,:2] * 2}
+
+
+class StatefulPolicy(DummyPolicy):
+    def reset(self):
+        pass
+
+
+def test_policy_server():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        address = os.path.join(tmp_dir, 'policy.sock')
+        with PolicyServer(DummyPolicy(), address=address,
+                max_batch_size=8, max_wait=0.01) as server:
+            failed = list()
+            def run_client(i):
+                with PolicyClient(address) as client:
+                    for _ in range(10):
+                        obs = torch.randn(1 + i % 2, 2, 3)
+                        action = client.predict_action({'obs': obs})['action']
+                        if not torch.allclose(action, obs[...,:2] * 2):
+                            failed.append(i)
+            threads = [threading.Thread(target=run_client, args=(i,))
+                for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert len(failed) == 0
+
+            metrics = server.get_metrics()
+            assert metrics['n_requests'] == 40
+            assert metrics['batch_size_max'] <= 8
+            # concurrent requests were batched
+            assert metrics['batch_size_max'] > 2
+            assert metrics['n_batches'] < 40
+
+
+def test_policy_server_authkey():
+    # other hosts, or other users on loopback, could send pickles
+    for address in [('0.0.0.0', 0), ('127.0.0.1', 0)]:
+        with pytest.raises(ValueError, match='authkey'):
+            PolicyServer(DummyPolicy(), address=address)
+    # batching would mix per-episode state across clients
+    with pytest.raises(ValueError, match='per-episode state'):
+        PolicyServer(StatefulPolicy(), address=('127.0.0.1', 0),
+            authkey=b'secret')
+
+    # unix socket, key only readable by this user
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        address = os.path.join(tmp_dir, 'policy.sock')
+        with PolicyServer(DummyPolicy(), address=address):
+            authkey_path = get_authkey_path(address)
+            assert (os.stat(authkey_path).st_mode & 0o777) == 0o600
+            with pytest.raises(multiprocessing.AuthenticationError):
+                PolicyClient(address, authkey=b'wrong')
+            with PolicyClient(address) as client:
+                obs = torch.randn(1, 2, 3)
+                action = client.predict_action({'obs': obs})['action']
+                assert torch.allclose(action, obs[...,:2] * 2)
+        assert not os.path.exists(authkey_path)
+
+    with PolicyServer(DummyPolicy(), address=('127.0.0.1', 0),
+            authkey=b'secret') as server:
+        address = server.listener.address
+        with pytest.raises(multiprocessing.AuthenticationError):
+            PolicyClient(address, authkey=b'wrong')
+        # the listener survives bad clients
+        with PolicyClient(address, authkey=b'secret') as client:
+            obs = torch.randn(1, 2, 3)
+            action = client.predict_action({'obs': obs})['action']
+            assert torch.allclose(action, obs[...,:2] * 2)
+
+
+if __name__ == "__main__":
+    test_policy_server()
+    test_policy_server_authkey()
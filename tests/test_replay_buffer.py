@@ -60,3 +60,72 @@ def test_pop():
     buff = ReplayBuffer.create_from_path(
         '/home/chengchi/dev/diffusion_policy/data/pusht_cchi_v3_replay.zarr',
         mode='rw')
+
+
+def test_memmap():
+    import tempfile
+    import numpy as np
+    buff = ReplayBuffer.create_empty_zarr()
+    buff.add_episode({
+        'obs': np.zeros((100,10), dtype=np.float16)
+    })
+    buff.add_episode({
+        'obs': np.ones((50,10), dtype=np.float16)
+    })
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'test.memmap')
+        buff.save_to_memmap(path)
+
+        mm_buff = ReplayBuffer.create_from_memmap(path)
+        assert isinstance(mm_buff['obs'], np.memmap)
+        assert mm_buff.n_episodes == 2
+        assert np.array_equal(mm_buff['obs'], buff['obs'][:])
+
+        # copy_from_path opens memmap copy-on-write
+        cow_buff = ReplayBuffer.copy_from_path(path)
+        cow_buff['obs'][:] = 2
+        assert np.array_equal(
+            ReplayBuffer.create_from_memmap(path)['obs'], buff['obs'][:])
+        del mm_buff, cow_buff
+
+
+def test_add_episodes():
+    import pickle
+    import numpy as np
+    episodes = [{
+        'obs': np.full((n,3), i, dtype=np.float32),
+        'action': np.full((n,), i, dtype=np.int64)
+    } for i, n in enumerate([5, 1, 7, 3])]
+    for create in [ReplayBuffer.create_empty_numpy, ReplayBuffer.create_empty_zarr]:
+        one_by_one = create()
+        for episode in episodes:
+            one_by_one.add_episode(episode)
+        bulk = create()
+        bulk.add_episodes(episodes[:1])
+        bulk.add_episodes(episodes[1:])
+        for buff in [one_by_one, bulk]:
+            assert buff.n_episodes == 4
+            assert np.array_equal(buff.episode_ends[:], [5, 6, 13, 16])
+            assert buff['obs'].shape == (16,3)
+            for i, episode in enumerate(episodes):
+                assert np.array_equal(buff.get_episode(i)['obs'], episode['obs'])
+
+        buff = pickle.loads(pickle.dumps(one_by_one))
+        buff.drop_episode()
+        assert buff.n_episodes == 3
+        assert buff['obs'].shape == (13,3)
+        buff.add_episode(episodes[0])
+        assert np.array_equal(buff.get_episode(-1)['action'], episodes[0]['action'])
+        assert np.array_equal(buff.get_episode(2)['action'], episodes[2]['action'])
+
+    # numpy backend grows geometrically
+    buff = ReplayBuffer.create_empty_numpy()
+    n_allocs = 0
+    for i in range(1000):
+        base = buff.root['data'].get('obs')
+        base = None if base is None else base.base
+        buff.add_episode(episodes[i % 4])
+        n_allocs += int(buff['obs'].base is not base)
+    assert n_allocs < 30
+    buff.shrink_to_fit()
+    assert buff['obs'].base is None
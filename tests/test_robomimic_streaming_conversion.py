@@ -0,0 +1,148 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import tempfile
+import numpy as np
+import h5py
+import zarr
+import pytest
+import diffusion_policy.dataset.robomimic_replay_image_dataset as robomimic_dataset
+from diffusion_policy.dataset.robomimic_replay_image_dataset import (
+    _convert_robomimic_to_replay, _convert_robomimic_to_zarr_streaming)
+from diffusion_policy.common.replay_buffer import ReplayBuffer
+
+
+SHAPE_META = {
+    'obs': {
+        'agentview_image': {'shape': [3,16,16], 'type': 'rgb'},
+        'robot0_eye_in_hand_image': {'shape': [3,16,16], 'type': 'rgb'},
+        'robot0_eef_pos': {'shape': [3]},
+        'robot0_gripper_qpos': {'shape': [2]}
+    },
+    'action': {'shape': [7]}
+}
+
+
+def create_hdf5(path, episode_lengths=(5,3,7,4)):
+    rng = np.random.default_rng(0)
+    with h5py.File(path, 'w') as file:
+        data = file.create_group('data')
+        for i, n in enumerate(episode_lengths):
+            demo = data.create_group(f'demo_{i}')
+            demo['actions'] = rng.uniform(-1, 1, size=(n,7))
+            obs = demo.create_group('obs')
+            obs['agentview_image'] = rng.integers(
+                0, 255, size=(n,16,16,3), dtype=np.uint8)
+            obs['robot0_eye_in_hand_image'] = rng.integers(
+                0, 255, size=(n,16,16,3), dtype=np.uint8)
+            obs['robot0_eef_pos'] = rng.normal(size=(n,3))
+            obs['robot0_gripper_qpos'] = rng.normal(size=(n,2))
+
+
+def load_zip(zarr_path):
+    with zarr.ZipStore(zarr_path, mode='r') as zip_store:
+        return ReplayBuffer.copy_from_store(
+            src_store=zip_store, store=zarr.MemoryStore())
+
+
+def convert(zarr_path, dataset_path, shape_meta=SHAPE_META):
+    return _convert_robomimic_to_zarr_streaming(
+        zarr_path=zarr_path,
+        shape_meta=shape_meta,
+        dataset_path=dataset_path,
+        abs_action=False,
+        rotation_transformer=None,
+        n_workers=2,
+        max_inflight_tasks=4)
+
+
+def assert_replay_equal(actual, expected):
+    np.testing.assert_array_equal(actual.episode_ends[:], expected.episode_ends[:])
+    assert set(actual.keys()) == set(expected.keys())
+    for key in expected.keys():
+        np.testing.assert_array_equal(actual[key][:], expected[key][:])
+
+
+class InterruptedChunkEncoder(robomimic_dataset.ChunkEncoder):
+    """
+    Raises after n_puts frames, like a conversion killed partway.
+    """
+    n_puts = 30
+
+    def put(self, *args, **kwargs):
+        if self.n_puts == 0:
+            raise KeyboardInterrupt()
+        self.n_puts -= 1
+        return super().put(*args, **kwargs)
+
+
+class CountingChunkEncoder(robomimic_dataset.ChunkEncoder):
+    n_puts = 0
+
+    def put(self, *args, **kwargs):
+        CountingChunkEncoder.n_puts += 1
+        return super().put(*args, **kwargs)
+
+
+def test_streaming_conversion(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_path = os.path.join(tmp_dir, 'image.hdf5')
+        create_hdf5(dataset_path)
+        expected = _convert_robomimic_to_replay(
+            store=zarr.MemoryStore(),
+            shape_meta=SHAPE_META,
+            dataset_path=dataset_path,
+            abs_action=False,
+            rotation_transformer=None,
+            n_workers=2)
+
+        # uninterrupted, parity with the in-memory conversion
+        zarr_path = os.path.join(tmp_dir, 'full.zarr.zip')
+        convert(zarr_path, dataset_path)
+        assert not os.path.exists(zarr_path + '.partial')
+        assert_replay_equal(load_zip(zarr_path), expected)
+
+        # interrupted, then resumed from the last committed episode
+        zarr_path = os.path.join(tmp_dir, 'resumed.zarr.zip')
+        with monkeypatch.context() as m:
+            m.setattr(robomimic_dataset, 'ChunkEncoder', InterruptedChunkEncoder)
+            with pytest.raises(KeyboardInterrupt):
+                convert(zarr_path, dataset_path)
+        assert not os.path.exists(zarr_path)
+        partial = zarr.open_group(zarr_path + '.partial', mode='r')
+        n_completed = partial.attrs['n_completed_episodes']
+        assert 0 < n_completed < len(expected.episode_ends)
+        with monkeypatch.context() as m:
+            m.setattr(robomimic_dataset, 'ChunkEncoder', CountingChunkEncoder)
+            convert(zarr_path, dataset_path)
+        # only frames of uncommitted episodes are encoded again
+        n_remaining = expected.n_steps - expected.episode_ends[n_completed-1]
+        assert CountingChunkEncoder.n_puts == n_remaining * 2
+        assert_replay_equal(load_zip(zarr_path), expected)
+
+        # interrupted, then restarted since the settings changed
+        zarr_path = os.path.join(tmp_dir, 'restarted.zarr.zip')
+        with monkeypatch.context() as m:
+            m.setattr(robomimic_dataset, 'ChunkEncoder', InterruptedChunkEncoder)
+            with pytest.raises(KeyboardInterrupt):
+                convert(zarr_path, dataset_path)
+        shape_meta = {
+            'obs': {key: value for key, value in SHAPE_META['obs'].items()
+                if key != 'robot0_gripper_qpos'},
+            'action': SHAPE_META['action']
+        }
+        convert(zarr_path, dataset_path, shape_meta=shape_meta)
+        replay_buffer = load_zip(zarr_path)
+        assert 'robot0_gripper_qpos' not in replay_buffer
+        np.testing.assert_array_equal(
+            replay_buffer.episode_ends[:], expected.episode_ends[:])
+        for key in replay_buffer.keys():
+            np.testing.assert_array_equal(replay_buffer[key][:], expected[key][:])
+
+
+if __name__ == "__main__":
+    test_streaming_conversion(pytest.MonkeyPatch())
@@ -0,0 +1,204 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import copy
+import dill
+import numpy as np
+from diffusion_policy.env_runner.rollout_scheduler import (
+    run_rollouts, SequentialStopping, score_confidence_interval)
+
+
+class CountdownEnv:
+    """
+    Episode of n_steps steps, obs is the init index.
+    """
+    def run_dill_function(self, dill_fn):
+        dill.loads(dill_fn)(self)
+
+    def reset(self):
+        self.t = 0
+        self.reward = list()
+        return np.array([self.init_idx], dtype=np.float32)
+
+    def step(self, action):
+        assert action[0] == self.init_idx
+        self.t += 1
+        self.reward.append(float(self.t))
+        done = self.t >= self.n_steps
+        return np.array([self.init_idx], dtype=np.float32), self.t, done, {'t': self.t}
+
+
+class FakeVectorEnv:
+    """
+    In-process stand-in for AsyncVectorEnv's indexed calls.
+    """
+    def __init__(self, n_envs):
+        self.envs = [CountdownEnv() for _ in range(n_envs)]
+        self.num_envs = n_envs
+        self.n_steps = 0
+
+    def call_each(self, name, args_list, indices):
+        return [getattr(self.envs[i], name)(*args) for i, args in zip(indices, args_list)]
+
+    def reset(self, indices):
+        return np.stack([self.envs[i].reset() for i in indices])
+
+    def step(self, actions, indices):
+        self.n_steps += 1
+        obs, reward, done, info = zip(*[self.envs[i].step(a) for i, a in zip(indices, actions)])
+        return np.stack(obs), np.array(reward), np.array(done), info
+
+    def render(self, indices):
+        return [f'video_{self.envs[i].init_idx}.mp4' for i in indices]
+
+    def call(self, name, attr, indices):
+        assert name == 'get_attr'
+        # copies, as from the worker processes
+        return [copy.deepcopy(getattr(self.envs[i], attr)) for i in indices]
+
+
+class StatefulPolicy:
+    """
+    Per-row state sized to the batch at the first call after reset,
+    like the hidden state of an RNN policy.
+    """
+    def __init__(self, stateful=True):
+        self.stateful = stateful
+        self.n_resets = 0
+        self.batch_sizes = list()
+        self.state = None
+
+    def reset(self):
+        self.n_resets += 1
+        self.state = None
+
+    def predict_action(self, obs, past_action):
+        self.batch_sizes.append(len(obs))
+        if self.stateful:
+            if self.state is None:
+                self.state = obs.copy()
+            # rows keep their env
+            assert np.array_equal(self.state, obs)
+        if past_action is not None:
+            assert np.array_equal(past_action, obs)
+        # echo the init index, checked by the env
+        return obs.copy()
+
+
+def get_init_fn_dills(episode_lengths):
+    init_fn_dills = list()
+    for i, n_steps in enumerate(episode_lengths):
+        def init_fn(env, init_idx=i, n_steps=n_steps):
+            env.init_idx = init_idx
+            env.n_steps = n_steps
+        init_fn_dills.append(dill.dumps(init_fn))
+    return init_fn_dills
+
+
+def test_run_rollouts():
+    episode_lengths = [10, 1, 1, 1, 2, 2, 1, 3, 1]
+    init_fn_dills = get_init_fn_dills(episode_lengths)
+
+    n_steps = dict()
+    for continuous in [True, False]:
+        env = FakeVectorEnv(3)
+        policy = StatefulPolicy(stateful=not continuous)
+        video_paths, rewards, last_infos = run_rollouts(
+            env=env,
+            env_init_fn_dills=init_fn_dills,
+            predict_action=policy.predict_action,
+            reset_policy=policy.reset,
+            continuous=continuous)
+        for i, n in enumerate(episode_lengths):
+            assert video_paths[i] == f'video_{i}.mp4'
+            assert rewards[i] == list(range(1, n+1))
+            assert last_infos[i] == {'t': n}
+        n_steps[continuous] = env.n_steps
+        if continuous:
+            # only the running envs are stepped
+            assert sum(policy.batch_sizes) == sum(episode_lengths)
+        else:
+            # policy reset for each chunk of 3 envs,
+            # whose batch keeps its size until all are done
+            assert policy.n_resets == 3
+            assert set(policy.batch_sizes) == {3}
+    # chunks wait for their longest episode
+    assert n_steps[False] == 10 + 2 + 3
+    assert n_steps[True] == 10
+
+
+def test_run_rollouts_groups():
+    # e.g. one env pool per robot
+    env_groups = ['a', 'a', 'b']
+    init_groups = ['a', 'b', 'a', 'b', 'a', 'a', 'b']
+    episode_lengths = [3, 1, 2, 2, 1, 1, 1]
+    init_fn_dills = list()
+    for i, (n_steps, group) in enumerate(zip(episode_lengths, init_groups)):
+        def init_fn(env, init_idx=i, n_steps=n_steps, group=group):
+            assert env.group == group
+            env.init_idx = init_idx
+            env.n_steps = n_steps
+        init_fn_dills.append(dill.dumps(init_fn))
+
+    for continuous in [True, False]:
+        env = FakeVectorEnv(3)
+        for this_env, group in zip(env.envs, env_groups):
+            this_env.group = group
+        policy = StatefulPolicy(stateful=not continuous)
+        video_paths, rewards, _ = run_rollouts(
+            env=env,
+            env_init_fn_dills=init_fn_dills,
+            predict_action=policy.predict_action,
+            reset_policy=policy.reset,
+            continuous=continuous,
+            env_groups=env_groups,
+            init_groups=init_groups)
+        for i, n in enumerate(episode_lengths):
+            assert video_paths[i] == f'video_{i}.mp4'
+            assert rewards[i] == list(range(1, n+1))
+        if continuous:
+            assert sum(policy.batch_sizes) == sum(episode_lengths)
+
+
+def test_sequential_stopping():
+    low, high = score_confidence_interval([1.0] * 10)
+    assert 0.5 < low < high <= 1.0
+    # waves of 4 until the mean is known to 0.2
+    stopping = SequentialStopping(wave_size=4, ci_half_width=0.2)
+    assert not stopping([1.0] * 3)
+    assert not stopping([1.0, 0.0, 1.0, 0.0])
+    assert not stopping([1.0, 0.0, 1.0, 0.0, 1.0])
+    assert stopping([1.0, 0.0] * 12)
+    # clearly below the top-k
+    stopping = SequentialStopping(wave_size=4, ci_half_width=0.01,
+        score_threshold=0.9)
+    assert stopping([0.0] * 4)
+
+    # long episode 0 holds back the prefix seen by stop_fn
+    episode_lengths = [6] + [1] * 14
+    env = FakeVectorEnv(3)
+    prefixes = list()
+    def stop_fn(rewards):
+        assert all(x is not None for x in rewards)
+        prefixes.append(len(rewards))
+        return len(rewards) >= 4
+    _, rewards, _ = run_rollouts(
+        env=env,
+        env_init_fn_dills=get_init_fn_dills(episode_lengths),
+        predict_action=lambda obs, past_action: obs.copy(),
+        reset_policy=lambda: None,
+        stop_fn=stop_fn)
+    assert prefixes == [13]
+    assert all(x is not None for x in rewards[:13])
+    assert all(x is None for x in rewards[13:])
+    assert env.n_steps == 6
+
+
+if __name__ == "__main__":
+    test_run_rollouts()
+    test_run_rollouts_groups()
+    test_sequential_stopping()
@@ -0,0 +1,135 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import numpy as np
+from diffusion_policy.common.replay_buffer import ReplayBuffer
+from diffusion_policy.common.sampler import (
+    SequenceSampler, LazySequenceIndex, create_indices)
+from diffusion_policy.common.dataloader_util import ChunkLocalitySampler
+
+
+def _create_buffers():
+    rng = np.random.default_rng(0)
+    np_buff = ReplayBuffer.create_empty_numpy()
+    zarr_buff = ReplayBuffer.create_empty_zarr()
+    for n in [5, 17, 3, 30]:
+        episode = {
+            'obs': rng.normal(size=(n,4,2)).astype(np.float32),
+            'img': rng.integers(0, 255, size=(n,3,3,3)).astype(np.uint8)
+        }
+        np_buff.add_episode(episode)
+        zarr_buff.add_episode(episode, chunks={
+            'obs': (7,4,2),
+            'img': (1,3,3,3)
+        })
+    return np_buff, zarr_buff
+
+
+def test_sample_batch():
+    episode_mask = np.array([True, False, True, True])
+    for buff in _create_buffers():
+        for key_first_k in [dict(), {'obs': 2, 'img': 3}]:
+            sampler = SequenceSampler(
+                replay_buffer=buff,
+                sequence_length=8,
+                pad_before=3,
+                pad_after=5,
+                key_first_k=key_first_k,
+                episode_mask=episode_mask)
+            idxs = np.random.default_rng(0).permutation(len(sampler))
+            batch = sampler.sample_batch(idxs)
+            for key, value in batch.items():
+                expected = np.stack([
+                    sampler.sample_sequence(i)[key] for i in idxs])
+                np.testing.assert_array_equal(value, expected)
+
+
+def test_lazy_index():
+    episode_ends = np.cumsum([10, 3, 1, 25, 7])
+    episode_mask = np.array([True, True, True, False, True])
+    for sequence_length in [1, 4, 8]:
+        for pad_before, pad_after in [(0,0), (1,7), (15,15)]:
+            expected = create_indices(episode_ends,
+                sequence_length=sequence_length, episode_mask=episode_mask,
+                pad_before=pad_before, pad_after=pad_after)
+            index = LazySequenceIndex(episode_ends,
+                sequence_length=sequence_length, episode_mask=episode_mask,
+                pad_before=pad_before, pad_after=pad_after)
+            assert len(index) == len(expected)
+            if len(expected) == 0:
+                continue
+            np.testing.assert_array_equal(np.asarray(index), expected)
+            for i in [0, len(index) // 2, -1]:
+                np.testing.assert_array_equal(index[i], expected[i])
+            idxs = np.random.default_rng(0).integers(0, len(index), size=32)
+            np.testing.assert_array_equal(index[idxs], expected[idxs])
+            np.testing.assert_array_equal(index[idxs,0], expected[idxs,0])
+
+    np_buff, _ = _create_buffers()
+    kwargs = dict(replay_buffer=np_buff, sequence_length=8,
+        pad_before=3, pad_after=5, key_first_k={'obs': 2})
+    sampler = SequenceSampler(**kwargs)
+    lazy_sampler = SequenceSampler(lazy_index=True, **kwargs)
+    assert len(lazy_sampler) == len(sampler)
+    for i in range(len(sampler)):
+        np.testing.assert_array_equal(sampler.sample_sequence(i)['img'],
+            lazy_sampler.sample_sequence(i)['img'])
+    idxs = np.arange(len(sampler))
+    for key, value in sampler.sample_batch(idxs).items():
+        np.testing.assert_array_equal(value,
+            lazy_sampler.sample_batch(idxs)[key])
+
+
+def test_chunk_locality_sampler():
+    np_buff, zarr_buff = _create_buffers()
+    sampler = SequenceSampler(replay_buffer=zarr_buff, sequence_length=4)
+    block_ids = sampler.get_sample_block_ids()
+    # obs has the largest rows, chunked by 7
+    np.testing.assert_array_equal(block_ids, sampler.indices[:,0] // 7)
+    episode_ids = SequenceSampler(replay_buffer=np_buff,
+        sequence_length=4).get_sample_block_ids()
+    assert episode_ids[0] == 0 and episode_ids[-1] == 3
+
+    for window_size in [1, 3]:
+        locality_sampler = ChunkLocalitySampler(block_ids, window_size=window_size)
+        idxs = list(locality_sampler)
+        assert sorted(idxs) == list(range(len(sampler)))
+    # window_size=1 visits blocks one after another
+    idxs = list(ChunkLocalitySampler(block_ids, window_size=1))
+    n_changes = np.sum(np.diff(block_ids[idxs]) != 0)
+    assert n_changes == len(np.unique(block_ids)) - 1
+
+
+def test_chunk_block_ids_per_frame_images():
+    rng = np.random.default_rng(0)
+    for img_chunk_len in [1, 4]:
+        buff = ReplayBuffer.create_empty_zarr()
+        for n in [5, 17, 3, 30]:
+            buff.add_episode({
+                'obs': rng.normal(size=(n,4)).astype(np.float32),
+                'img': rng.integers(0, 255, size=(n,8,8,3)).astype(np.uint8)
+            }, chunks={
+                'obs': (7,4),
+                'img': (img_chunk_len,8,8,3)
+            }, compressors={'obs': None, 'img': 'default'})
+        sampler = SequenceSampler(replay_buffer=buff, sequence_length=4)
+        block_ids = sampler.get_sample_block_ids()
+        if img_chunk_len == 1:
+            # one image per chunk, as with Jpeg2k, falls back to episodes
+            episode_ids = sampler.get_sample_block_ids(group_by='episode')
+            np.testing.assert_array_equal(block_ids, episode_ids)
+            assert len(np.unique(block_ids)) > 1
+        else:
+            np.testing.assert_array_equal(block_ids,
+                sampler.indices[:,0] // img_chunk_len)
+
+
+if __name__ == "__main__":
+    test_chunk_locality_sampler()
+    test_chunk_block_ids_per_frame_images()
+    test_sample_batch()
+    test_lazy_index()
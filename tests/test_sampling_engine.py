@@ -0,0 +1,76 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
+from diffusion_policy.model.diffusion.conditional_unet1d import ConditionalUnet1D
+from diffusion_policy.model.diffusion.sampling_engine import DiffusionSamplingEngine
+
+
+class GaussianEpsModel(torch.nn.Module):
+    """
+    Exact epsilon prediction for data ~ N(mean, std^2).
+    """
+    def __init__(self, alphas_cumprod, mean, std):
+        super().__init__()
+        self.alphas_cumprod = alphas_cumprod
+        self.mean = mean
+        self.std = std
+
+    def forward(self, sample, timestep, **kwargs):
+        a = self.alphas_cumprod[int(timestep)]
+        var = a * self.std**2 + (1 - a)
+        return (1 - a)**0.5 * (sample - a**0.5 * self.mean) / var
+
+
+def test_scheduler_parity():
+    torch.manual_seed(0)
+    model = ConditionalUnet1D(input_dim=4, global_cond_dim=8,
+        diffusion_step_embed_dim=16, down_dims=[32,64]).eval()
+    scheduler = DDPMScheduler(num_train_timesteps=100,
+        beta_schedule='squaredcos_cap_v2')
+    global_cond = torch.randn(3,8)
+    condition_data = torch.zeros(3,16,4)
+    condition_mask = torch.zeros_like(condition_data, dtype=torch.bool)
+
+    with torch.no_grad():
+        generator = torch.Generator().manual_seed(1)
+        expected = torch.randn(condition_data.shape, generator=generator)
+        scheduler.set_timesteps(20)
+        for t in scheduler.timesteps:
+            model_output = model(expected, t, global_cond=global_cond)
+            expected = scheduler.step(model_output, t, expected,
+                generator=generator).prev_sample
+
+        engine = DiffusionSamplingEngine(scheduler, record_latency=True)
+        for _ in range(2):
+            result = engine.sample(model, condition_data, condition_mask,
+                num_inference_steps=20,
+                model_kwargs=dict(global_cond=global_cond),
+                generator=torch.Generator().manual_seed(1))
+            assert torch.allclose(result, expected, atol=1e-5)
+        assert engine.get_latency_stats()['n_steps'] == 20
+
+
+def test_fast_solvers():
+    scheduler = DDPMScheduler(num_train_timesteps=100,
+        beta_schedule='squaredcos_cap_v2', clip_sample=False)
+    model = GaussianEpsModel(scheduler.alphas_cumprod, mean=0.3, std=0.5)
+    condition_data = torch.zeros(20000,1,1)
+    condition_mask = torch.zeros_like(condition_data, dtype=torch.bool)
+    for solver, n_steps in [('ddim', 50), ('dpmsolver++', 15)]:
+        engine = DiffusionSamplingEngine(scheduler, solver=solver)
+        result = engine.sample(model, condition_data, condition_mask,
+            num_inference_steps=n_steps,
+            generator=torch.Generator().manual_seed(0))
+        assert abs(result.mean().item() - 0.3) < 0.02
+        assert abs(result.std().item() - 0.5) < 0.03
+
+
+if __name__ == "__main__":
+    test_scheduler_parity()
+    test_fast_solvers()
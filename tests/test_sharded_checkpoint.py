@@ -0,0 +1,122 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import pathlib
+import tempfile
+import torch
+from omegaconf import OmegaConf
+from diffusion_policy.workspace.base_workspace import BaseWorkspace
+from diffusion_policy.common.checkpoint_util import TopKCheckpointManager
+from diffusion_policy.common.sharded_checkpoint import (
+    is_sharded_checkpoint, LazyStateDicts)
+
+
+class DummyWorkspace(BaseWorkspace):
+    include_keys = ['epoch']
+
+    def __init__(self, cfg, output_dir=None):
+        super().__init__(cfg, output_dir=output_dir)
+        self.model = torch.nn.Sequential(
+            torch.nn.Linear(4, 8), torch.nn.BatchNorm1d(8))
+        self.ema_model = torch.nn.Linear(4, 8)
+        self.optimizer = torch.optim.AdamW(self.model.parameters())
+        self.epoch = 0
+
+
+def test_sharded_checkpoint():
+    cfg = OmegaConf.create({'checkpoint': {'format': 'sharded'}})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workspace = DummyWorkspace(cfg, output_dir=tmp_dir)
+        workspace.model(torch.randn(3, 4)).sum().backward()
+        workspace.optimizer.step()
+        workspace.epoch = 5
+        path = workspace.save_checkpoint(use_thread=False)
+        assert is_sharded_checkpoint(path)
+        # overwrite in place
+        path = workspace.save_checkpoint(use_thread=False)
+
+        other = DummyWorkspace(cfg, output_dir=tmp_dir)
+        payload = other.load_checkpoint(path, exclude_keys=['optimizer'])
+        assert isinstance(payload['state_dicts'], LazyStateDicts)
+        # excluded state dicts are never read
+        assert 'optimizer' not in payload['state_dicts'].loaded
+        assert other.epoch == 5
+        for key, value in workspace.model.state_dict().items():
+            assert torch.equal(value, other.model.state_dict()[key])
+
+        other = DummyWorkspace.create_from_checkpoint(path)
+        assert other.optimizer.state_dict()['state'][0]['step'] \
+            == workspace.optimizer.state_dict()['state'][0]['step']
+
+        # identical shards are hard-linked, removed ones garbage collected
+        ckpt_dir = pathlib.Path(path).parent
+        store = ckpt_dir.joinpath('.shards')
+        topk = TopKCheckpointManager(str(ckpt_dir), monitor_key='loss', k=1,
+            format_str='loss={loss:.3f}.ckpt')
+        topk_path = topk.get_ckpt_path({'loss': 1.0})
+        workspace.save_checkpoint(path=topk_path, use_thread=False)
+        n_store = len(list(store.iterdir()))
+        assert n_store == 3
+        workspace.ema_model.weight.data += 1
+        topk_path = topk.get_ckpt_path({'loss': 0.5})
+        workspace.save_checkpoint(path=topk_path, use_thread=False)
+        assert len(list(store.iterdir())) == 4
+        ema_file = pathlib.Path(topk_path).joinpath(
+            'shards', 'ema_model.safetensors')
+        assert ema_file.stat().st_nlink == 2
+        model_file = pathlib.Path(topk_path).joinpath(
+            'shards', 'model.safetensors')
+        assert model_file.stat().st_nlink == 3
+
+
+
+def test_resume_sharded_checkpoint():
+    cfg = OmegaConf.create({'checkpoint': {'format': 'sharded'}})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workspace = DummyWorkspace(cfg, output_dir=tmp_dir)
+        latest_ckpt_path = workspace.get_checkpoint_path()
+        assert not workspace.is_checkpoint(latest_ckpt_path)
+        workspace.epoch = 7
+        workspace.save_checkpoint(use_thread=False)
+        # latest.ckpt is a directory
+        assert latest_ckpt_path.is_dir()
+
+        # as in the resume block of the training workspaces
+        other = DummyWorkspace(cfg, output_dir=tmp_dir)
+        assert other.is_checkpoint(other.get_checkpoint_path())
+        other.load_checkpoint(path=other.get_checkpoint_path())
+        assert other.epoch == 7
+
+        # torch format
+        cfg = OmegaConf.create({'checkpoint': {'format': 'torch'}})
+        workspace = DummyWorkspace(cfg, output_dir=tmp_dir)
+        path = workspace.save_checkpoint(tag='torch', use_thread=False)
+        assert workspace.is_checkpoint(path)
+
+
+def test_switch_checkpoint_format():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, format in enumerate(['torch', 'sharded', 'torch']):
+            cfg = OmegaConf.create({'checkpoint': {'format': format}})
+            workspace = DummyWorkspace(cfg, output_dir=tmp_dir)
+            workspace.epoch = i
+            path = pathlib.Path(workspace.save_checkpoint(use_thread=False))
+            assert is_sharded_checkpoint(path) == (format == 'sharded')
+            assert not path.with_name(path.name + '.old').exists()
+
+            other = DummyWorkspace(cfg, output_dir=tmp_dir)
+            other.load_checkpoint(path=path)
+            assert other.epoch == i
+        # shards of the replaced checkpoint are garbage collected
+        store = path.parent.joinpath('.shards')
+        assert len(list(store.glob('*.safetensors'))) == 0
+
+
+if __name__ == "__main__":
+    test_sharded_checkpoint()
+    test_resume_sharded_checkpoint()
+    test_switch_checkpoint_format()
@@ -0,0 +1,89 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import tempfile
+import numpy as np
+import torch
+import zarr
+from diffusion_policy.common.stats_util import (
+    compute_array_stats, get_array_stats, get_path_fingerprint)
+from diffusion_policy.common.normalize_util import array_to_stats
+from diffusion_policy.model.common.normalizer import SingleFieldLinearNormalizer
+
+
+def test_compute_array_stats():
+    data = np.random.default_rng(0).normal(loc=3, size=(1000,4,2)).astype(np.float32)
+    zarr_data = zarr.array(data, chunks=(64,4,2))
+    for arr in [data, zarr_data]:
+        # small blocks to exercise merging
+        stats = compute_array_stats(arr, last_n_dims=2, max_block_bytes=1024)
+        flat = data.reshape(-1,8).astype(np.float64)
+        assert np.allclose(stats['min'], flat.min(axis=0))
+        assert np.allclose(stats['max'], flat.max(axis=0))
+        assert np.allclose(stats['mean'], flat.mean(axis=0))
+        assert np.allclose(stats['std'], flat.std(axis=0))
+
+    stat = array_to_stats(zarr_data)
+    assert stat['mean'].shape == (4,2)
+    assert stat['mean'].dtype == np.float32
+    assert np.allclose(stat['std'], data.std(axis=0), atol=1e-5)
+
+    # zarr path matches the in-memory torch fit
+    expected = SingleFieldLinearNormalizer.create_fit(data, mode='gaussian')
+    result = SingleFieldLinearNormalizer.create_fit(zarr_data, mode='gaussian')
+    for key in ['scale', 'offset']:
+        assert torch.allclose(result.params_dict[key],
+            expected.params_dict[key], atol=1e-5)
+
+
+def test_stats_cache():
+    data = np.random.default_rng(0).uniform(size=(100,3))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path = os.path.join(tmp_dir, 'stats.json')
+        stats = get_array_stats(data, cache_path=cache_path)
+        assert os.path.isfile(cache_path)
+        cached = get_array_stats(data, cache_path=cache_path)
+        for key, value in stats.items():
+            assert np.allclose(cached[key], value)
+        data[0] = 10
+        changed = get_array_stats(data, cache_path=cache_path)
+        assert np.allclose(changed['max'][0], 10)
+
+
+def test_stats_cache_key():
+    data = np.random.default_rng(0).uniform(size=(100,3))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path = os.path.join(tmp_dir, 'stats.json')
+        dataset_path = os.path.join(tmp_dir, 'data.zarr.zip')
+        with open(dataset_path, 'wb') as f:
+            f.write(b'0' * 16)
+        fingerprint = get_path_fingerprint(dataset_path)
+        assert fingerprint == get_path_fingerprint(dataset_path)
+        assert fingerprint != get_path_fingerprint(dataset_path, True)
+        stats = get_array_stats(data, cache_path=cache_path,
+            cache_key=f'{fingerprint}/action')
+
+        class Unreadable:
+            shape = data.shape
+            dtype = data.dtype
+            def __getitem__(self, idx):
+                raise AssertionError('cached stats read the array')
+        cached = get_array_stats(Unreadable(), cache_path=cache_path,
+            cache_key=f'{fingerprint}/action')
+        for key, value in stats.items():
+            assert np.allclose(cached[key], value)
+
+        # rewritten dataset
+        with open(dataset_path, 'wb') as f:
+            f.write(b'1' * 17)
+        assert get_path_fingerprint(dataset_path) != fingerprint
+
+
+if __name__ == "__main__":
+    test_compute_array_stats()
+    test_stats_cache()
+    test_stats_cache_key()
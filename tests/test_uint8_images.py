@@ -0,0 +1,42 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import tempfile
+import numpy as np
+import torch
+from diffusion_policy.common.replay_buffer import ReplayBuffer
+from diffusion_policy.common.pytorch_util import dict_apply, uint8_images_to_float
+from diffusion_policy.dataset.pusht_image_dataset import PushTImageDataset
+
+
+def test_uint8_images():
+    rb = ReplayBuffer.create_empty_numpy()
+    for _ in range(2):
+        rb.add_episode({
+            'img': np.random.randint(0, 256, size=(10,8,8,3)).astype(np.float32),
+            'state': np.random.uniform(size=(10,5)).astype(np.float32),
+            'action': np.random.uniform(size=(10,2)).astype(np.float32)
+        })
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        zarr_path = os.path.join(tmp_dir, 'data.zarr')
+        rb.save_to_path(zarr_path)
+        float_dataset = PushTImageDataset(zarr_path, horizon=4)
+        uint8_dataset = PushTImageDataset(zarr_path, horizon=4, uint8_images=True)
+
+        expected = float_dataset[3]
+        result = uint8_dataset[3]
+        assert result['obs']['image'].dtype == torch.uint8
+        assert result['obs']['image'].shape == (4,3,8,8)
+        result = dict_apply(result, uint8_images_to_float)
+        assert result['obs']['image'].dtype == torch.float32
+        assert torch.allclose(result['obs']['image'],
+            expected['obs']['image'].float())
+        assert torch.equal(result['action'], expected['action'])
+
+
+if __name__ == "__main__":
+    test_uint8_images()